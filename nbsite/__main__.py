@@ -5,7 +5,9 @@ import inspect
 
 from pathlib import Path
 
-from .cmd import build, generate_rst, init
+from .cmd import (
+    build, execute, generate_rst, init,
+)
 from .scripts import build_llms_docs
 
 
@@ -87,8 +89,32 @@ def main(args=None):
                               help='dir in which assets for examples are located - if relative, should be relative to project-root')
     build_parser.add_argument('--clean-dry-run',action='store_true',help='whether to not actually delete files from output (useful for uploading)')
     build_parser.add_argument('--inspect-links',action='store_true',help='whether to not to print all links')
+    build_parser.add_argument('--doctree-dir',type=str,default=None,
+                              help='where to keep the sphinx environment between builds; defaults to .nbsite/doctrees in project-root')
+    build_parser.add_argument('--fresh',action='store_true',help='whether to ignore the kept sphinx environment and rebuild everything')
+    build_parser.add_argument('--profile',nargs='?',const=True,default=False,metavar='DIR',
+                              help='write a timing report of the build to DIR; defaults to .nbsite/profile in project-root')
+    build_parser.add_argument('--max-memory',type=str,default=None,
+                              help='memory budget of the parallel sphinx workers, e.g. 16G (requires psutil)')
+    build_parser.add_argument('--max-notebook-time',type=float,default=None,
+                              help='fail the build if a notebook takes longer than this number of seconds to execute')
+    build_parser.add_argument('--max-cell-time',type=float,default=None,
+                              help='fail the build if a notebook cell takes longer than this number of seconds to execute')
+    build_parser.add_argument('--executed',type=str,default=None,metavar='DIR',
+                              help='directory of the notebooks executed with `nbsite execute` (all shards merged) to install before building')
     _set_defaults(build_parser,build)
 
+    execute_parser = subparsers.add_parser("execute", help=inspect.getdoc(execute))
+    _add_common_args(execute_parser,'--project-root','--doc','--examples')
+    execute_parser.add_argument('--examples-assets',type=str,default="assets",
+                                help='dir in which assets for examples are located - if relative, should be relative to project-root')
+    execute_parser.add_argument('--what',type=str,help='type of output the notebooks are executed for',default='html')
+    execute_parser.add_argument('--shard',type=str,default='1/1',metavar='i/N',
+                                help='execute the i-th of N shards of the notebooks, e.g. 2/4')
+    execute_parser.add_argument('--output',type=str,default=None,metavar='DIR',
+                                help='where to write the executed notebooks; defaults to .nbsite/executed in project-root')
+    _set_defaults(execute_parser,execute)
+
     llms_parser = subparsers.add_parser("build-llms", help="build markdown docs and llms.txt from a reusable config")
     llms_parser.add_argument('--config', type=str, required=True, help='config spec in module:attr or path.py:attr form; attr defaults to CONFIG')
     llms_parser.set_defaults(func=lambda args: build_llms_docs(_load_config_object(args.config)))
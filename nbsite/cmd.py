@@ -2,48 +2,25 @@ import glob
 import os
 import re
 import sys
+import tempfile
 
 from collections import ChainMap
 from os.path import dirname
 
 from sphinx.application import Sphinx
-from sphinx.util import parallel as _sphinx_parallel
 
-from .scripts import clean_dist_html, fix_links
+from .execstats import (
+    REPORT_FILENAME, check_thresholds, execution_stats, print_report,
+    write_report,
+)
+from .parallel import memory_aware_parallel
+from .profiling import profile_builder, profiled, span
+from .scripts import postprocess_html
+from .shards import (
+    install_artifacts, parse_shard, read_manifest, shard_of, write_manifest,
+)
 from .util import copy_files
 
-_orig_join_one = _sphinx_parallel.ParallelTasks._join_one
-
-
-def _safe_join_one(self):
-    try:
-        return _orig_join_one(self)
-    except EOFError:
-        pass
-    for tid, proc in self._procs.copy().items():
-        if proc.exitcode is None:
-            continue
-        # Worker died without sending; finish chunk in main proc so build completes.
-        print(
-            f"sphinx parallel worker (tid={tid}, exitcode={proc.exitcode}) died; "
-            f"running chunk serial in main process",
-            flush=True,
-            file=sys.stderr,
-        )
-        _, func, arg = proc._args
-        proc.join()
-        self._procs.pop(tid)
-        self._precvs.pop(tid)
-        self._args.pop(tid)
-        result_func = self._result_funcs.pop(tid)
-        self._pworking -= 1
-        result_func(arg, func(arg) if arg is not None else func())
-        break
-    return True
-
-
-_sphinx_parallel.ParallelTasks._join_one = _safe_join_one
-
 DEFAULT_SITE_ORDERING = [
     "Introduction",
     "Getting Started",
@@ -53,6 +30,20 @@ DEFAULT_SITE_ORDERING = [
     "API"
 ]
 
+# Sphinx environment and doctrees, kept between builds and relative to
+# the project root.
+DOCTREE_DIR = os.path.join('.nbsite', 'doctrees')
+
+# Default location of the --profile report, relative to the project root.
+PROFILE_DIR = os.path.join('.nbsite', 'profile')
+
+# Notebook execution report, relative to the project root.
+EXECUTION_REPORT = os.path.join('.nbsite', REPORT_FILENAME)
+
+# Default location of the `nbsite execute` artifacts, relative to the
+# project root.
+EXECUTED_DIR = os.path.join('.nbsite', 'executed')
+
 def init(project_root='', doc='doc', theme=''):
     """
     Start an nbsite project: create a doc folder containing nbsite
@@ -63,10 +54,10 @@ def init(project_root='', doc='doc', theme=''):
     paths = _prepare_paths(project_root, doc=doc)
     if theme:
         copy_files(os.path.join(dirname(__file__), 'templates', theme),
-                   paths['doc'])
+                   paths['doc'], check='exists', link=None)
     else:
         copy_files(os.path.join(dirname(__file__), 'templates', 'basic'),
-                   paths['doc'])
+                   paths['doc'], check='exists', link=None)
 
 hosts = {
     # no trailing slash
@@ -89,71 +80,221 @@ def build(what='html',
           examples_assets='assets',
           clean_dry_run=False,
           inspect_links=False,
-          overwrite=False):
+          overwrite=False,
+          doctree_dir=None,
+          fresh=False,
+          profile=False,
+          max_memory=None,
+          max_notebook_time=None,
+          max_cell_time=None,
+          executed=None):
     """
     Build the site from the rst files and the notebooks
 
     Usually this is run after `nbsite scaffold`
+
+    The settings of the build are passed to Sphinx as config values,
+    not through the environment of the process, so that several builds
+    (e.g. of different targets or versions) can run concurrently in
+    threads of the same process, sharing the executed notebook cache
+    and the kernel pools. The profile and the scheduling of the parallel
+    workers (see max_memory) are those of the thread running the build.
+
+    The Sphinx environment and doctrees are kept between runs in
+    doctree_dir (defaults to .nbsite/doctrees in the project root) so
+    that only the changed documents are rebuilt; use fresh to force a
+    full rebuild.
+
+    With profile, the time spent in each phase of the build (gallery
+    generation, notebook execution and rendering, Sphinx read and write,
+    post-processing) is written as a JSON report and a Chrome trace to
+    the profile directory (.nbsite/profile in the project root if profile
+    is True).
+
+    max_memory (e.g. '16G') caps the memory used by the parallel Sphinx
+    workers, fewer workers being run when it would be exceeded (requires
+    psutil). The chunk of documents of a worker that died is resubmitted
+    to a fresh worker.
+
+    The execution time, kernel memory and output size of the notebooks
+    and their cells are reported in .nbsite/execution.json, the build
+    failing if a notebook or a cell took longer to execute than
+    max_notebook_time or max_cell_time seconds.
+
+    executed is a directory of notebooks executed with `nbsite execute`,
+    the artifacts of all the shards being merged into it, installed in
+    the doc tree before the build.
     """
-    env = {
-        'PROJECT_NAME':project_name,
-        'PROJECT_ROOT':project_root if project_root!='' else os.getcwd(),
-        'HOST':host,
-        'REPO':repo,
-        'BRANCH':branch,
-        'ORG':org,
-        'EXAMPLES':examples,
-        'DOC':doc,
-        'EXAMPLES_ASSETS':examples_assets,
-        'BINDER':binder
+    # Passed to the notebook directive as nbbuild_<name> config values.
+    context = {
+        'project_name':project_name,
+        'project_root':project_root if project_root!='' else os.getcwd(),
+        'host':host,
+        'repo':repo,
+        'branch':branch,
+        'org':org,
+        'examples':examples,
+        'doc':doc,
+        'examples_assets':examples_assets,
+        'binder':binder
     }
-    none_vals = {k:v for k,v in env.items() if v is None}
+    none_vals = {k:v for k,v in context.items() if v is None}
     if none_vals:
         raise Exception("Missing value for %s" % list(none_vals.keys()))
 
     paths = _prepare_paths(project_root, examples=examples, doc=doc, examples_assets=examples_assets)
-    if overwrite:
-        for path in glob.glob(os.path.join(paths['doc'], '**', '*.ipynb'), recursive=True):
-            print('Removing evaluated notebook from {}'.format(path))
-            os.remove(path)
-
-    parallel = 0 if disable_parallel else os.cpu_count()
-    # Code smell as there should be a way to configure Sphinx/Nbsite without
-    # env vars, but that's how it was done at the time Sphinx was called
-    # via subprocess.
-    _environ = dict(os.environ)
-    os.environ.update(env)
-    try:
+    if doctree_dir is None:
+        doctree_dir = os.path.join(paths['project'], DOCTREE_DIR)
+    profile_dir = None
+    if profile:
+        profile_dir = profile if isinstance(profile, str) else os.path.join(paths['project'], PROFILE_DIR)
+    with profiled(profile_dir):
+        if overwrite:
+            for path in glob.glob(os.path.join(paths['doc'], '**', '*.ipynb'), recursive=True):
+                print('Removing evaluated notebook from {}'.format(path))
+                os.remove(path)
+
+        if executed:
+            installed = install_artifacts(executed, paths['doc'])
+            print('Installed {} executed notebook files from {}'.format(len(installed), executed))
+
+        parallel = 0 if disable_parallel else os.cpu_count()
+        # Includes the gallery generation, run when the builder is inited.
+        with span('sphinx.init'):
+            app = Sphinx(
+                srcdir=paths["doc"],
+                confdir=paths["doc"],
+                outdir=output,
+                doctreedir=doctree_dir,
+                buildername=what,
+                parallel=parallel,
+                freshenv=fresh,
+                confoverrides={f'nbbuild_{k}': v for k, v in context.items()},
+            )
+        profile_builder(app.builder)
+        with memory_aware_parallel(max_memory) as recovery_events:
+            app.build(force_all=fresh)
+
+        if recovery_events:
+            print('Recovered from {} parallel worker failures:'.format(len(recovery_events)))
+            for event in recovery_events:
+                print('  worker {reason} (exit code {exitcode}) processing {arg!r}'.format(**event))
+
+        execution_records = execution_stats(app.env)
+        if execution_records:
+            report_path = os.path.join(paths['project'], EXECUTION_REPORT)
+            print_report(write_report(execution_records, report_path), report_path)
+        too_slow = check_thresholds(execution_records, max_notebook_time, max_cell_time)
+        if too_slow:
+            raise Exception("Notebook execution exceeded the time limits:\n  %s" % "\n  ".join(too_slow))
+
+        with span('copy_files'):
+            print('Copying json blobs (used for holomaps) from {} to {}'.format(paths['doc'], output))
+            copy_files(paths['doc'], output, ['**/*.json', 'json_*'])
+            if 'examples_assets' in paths:
+                build_assets = os.path.join(output, examples_assets)
+                print("Copying examples assets from %s to %s"%(paths['examples_assets'],build_assets))
+                # Assets may be large data files, hardlinked when possible.
+                copy_files(paths['examples_assets'], build_assets, link='hardlink')
+
+        # create a .nojekyll file in output for github compatibility
+        with open(os.path.join(output, '.nojekyll'), 'w') as f:
+            f.write('')
+
+        if not clean_dry_run:
+            print("Call `nbsite build` with `--clean-dry-run` to not actually delete files.")
+
+        # Fix the links and remove the Sphinx leftovers in a single walk.
+        with span('postprocess_html'):
+            postprocess_html(output, clean=True, dry_run=clean_dry_run, inspect_links=inspect_links)
+
+def execute(shard='1/1',
+            output=None,
+            what='html',
+            project_root='',
+            doc='doc',
+            examples='examples',
+            examples_assets='assets'):
+    """
+    Execute a shard of the notebooks of the site
+
+    shard 'i/N' selects the i-th of N shards of the notebooks embedded in
+    the doc tree and the galleries, the partition being the same on every
+    machine. The evaluated notebooks and their side files are written to
+    output (defaults to .nbsite/executed in the project root), mirroring
+    the doc tree, along with a manifest of the shard. Executed again into
+    the same output, only the notebooks changed since (their code cells
+    or the data files they read) are executed.
+
+    The outputs of all the shards are merged by copying them into the
+    same directory, then passed to `nbsite build --executed`.
+    """
+    # nbbuild imports this module.
+    from .nbbuild import (
+        find_notebook_jobs, is_evaluated, notebook_job_key,
+        notebook_side_files, read_evaluated_notebook, run_notebook_jobs,
+    )
+
+    index, count = parse_shard(shard)
+    paths = _prepare_paths(project_root, examples=examples, doc=doc, examples_assets=examples_assets)
+    if output is None:
+        output = os.path.join(paths['project'], EXECUTED_DIR)
+    context = {
+        'project_root': paths['project'],
+        'examples': examples,
+        'doc': doc,
+        'examples_assets': examples_assets,
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        # The galleries are generated when the builder is inited, the
+        # documents being listed without being read.
         app = Sphinx(
             srcdir=paths["doc"],
             confdir=paths["doc"],
-            outdir=output,
-            doctreedir=os.path.join(output, ".doctrees"),
+            outdir=os.path.join(tmp, 'out'),
+            doctreedir=os.path.join(tmp, 'doctrees'),
             buildername=what,
-            parallel=parallel,
+            freshenv=True,
+            confoverrides={f'nbbuild_{k}': v for k, v in context.items()},
         )
-        app.build()
-    finally:
-        os.environ.clear()
-        os.environ.update(_environ)
-
-    print('Copying json blobs (used for holomaps) from {} to {}'.format(paths['doc'], output))
-    copy_files(paths['doc'], output, '**/*.json')
-    copy_files(paths['doc'], output, 'json_*')
-    if 'examples_assets' in paths:
-        build_assets = os.path.join(output, examples_assets)
-        print("Copying examples assets from %s to %s"%(paths['examples_assets'],build_assets))
-        copy_files(paths['examples_assets'], build_assets)
-    fix_links(output, inspect_links)
-
-    # create a .nojekyll file in output for github compatibility
-    with open(os.path.join(output, '.nojekyll'), 'w') as f:
-        f.write('')
-
-    if not clean_dry_run:
-        print("Call `nbsite build` with `--clean-dry-run` to not actually delete files.")
-
-    clean_dist_html(output, clean_dry_run)
+        app.env.find_files(app.config, app.builder)
+        previous = read_manifest(output, index, count)
+        notebooks, jobs = {}, []
+        for nb_abs_path, dest_path, skip_exceptions in find_notebook_jobs(app.env, sorted(app.env.found_docs)):
+            relpath = os.path.relpath(dest_path, paths['doc']).replace(os.sep, '/')
+            if shard_of(relpath, count) != index:
+                continue
+            artifact_path = os.path.join(output, *relpath.split('/'))
+            key = notebook_job_key(nb_abs_path, skip_exceptions, app.config)
+            entry = previous.get(relpath)
+            if entry is not None and entry['key'] == key and is_evaluated(nb_abs_path, artifact_path):
+                notebooks[relpath] = entry
+                continue
+            # Outdated artifacts, e.g. of a notebook edited since.
+            for path in [relpath, *(entry['files'] if entry else [])]:
+                if os.path.isfile(os.path.join(output, *path.split('/'))):
+                    os.remove(os.path.join(output, *path.split('/')))
+            notebooks[relpath] = {'key': key}
+            os.makedirs(os.path.dirname(artifact_path), exist_ok=True)
+            jobs.append((nb_abs_path, artifact_path, skip_exceptions))
+
+        print('Executing {} of the {} notebooks of shard {}/{} into {}'.format(
+            len(jobs), len(notebooks), index, count, output))
+        if jobs:
+            run_notebook_jobs(jobs, app.config)
+
+    failed = [relpath for relpath in notebooks if not os.path.isfile(os.path.join(output, *relpath.split('/')))]
+    if failed:
+        raise Exception("Failed to execute the notebooks:\n  %s" % "\n  ".join(failed))
+    for relpath, entry in notebooks.items():
+        if 'files' not in entry:
+            notebook = read_evaluated_notebook(os.path.join(output, *relpath.split('/')))
+            directory = relpath.rpartition('/')[0]
+            entry['files'] = [relpath] + [
+                '/'.join(filter(None, [directory, name])) for name in notebook_side_files(notebook)
+            ]
+    write_manifest(output, index, count, notebooks)
+
 
 def _prepare_paths(root,examples='',doc='',examples_assets=''):
     if root=='':
@@ -0,0 +1,187 @@
+"""
+Tracking of the data files read by the notebooks.
+
+When a notebook is executed, an audit hook installed in the kernel (see
+``tracker_code``) records the files opened for reading, e.g. the CSV
+files loaded with pandas, and the files opened for writing, which are
+side files of the notebook (see ``written_files``). The
+files read, and not written, are stored with a hash of their
+content in the ``nbsite`` metadata of the evaluated notebook, relative
+to the directory of the notebook, and travel with it (including through
+the notebook cache and the ``nbsite execute`` artifacts).
+
+They are used to find out that an evaluated notebook, or a cached one,
+is outdated (see ``changed_dependencies``) and are recorded as Sphinx
+dependencies of the documents embedding the notebook. The files of the
+environment of the kernel (e.g. the installed packages), logged by the
+tracker too, are not data files.
+
+Only the files opened through Python are seen, not those opened by
+compiled libraries directly (e.g. pyarrow).
+"""
+from __future__ import annotations
+
+import hashlib
+import os
+import site
+import sys
+
+# Key of the dependencies in the nbsite metadata of the notebook.
+METADATA_KEY = 'nbsite'
+
+# Installed in the kernel after the startup code, logging the prefixes
+# of the environment of the kernel (x) then appending the path of every
+# file opened for reading (r) or writing (w) to the log file, once.
+TRACKER_CODE = '''\
+def __nbsite_track_files(log_path):
+    import os, site, sys
+    seen = set()
+    log = open(log_path, 'a', encoding='utf-8', buffering=1)
+    prefixes = set((sys.prefix, sys.base_prefix, sys.exec_prefix, sys.base_exec_prefix))
+    try:
+        prefixes.update(getattr(site, 'getsitepackages', list)())
+        prefixes.add(site.getusersitepackages())
+    except Exception:
+        pass
+    for prefix in prefixes:
+        if prefix:
+            log.write('x ' + prefix + '\\n')
+    write_flags = os.O_WRONLY | os.O_RDWR | os.O_APPEND | os.O_CREAT
+
+    def hook(event, args):
+        if event != 'open':
+            return
+        try:
+            path, mode, flags = args
+            if isinstance(path, int):
+                return
+            written = bool(mode.strip('rbtU')) if mode else bool(flags & write_flags)
+            entry = ('w ' if written else 'r ') + os.path.abspath(os.fsdecode(path))
+            if entry not in seen:
+                seen.add(entry)
+                log.write(entry + '\\n')
+        except Exception:
+            pass
+
+    sys.addaudithook(hook)
+__nbsite_track_files({log_path!r})
+del __nbsite_track_files
+'''
+
+
+def tracker_code(log_path) -> str:
+    """Code installing the audit hook logging the files opened to log_path."""
+    return TRACKER_CODE.format(log_path=os.fspath(log_path))
+
+
+def _read_log(log_path):
+    # The paths logged per kind (see TRACKER_CODE), in the order they
+    # were opened.
+    entries = {'r': [], 'w': [], 'x': []}
+    try:
+        with open(log_path, encoding='utf-8') as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return entries
+    for line in lines:
+        kind, _, path = line.partition(' ')
+        if kind in entries:
+            entries[kind].append(path)
+    return entries
+
+
+def written_files(log_path) -> list[str]:
+    """Return the files opened for writing logged by the tracker.
+
+    The files written by compiled libraries directly or by subprocesses
+    are not seen.
+    """
+    return list(dict.fromkeys(_read_log(log_path)['w']))
+
+
+def _excluded_prefixes(kernel_prefixes=()):
+    # The installed packages and the configuration and cache files of
+    # the kernel and the libraries, those of this process when the
+    # prefixes of the kernel were not logged.
+    prefixes = set(kernel_prefixes)
+    if not prefixes:
+        prefixes = {sys.prefix, sys.base_prefix, sys.exec_prefix, sys.base_exec_prefix}
+        prefixes.update(getattr(site, 'getsitepackages', list)())
+        prefixes.add(site.getusersitepackages())
+    prefixes.update(('/proc', '/dev', '/sys'))
+    return tuple(os.path.join(prefix, '') for prefix in prefixes if prefix)
+
+
+def _is_data_file(path, excluded) -> bool:
+    if path.startswith(excluded) or path.endswith('.pyc'):
+        return False
+    home = os.path.expanduser('~')
+    if path.startswith(os.path.join(home, '.')):
+        return False
+    return os.path.isfile(path)
+
+
+def file_hash(path) -> str:
+    """Return the SHA-256 hash of the content of a file."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def collect_dependencies(log_path, nb_dir, since=None) -> dict[str, str]:
+    """Return the data files logged by the tracker with their hash.
+
+    The files written by the notebook are its outputs, not data files.
+    The files modified after the since timestamp, i.e. while the notebook
+    was executed, are recorded without hash: the content the notebook
+    read is unknown. The paths are relative to nb_dir, the directory of
+    the notebook.
+    """
+    entries = _read_log(log_path)
+    excluded = _excluded_prefixes(entries['x'])
+    written = set(entries['w'])
+    written.add(os.path.abspath(log_path))
+    dependencies = {}
+    for path in dict.fromkeys(entries['r']):
+        if path in written or not _is_data_file(path, excluded):
+            continue
+        relpath = os.path.relpath(path, nb_dir).replace(os.sep, '/')
+        modified = since is not None and os.path.getmtime(path) > since
+        dependencies[relpath] = '' if modified else file_hash(path)
+    return dependencies
+
+
+def record_dependencies(notebook, dependencies):
+    """Record the data files read by a notebook in its metadata."""
+    notebook.metadata.setdefault(METADATA_KEY, {})['dependencies'] = dependencies
+
+
+def notebook_dependencies(notebook, nb_dir) -> list[str]:
+    """Return the absolute paths of the data files read by an evaluated notebook."""
+    dependencies = notebook.metadata.get(METADATA_KEY, {}).get('dependencies', {})
+    return [os.path.normpath(os.path.join(nb_dir, relpath)) for relpath in dependencies]
+
+
+def changed_dependencies(notebook, nb_dir, since=None) -> list[str]:
+    """Return the data files read by an evaluated notebook that changed since.
+
+    The files not modified after the since timestamp (e.g. the start of
+    the execution of the notebook) are assumed to be unchanged, the
+    content of the others being compared to the hash recorded when the
+    notebook was executed.
+    """
+    dependencies = notebook.metadata.get(METADATA_KEY, {}).get('dependencies', {})
+    changed = []
+    for relpath, digest in dependencies.items():
+        path = os.path.join(nb_dir, relpath)
+        try:
+            if since is not None and os.path.getmtime(path) <= since:
+                continue
+            if file_hash(path) == digest:
+                continue
+        except OSError:
+            pass
+        changed.append(relpath)
+    return changed
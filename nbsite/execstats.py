@@ -0,0 +1,200 @@
+"""
+Execution statistics of the notebooks and the slow notebook report.
+
+When a notebook is executed, the wall time, the peak memory of the
+kernel and the size of the outputs of each code cell are recorded in
+the ``nbsite`` metadata of the cell, and the total execution time in the
+``nbsite`` metadata of the notebook. The statistics travel with the
+evaluated notebook (including through the notebook cache) and are
+collected by the notebook directive into the Sphinx environment, from
+which ``nbsite build`` writes a report of the slowest notebooks and
+cells, optionally failing the build when thresholds are exceeded.
+
+The statistics of the notebooks executed before the build, e.g. restored
+from the notebook cache, are marked as cached in the report and not
+checked against the thresholds.
+"""
+from __future__ import annotations
+
+import json
+import os
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Key of the statistics in the notebook and cell metadata.
+METADATA_KEY = 'nbsite'
+
+REPORT_FILENAME = 'execution.json'
+
+
+def kernel_peak_memory(pid) -> int | None:
+    """Peak resident memory of the kernel process in bytes, if available."""
+    if pid is None:
+        return None
+    try:
+        # The high water mark of the resident memory (Linux only).
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    if psutil is not None:
+        try:
+            return psutil.Process(pid).memory_info().rss
+        except psutil.Error:
+            pass
+    return None
+
+
+def output_size(outputs) -> int:
+    """Approximate size of the outputs of a cell in bytes."""
+    size = 0
+    for output in outputs:
+        for key in ('text', 'traceback'):
+            if key in output:
+                value = output[key]
+                size += sum(map(len, value)) if isinstance(value, list) else len(value)
+        for value in output.get('data', {}).values():
+            size += len(value) if isinstance(value, str) else len(json.dumps(value))
+    return size
+
+
+def record_cell(cell, duration, peak_memory=None):
+    """Record the execution statistics of a code cell in its metadata."""
+    cell.metadata.setdefault(METADATA_KEY, {})['execution'] = {
+        'duration': duration,
+        'peak_memory': peak_memory,
+        'output_size': output_size(cell.get('outputs', [])),
+    }
+
+
+def record_notebook(notebook, duration, started=None):
+    """Record the total execution time of a notebook in its metadata.
+
+    started is the time the execution started at, in seconds since the
+    epoch.
+    """
+    notebook.metadata.setdefault(METADATA_KEY, {})['execution'] = {
+        'duration': duration, 'started': started,
+    }
+
+
+def execution_started(notebook) -> float | None:
+    """Return the time the execution of an evaluated notebook started at, if recorded."""
+    return notebook.metadata.get(METADATA_KEY, {}).get('execution', {}).get('started')
+
+
+def notebook_stats(notebook, path):
+    """Return the execution statistics recorded in an evaluated notebook.
+
+    Returns None if the notebook was not executed by nbsite.
+    """
+    execution = notebook.metadata.get(METADATA_KEY, {}).get('execution')
+    if execution is None:
+        return None
+    cells = []
+    for index, cell in enumerate(notebook.cells):
+        stats = cell.metadata.get(METADATA_KEY, {}).get('execution')
+        if cell.cell_type != 'code' or stats is None:
+            continue
+        lines = cell.source.strip().splitlines()
+        cells.append(dict(stats, index=index, source=lines[0] if lines else ''))
+    peak_memories = [c['peak_memory'] for c in cells if c['peak_memory'] is not None]
+    return {
+        'notebook': path,
+        'started': execution.get('started'),
+        'duration': execution['duration'],
+        'peak_memory': max(peak_memories, default=None),
+        'output_size': sum(c['output_size'] for c in cells),
+        'cells': cells,
+    }
+
+
+def execution_stats(env):
+    """Return the statistics of the notebooks collected in a Sphinx environment.
+
+    The notebooks executed before the build started (see
+    nbsite_build_started) are marked as cached.
+    """
+    stats = {}
+    for notebooks in getattr(env, 'nbsite_execution_stats', {}).values():
+        stats.update(notebooks)
+    build_started = getattr(env, 'nbsite_build_started', None)
+    return [
+        dict(record, cached=build_started is not None and (
+            record.get('started') is None or record['started'] < build_started
+        ))
+        for record in stats.values()
+    ]
+
+
+def check_thresholds(records, max_notebook_time=None, max_cell_time=None):
+    """Return the messages describing the notebooks and cells too slow.
+
+    The cached statistics, not measured during the build, are ignored.
+    """
+    failures = []
+    for record in records:
+        if record.get('cached'):
+            continue
+        if max_notebook_time is not None and record['duration'] > max_notebook_time:
+            failures.append('{notebook} took {duration:.1f}s to execute (limit {limit}s)'.format(
+                limit=max_notebook_time, **record))
+        if max_cell_time is None:
+            continue
+        for cell in record['cells']:
+            if cell['duration'] > max_cell_time:
+                failures.append('{notebook} cell {index} ({source}) took {duration:.1f}s to execute (limit {limit}s)'.format(
+                    notebook=record['notebook'], limit=max_cell_time, **cell))
+    return failures
+
+
+def write_report(records, report_path):
+    """Write the notebooks and cells sorted by execution time to a JSON report."""
+    notebooks = sorted(records, key=lambda r: r['duration'], reverse=True)
+    cells = [
+        dict(cell, notebook=record['notebook'], cached=record.get('cached', False))
+        for record in records for cell in record['cells']
+    ]
+    report = {
+        'notebooks': [{k: v for k, v in r.items() if k != 'cells'} for r in notebooks],
+        'cells': sorted(cells, key=lambda c: c['duration'], reverse=True),
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(report_path)), exist_ok=True)
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=1)
+    return report
+
+
+def _format_size(size):
+    return '-' if size is None else f'{size / 1024**2:.1f}MiB'
+
+
+def _cached(record):
+    return '  (cached)' if record.get('cached') else ''
+
+
+def print_report(report, report_path, limit=10):
+    """Print the slowest notebooks and cells of a report."""
+    if not report['notebooks']:
+        return
+    total = sum(r['duration'] for r in report['notebooks'])
+    cached = sum(bool(r.get('cached')) for r in report['notebooks'])
+    print('Notebook execution report ({} notebooks, {:.1f}s{}) written to {}'.format(
+        len(report['notebooks']), total,
+        f', {cached} cached from previous executions' if cached else '', report_path))
+    print('  Slowest notebooks:')
+    for record in report['notebooks'][:limit]:
+        print('  {:9.2f}s  {:>10}  {:>10}  {}{}'.format(
+            record['duration'], _format_size(record['peak_memory']),
+            _format_size(record['output_size']), record['notebook'], _cached(record)))
+    print('  Slowest cells:')
+    for cell in report['cells'][:limit]:
+        print('  {:9.2f}s  {:>10}  {:>10}  {}[{}]  {}{}'.format(
+            cell['duration'], _format_size(cell['peak_memory']),
+            _format_size(cell['output_size']), cell['notebook'], cell['index'],
+            cell['source'][:60], _cached(cell)))
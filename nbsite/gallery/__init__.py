@@ -1,5 +1,6 @@
 from .. import __version__ as nbs_version
 from .gen import DEFAULT_GALLERY_CONF, generate_gallery_rst
+from .images import add_thumbnail_sources
 
 
 def setup(app):
@@ -7,6 +8,7 @@ def setup(app):
     app.add_config_value('nbsite_gallery_conf', DEFAULT_GALLERY_CONF, 'html')
 
     app.connect('builder-inited', generate_gallery_rst)
+    app.connect('doctree-resolved', add_thumbnail_sources)
     metadata = {'parallel_read_safe': True,
                 'version': nbs_version}
     return metadata
@@ -0,0 +1,204 @@
+"""
+HTTP client of the gallery, e.g. to download the thumbnails.
+
+A single ``requests`` session is shared by the gallery, with at most
+``download_concurrency`` requests in flight and a ``download_timeout``
+on each of them. A host that cannot be reached (connection error or
+timeout) is not contacted again during the build.
+
+The downloads are kept in an on-disk cache outside of the doc tree
+(see ``download_cache_dir``), revalidated with the ``ETag`` and
+``Last-Modified`` headers the server sent them with, so that an
+unchanged file is not downloaded again. In offline mode (the
+``offline`` gallery option or the ``NBSITE_OFFLINE`` environment
+variable), the network is never used, only the downloads in the cache.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+from urllib.parse import urlparse
+
+import requests
+import sphinx.util.logging
+
+from requests.adapters import HTTPAdapter
+
+logger = sphinx.util.logging.getLogger('nbsite-gallery')
+
+# (connect, read) timeouts in seconds.
+DEFAULT_TIMEOUT = (5, 30)
+
+DEFAULT_CONCURRENCY = 8
+
+OFFLINE_ENVVAR = 'NBSITE_OFFLINE'
+
+
+def default_cache_dir() -> str:
+    """Return the default location of the download cache.
+
+    ``XDG_CACHE_HOME`` takes precedence over ``~/.cache``.
+    """
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'nbsite', 'downloads')
+
+
+def _offline_from_env() -> bool:
+    return os.environ.get(OFFLINE_ENVVAR, '').lower() not in ('', '0', 'false', 'no')
+
+
+class DownloadClient:
+    """
+    Connection-pooled HTTP client with an on-disk, revalidated cache.
+
+    Parameters
+    ----------
+    cache_dir: str | None
+        Directory of the download cache, None disabling the cache.
+    offline: bool
+        Whether to only use the cache, never the network.
+    timeout: float | tuple[float, float]
+        Timeout of the requests in seconds, see requests.
+    concurrency: int
+        Maximum number of requests in flight.
+    """
+
+    def __init__(self, cache_dir=None, offline=False, timeout=DEFAULT_TIMEOUT,
+                 concurrency=DEFAULT_CONCURRENCY):
+        self.cache_dir = cache_dir
+        self.offline = offline
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._semaphore = threading.BoundedSemaphore(concurrency)
+        self._lock = threading.Lock()
+        self._unreachable = set()
+
+    def reset(self):
+        """Forget the hosts that could not be reached, e.g. for a new build."""
+        with self._lock:
+            self._unreachable.clear()
+
+    def _reachable(self, url) -> bool:
+        with self._lock:
+            return urlparse(url).netloc not in self._unreachable
+
+    def request(self, url, **kwargs) -> requests.Response | None:
+        """GET url, without caching.
+
+        Returns None in offline mode or when the host cannot be reached.
+        """
+        if self.offline or not self._reachable(url):
+            return None
+        kwargs.setdefault('timeout', self.timeout)
+        try:
+            with self._semaphore:
+                return self.session.get(url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            host = urlparse(url).netloc
+            with self._lock:
+                known = host in self._unreachable
+                self._unreachable.add(host)
+            if not known:
+                logger.warning('Could not reach %s, not downloading from it again during the build: %s', host, e)
+            return None
+
+    def _entry_paths(self, url):
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        entry = os.path.join(self.cache_dir, key[:2], key)
+        return entry + '.json', entry + '.body'
+
+    def _load(self, url):
+        meta_path, body_path = self._entry_paths(url)
+        try:
+            with open(meta_path, encoding='utf-8') as f:
+                meta = json.load(f)
+            with open(body_path, 'rb') as f:
+                return meta, f.read()
+        except (OSError, ValueError):
+            return None, None
+
+    def _store(self, url, response):
+        meta_path, body_path = self._entry_paths(url)
+        meta = {
+            'url': url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+        }
+        os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+        # The body first, the metadata marking the entry as complete.
+        for path, data in ((body_path, response.content), (meta_path, json.dumps(meta).encode('utf-8'))):
+            fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(path))
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp, path)
+            except BaseException:
+                os.remove(tmp)
+                raise
+
+    def _discard(self, url):
+        for path in self._entry_paths(url):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def fetch(self, url) -> bytes | None:
+        """Return the content at url, None if it cannot be found.
+
+        A cached download is revalidated with the server, and used as is
+        in offline mode or when the server cannot be reached.
+        """
+        meta, content = self._load(url) if self.cache_dir is not None else (None, None)
+        headers = {}
+        if meta is not None:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        response = self.request(url, headers=headers)
+        if response is None:
+            return content
+        if response.status_code == 304 and content is not None:
+            return content
+        if response.ok:
+            if self.cache_dir is not None:
+                self._store(url, response)
+            return response.content
+        if response.status_code in (404, 410):
+            if meta is not None:
+                self._discard(url)
+            return None
+        # Server errors, keeping the cached download.
+        return content
+
+
+_clients = {}
+
+def get_client(gallery_conf=None) -> DownloadClient:
+    """Return the DownloadClient configured by the gallery options.
+
+    The clients are shared, to reuse their connections.
+    """
+    gallery_conf = gallery_conf or {}
+    cache_dir = gallery_conf.get('download_cache_dir', '')
+    if cache_dir == '':
+        cache_dir = default_cache_dir()
+    timeout = gallery_conf.get('download_timeout', DEFAULT_TIMEOUT)
+    if isinstance(timeout, list):
+        timeout = tuple(timeout)
+    key = (
+        cache_dir, bool(gallery_conf.get('offline', False) or _offline_from_env()),
+        timeout, gallery_conf.get('download_concurrency', DEFAULT_CONCURRENCY),
+    )
+    if key not in _clients:
+        _clients[key] = DownloadClient(*key)
+    return _clients[key]
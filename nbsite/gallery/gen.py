@@ -5,6 +5,8 @@ import os
 import pathlib
 import re
 import shutil
+import subprocess
+import tempfile
 
 from concurrent.futures import ThreadPoolExecutor
 from functools import partial
@@ -14,14 +16,18 @@ import nbformat
 import requests
 import sphinx.util.logging
 
-from PIL import Image
-
 try:
     import bs4
 except ImportError:
     bs4 = None
 
-from .thumbnailer import execute, notebook_thumbnail
+from ..profiling import bind, span
+from .downloads import DEFAULT_CONCURRENCY, DEFAULT_TIMEOUT, get_client
+from .images import prepare_thumbnails, resize_pad  # noqa: F401
+from .manifest import ThumbnailManifest, thumbnail_key
+from .thumbnailer import (
+    execute, notebook_thumbnail, output_thumbnail, thumbnail_hook_code,
+)
 
 logger = sphinx.util.logging.getLogger('nbsite-gallery')
 logging.getLogger(requests.packages.urllib3.__package__).setLevel(logging.ERROR)
@@ -216,6 +222,15 @@ DEFAULT_GALLERY_CONF = {
     'skip_execute': [],
     'thumbnail_url': THUMBNAIL_URL,
     'thumbnail_size': (400, 280),
+    'thumbnail_workers': None,  # defaults to the number of CPUs
+    'thumbnail_timeout': 600,  # in seconds, per notebook
+    'thumbnail_from_outputs': False,
+    'thumbnail_formats': (),  # e.g. ('webp', 'avif')
+    'thumbnail_widths': (250, 500),
+    'offline': False,  # or set the NBSITE_OFFLINE environment variable
+    'download_timeout': DEFAULT_TIMEOUT,  # (connect, read) in seconds
+    'download_concurrency': DEFAULT_CONCURRENCY,
+    'download_cache_dir': '',  # defaults to ~/.cache/nbsite/downloads, None to disable
     'within_subsection_order': None,
     'nblink': 'both',  # use this to control the position of the nblink
     'github_ref': 'main',  # branch or tag
@@ -224,7 +239,8 @@ DEFAULT_GALLERY_CONF = {
     'grid_no_columns': (2, 2, 4, 5),
 }
 
-def get_deployed_url(deployment_urls, basename):
+def get_deployed_url(deployment_urls, basename, client=None):
+    client = client or get_client()
     for deployment_url in deployment_urls:
         # Test the deployment_url/basename, then deployment_url/notebooks/basename.ipynb
         candidates = [os.path.join(deployment_url,
@@ -233,14 +249,14 @@ def get_deployed_url(deployment_urls, basename):
                                    basename if basename.endswith('ipynb')
                                    else '%s.ipynb' % basename )]
         for candidate in candidates:
-            r = requests.get(candidate, verify=False)
-            if r.status_code == 200:
+            r = client.request(candidate)
+            if r is not None and r.status_code == 200:
                 return candidate
 
     # Check deployment_urls directly
     for deployment_url in deployment_urls:
-        r = requests.get(deployment_url, verify=False)
-        if r.status_code == 200:
+        r = client.request(deployment_url)
+        if r is not None and r.status_code == 200:
             return deployment_url
     return None
 
@@ -496,9 +512,7 @@ def generate_item_rst(
 
         if ftype == 'notebook':
             rst_file.write(".. notebook:: %s %s" % (proj, rel_path))
-            if deployed or (isinstance(skip, bool) and skip) or any(
-                basename.strip().endswith(skipped) for skipped in skip_execute
-            ):
+            if deployed or _skips_execution(basename, skip, skip_execute):
                 rst_file.write('\n    :skip_execute: True\n')
             if deployed:
                 rst_file.write(IFRAME_TEMPLATE.format(
@@ -511,12 +525,18 @@ def generate_item_rst(
         if nblink in ['bottom', 'both']:
             rst_file.write(f'\n\n-------\n\n{nblink_text}')
 
-def get_deployed_examples(endpoint):
+def _skips_execution(basename, skip, skip_execute):
+    return (isinstance(skip, bool) and skip) or any(
+        basename.strip().endswith(skipped) for skipped in skip_execute
+    )
+
+
+def get_deployed_examples(endpoint, client=None):
     # Try to fetch all deployed examples
     if not bs4 or endpoint is None:
         return []
-    r = requests.get(endpoint, verify=False)
-    if r.status_code != 200:
+    r = (client or get_client()).request(endpoint)
+    if r is None or r.status_code != 200:
         return []
 
     soup = bs4.BeautifulSoup(r.content, features='lxml')
@@ -545,7 +565,8 @@ def generate_file_rst(
         gallery_conf.get('skip_rst_notebook_directive', False)
     )
 
-    deployed_examples = get_deployed_examples(endpoint)
+    client = get_client(gallery_conf)
+    deployed_examples = get_deployed_examples(endpoint, client)
 
     files = []
     for extension in extensions:
@@ -559,7 +580,7 @@ def generate_file_rst(
         name = basename[:-(len(extension)+1)]
         deployed = name in deployed_examples
         try:
-            deployed_file = get_deployed_url(deployment_urls, basename)
+            deployed_file = get_deployed_url(deployment_urls, basename, client)
         except Exception:
             deployed_file = None
 
@@ -658,7 +679,7 @@ def _external_thumbnail_div(thumb_path, title, link, description=None):
     )
 
 
-def _resolve_thumbnail(thumb_url_base, dest_dir, basename, download, no_image_thumb):
+def _resolve_thumbnail(thumb_url_base, dest_dir, basename, download, no_image_thumb, client=None):
     """
     Resolve thumbnail by preferring local files, then downloading, then fallback image.
     """
@@ -681,30 +702,16 @@ def _resolve_thumbnail(thumb_url_base, dest_dir, basename, download, no_image_th
         thumb_extension = "gif"
 
     if download and retcode:
-        png_url = f"{thumb_url_base}.png"
-        try:
-            thumb_req = requests.get(png_url)
-        except Exception:
-            thumb_req = requests.get(png_url, verify=False)
-
-        if thumb_req.ok:
-            retcode = 0
-            verb = "Successfully downloaded"
-        else:
-            gif_url = f"{thumb_url_base}.gif"
-            try:
-                thumb_req = requests.get(gif_url)
-            except Exception:
-                thumb_req = requests.get(gif_url, verify=False)
-            if thumb_req.ok:
-                thumb_extension = "gif"
-                thumb_path = gif_thumb_path
+        client = client or get_client()
+        for extension, path in (("png", thumb_path), ("gif", gif_thumb_path)):
+            content = client.fetch(f"{thumb_url_base}.{extension}")
+            if content is not None:
+                thumb_extension, thumb_path = extension, path
                 retcode = 0
                 verb = "Successfully downloaded"
-
-        if not retcode:
-            with open(thumb_path, "wb") as thumb_f:
-                thumb_f.write(thumb_req.content)
+                with open(thumb_path, "wb") as thumb_f:
+                    thumb_f.write(content)
+                break
 
     if retcode and no_image_thumb:
         shutil.copy2(NO_IMAGE_THUMB, thumb_path)
@@ -722,6 +729,7 @@ def _download_external_item_image(
     download,
     dest_dir,
     no_image_thumb,
+    client=None,
 ):
     title = item.get("title", "")
     basename = _slugify_title(title)
@@ -736,27 +744,11 @@ def _download_external_item_image(
         basename=basename,
         download=download,
         no_image_thumb=no_image_thumb,
+        client=client,
     )
     return retcode, thumb_path, thumb_extension
 
 
-def resize_pad(im_pth, desired_size=500):
-    im = Image.open(im_pth)
-    old_size = im.size  # old_size[0] is in (width, height) format
-
-    ratio = float(desired_size)/max(old_size)
-    new_size = tuple([int(x*ratio) for x in old_size])
-    w = (desired_size-new_size[0])//2
-    h = (desired_size-new_size[1])//2
-
-    # LANCZOS replaced ANTIALIAS in PIL 10
-    im_filter = getattr(Image, "LANCZOS", None) or getattr(Image, "ANTIALIAS", None)
-    im = im.resize(new_size, im_filter)
-    new_im = Image.new("RGBA", (desired_size, desired_size), color=(0, 0, 0, 0))
-    new_im.paste(im, (w, h))
-    new_im.save(im_pth)
-
-
 def generate_gallery(app, page):
     """
     Generates a gallery for all example directories specified in
@@ -805,10 +797,25 @@ def generate_gallery(app, page):
     inline = gallery_conf['inline']
     card_title_below = content.get('card_title_below', False)
     no_image_thumb = content.get('no_image_thumb', False)
+    thumbnail_workers = gallery_conf['thumbnail_workers']
+    client = get_client(gallery_conf)
+    thumbnail_timeout = gallery_conf['thumbnail_timeout']
+    thumbnail_from_outputs = gallery_conf['thumbnail_from_outputs']
 
     if sort_fn is None:
         sort_fn = lambda key: titles.get(key, key)
 
+    # Thumbnails are made again when their inputs change
+    manifest = ThumbnailManifest(os.path.join(doc_dir, page))
+    thumbnail_settings = {
+        'thumbnail_size': content.get('thumbnail_size', gallery_conf['thumbnail_size']),
+        'script_prefix': script_prefix,
+        'thumbnail_from_outputs': thumbnail_from_outputs,
+    }
+
+    # Resized once all the thumbnails are found, see prepare_thumbnails
+    thumbnails = []
+
     # Write gallery index
     title = content['title']
     gallery_rst = title + '\n' + '_'*len(title) + '\n'
@@ -926,12 +933,13 @@ def generate_gallery(app, page):
                         download=download,
                         dest_dir=dest_path,
                         no_image_thumb=no_image_thumb,
+                        client=client,
                     )
                     if retcode:
                         thumb = logo_path
                     else:
                         if thumb_extension not in ("svg", "gif"):
-                            resize_pad(os.path.join(doc_dir, thumb_path))
+                            thumbnails.append(os.path.join(doc_dir, thumb_path))
                         thumb = thumb_path
                 this_entry = _external_thumbnail_div(
                     thumb,
@@ -1000,22 +1008,52 @@ def generate_gallery(app, page):
                                 )
 
             sorted_files = sorted(files, key=subsection_order)
-            with ThreadPoolExecutor() as ex:
-                func = partial(_download_image, page, thumbnail_url, download, backend, section, dest_dir, no_image_thumb)
-                futures = ex.map(func, sorted_files)
+            thumb_keys = {}
+            for f in sorted_files:
+                thumb_base = os.path.join(dest_dir, 'thumbnails', pathlib.Path(f).stem)
+                thumb_keys[f] = thumbnail_key(f, thumbnail_settings)
+                if manifest.is_stale(thumb_base, thumb_keys[f]):
+                    logger.info('Inputs of the %s thumbnail changed' % pathlib.Path(f).stem)
+                    for ext in ('png', 'gif'):
+                        if os.path.isfile(f'{thumb_base}.{ext}'):
+                            os.remove(f'{thumb_base}.{ext}')
+            with ThreadPoolExecutor(max_workers=client.concurrency) as ex:
+                func = partial(_download_image, page, thumbnail_url, download, backend, section, dest_dir, no_image_thumb, client)
+                downloads = list(ex.map(bind(func), sorted_files))
+
+            # Generate the thumbnails that could not be found or downloaded
+            to_generate = [] if only_use_existing else [
+                f for f, (_, extension, _, retcode, _) in zip(sorted_files, downloads)
+                if retcode and extension == 'ipynb'
+            ]
+            if thumbnail_from_outputs and to_generate and app.config.nbbuild_cache_dir is None:
+                # The notebooks would be executed again for their page.
+                logger.warning('thumbnail_from_outputs requires the notebook cache '
+                               '(nbbuild_cache_dir), generating the thumbnails of '
+                               '%s from scripts instead', page)
+                thumbnail_from_outputs = False
+            if thumbnail_from_outputs:
+                skipped = [
+                    f for f in to_generate
+                    if _skips_execution(os.path.basename(f), skip, gallery_conf['skip_execute'])
+                ]
+                retcodes = generate_output_thumbnails(
+                    app, to_generate, dest_dir, skipped, workers=thumbnail_workers,
+                    timeout=thumbnail_timeout, gallery=page, section=section, backend=backend,
+                )
+            else:
+                retcodes = generate_thumbnails(
+                    to_generate, dest_dir, script_prefix, workers=thumbnail_workers,
+                    timeout=thumbnail_timeout, gallery=page, section=section, backend=backend,
+                )
+            generated = dict(zip(to_generate, retcodes))
 
-            for f, (thumb_extension, extension, basename, retcode, verb) in zip(sorted_files, futures):
-                # Generate thumbnail
+            for f, (thumb_extension, extension, basename, retcode, verb) in zip(sorted_files, downloads):
                 if not retcode or only_use_existing:
                     pass
                 elif extension == 'ipynb':
                     verb = 'Successfully generated'
-                    print('getting thumbnail code for %s' % os.path.abspath(f))
-                    print('Path exists %s' % os.path.exists(os.path.abspath(f)))
-                    code = notebook_thumbnail(os.path.abspath(f), dest_dir)
-                    code = script_prefix + code
-                    my_env = os.environ.copy()
-                    retcode = execute(code.encode('utf8'), env=my_env, cwd=os.path.split(f)[0])
+                    retcode = generated[f]
                 else:
                     retcode = 1
 
@@ -1055,8 +1093,10 @@ def generate_gallery(app, page):
                     thumb_path = os.path.join(
                         dest_dir, 'thumbnails', f'{basename}.{thumb_extension}'
                     )
+                    if verb != 'Used existing':
+                        manifest.record(os.path.join(dest_dir, 'thumbnails', basename), thumb_keys[f])
                     if thumb_extension not in ('svg', 'gif'):
-                        resize_pad(os.path.join(doc_dir, thumb_path))
+                        thumbnails.append(os.path.join(doc_dir, thumb_path))
                     this_entry = _thumbnail_div(
                         thumb_path, section, backend, basename,
                         normalize, titles.get(basename),
@@ -1070,11 +1110,16 @@ def generate_gallery(app, page):
 
     if backends or section_backends:
         gallery_rst += HIDE_JS.format(backends=repr(backends[1:]))
+    prepare_thumbnails(
+        thumbnails, formats=gallery_conf['thumbnail_formats'],
+        widths=gallery_conf['thumbnail_widths'], workers=thumbnail_workers,
+    )
+    manifest.save()
     with open(os.path.join(doc_dir, page, 'index.rst'), 'w', encoding='utf-8') as f:
         f.write(gallery_rst)
 
 
-def _download_image(page, thumbnail_url, download, backend, section, dest_dir, no_image_thumb, f):
+def _download_image(page, thumbnail_url, download, backend, section, dest_dir, no_image_thumb, client, f):
     extension = f.split('.')[-1]
     basename = os.path.basename(f)[:-(len(extension)+1)]
 
@@ -1086,16 +1131,114 @@ def _download_image(page, thumbnail_url, download, backend, section, dest_dir, n
         url_components.append(backend)
     url_components.append(basename)
     thumb_url_base = '/'.join(url_components).replace('/./', '/')
-    retcode, _, thumb_extension, verb = _resolve_thumbnail(
-        thumb_url_base=thumb_url_base,
-        dest_dir=dest_dir,
-        basename=basename,
-        download=download,
-        no_image_thumb=no_image_thumb,
-    )
+    with span('gallery.thumbnail_fetch', item=f, gallery=page, section=section, backend=backend):
+        retcode, _, thumb_extension, verb = _resolve_thumbnail(
+            thumb_url_base=thumb_url_base,
+            dest_dir=dest_dir,
+            basename=basename,
+            download=download,
+            no_image_thumb=no_image_thumb,
+            client=client,
+        )
     return thumb_extension, extension, basename, retcode, verb
 
 
+def _generate_thumbnail(dest_dir, script_prefix, timeout, span_args, f):
+    print('getting thumbnail code for %s' % os.path.abspath(f))
+    with span('gallery.thumbnail_generate', item=f, **span_args):
+        code = notebook_thumbnail(os.path.abspath(f), dest_dir)
+        code = script_prefix + code
+        my_env = os.environ.copy()
+        try:
+            return execute(code.encode('utf8'), env=my_env, cwd=os.path.split(f)[0], timeout=timeout)
+        except subprocess.TimeoutExpired:
+            logger.warning('Thumbnail generation of %s timed out after %ss', f, timeout)
+            return 1
+
+
+def generate_thumbnails(files, dest_dir, script_prefix, workers=None, timeout=None, **span_args):
+    """
+    Generate the thumbnails of notebooks into dest_dir/thumbnails.
+
+    Each notebook is executed in its own Python subprocess, at most
+    workers (defaults to the number of CPUs) at the same time, and is
+    killed if it runs longer than timeout seconds. Returns the return
+    codes of the subprocesses in the order of files.
+    """
+    if not files:
+        return []
+    workers = min(workers or os.cpu_count() or 1, len(files))
+    func = partial(_generate_thumbnail, dest_dir, script_prefix, timeout, span_args)
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        return list(ex.map(bind(func), files))
+
+
+def generate_output_thumbnails(app, files, dest_dir, skipped=(), workers=None, timeout=None,
+                               **span_args):
+    """
+    Generate the thumbnails of notebooks from their evaluated outputs.
+
+    The first holoviews or panel object a notebook displays is saved as
+    its thumbnail while it is evaluated, failing that the last image/png
+    output is used. The evaluated notebooks are handed over to the
+    notebook directive of their page through the notebook cache, so that
+    they are executed only once (they cannot be written next to their
+    page, Sphinx would find them as documents of their own). The
+    notebooks already evaluated for their page are not executed again,
+    nor are the notebooks in skipped, whose stored outputs are used.
+    At most workers notebooks (defaults to the number of CPUs) are
+    executed at the same time, each for at most timeout seconds.
+    Returns 0 for the notebooks given a thumbnail and 1 for the others,
+    in the order of files.
+    """
+    from ..nbbuild import execute_notebooks, execution_options, is_evaluated
+
+    config = app.config
+    thumb_dir = os.path.join(dest_dir, 'thumbnails')
+    os.makedirs(thumb_dir, exist_ok=True)
+    basenames = [os.path.splitext(os.path.basename(f))[0] for f in files]
+    with tempfile.TemporaryDirectory(prefix='nbsite-thumbnails-') as tmp_dir:
+        evaluated, jobs = {}, []
+        for f, basename in zip(files, basenames):
+            dest_path = os.path.join(dest_dir, os.path.basename(f))
+            if f in skipped:
+                evaluated[f] = f
+            elif is_evaluated(f, dest_path):
+                evaluated[f] = dest_path
+            else:
+                # In a directory of its own, for its side files.
+                job_dir = os.path.join(tmp_dir, str(len(jobs)))
+                os.makedirs(job_dir)
+                evaluated[f] = os.path.join(job_dir, os.path.basename(f))
+                jobs.append((os.path.abspath(f), evaluated[f], False, {
+                    'setup_code': thumbnail_hook_code(os.path.join(thumb_dir, basename)),
+                    'notebook_timeout': timeout,
+                }))
+        if jobs:
+            with span('gallery.thumbnail_generate', **span_args):
+                execute_notebooks(jobs, workers or os.cpu_count(), **execution_options(config))
+
+        retcodes = []
+        for f, basename in zip(files, basenames):
+            thumb_path = os.path.join(thumb_dir, f'{basename}.png')
+            if os.path.isfile(thumb_path):
+                retcodes.append(0)
+                continue
+            if not os.path.isfile(evaluated[f]):
+                # Its execution failed, reported by execute_notebooks.
+                retcodes.append(1)
+                continue
+            try:
+                with open(evaluated[f], encoding='utf-8') as nb_file:
+                    notebook = nbformat.read(nb_file, as_version=4)
+            except Exception as e:
+                logger.warning('Could not read %s to get its thumbnail: %s', evaluated[f], e)
+                retcodes.append(1)
+                continue
+            retcodes.append(0 if output_thumbnail(notebook, thumb_path) else 1)
+    return retcodes
+
+
 def generate_gallery_rst(app):
     """Generate the Main examples gallery reStructuredText
     Start the sphinx-gallery configuration and recursively scan the examples
@@ -1106,6 +1249,8 @@ def generate_gallery_rst(app):
 
     # this assures I can call the config in other places
     app.config.nbsite_gallery_conf = gallery_conf
+    get_client(gallery_conf).reset()
 
     for gallery in sorted(gallery_conf['galleries']):
-        generate_gallery(app, gallery)
+        with span('gallery.generate', gallery=gallery):
+            generate_gallery(app, gallery)
@@ -0,0 +1,202 @@
+"""
+Processing of the gallery thumbnails.
+
+The thumbnails are padded into a square once (see ``resize_pad``), the
+thumbnails already at the size being left alone: re-encoding them at
+every build would degrade them. With the ``thumbnail_formats`` gallery
+option, smaller variants of the thumbnails in modern formats (e.g. WebP
+or AVIF) are also written next to them, at ``thumbnail_widths``. The
+gallery pages offer them to the browsers, the thumbnail being wrapped in
+a ``<picture>`` element with a source per format (see
+``add_thumbnail_sources``).
+"""
+from __future__ import annotations
+
+import os
+import shutil
+import tempfile
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from multiprocessing import get_context
+
+import sphinx.util.logging
+
+from docutils import nodes
+from PIL import Image, features
+from sphinx.util.osutil import relative_uri
+
+logger = sphinx.util.logging.getLogger('nbsite-gallery')
+
+THUMBNAILS_DIRNAME = 'thumbnails'
+
+DEFAULT_SIZE = 500
+
+MIME_TYPES = {'webp': 'image/webp', 'avif': 'image/avif'}
+
+# Width of the cards in the viewport, for the browsers to pick a variant.
+SIZES = '(max-width: 768px) 50vw, 25vw'
+
+# Directory of the variants in the output, relative to the _images directory.
+OUTPUT_DIRNAME = 'nbsite'
+
+
+def resize_pad(im_pth, desired_size=DEFAULT_SIZE):
+    """
+    Pad the image at im_pth into a transparent square of desired_size.
+
+    Returns whether the image was resized, the images already at the
+    size being left alone.
+    """
+    with Image.open(im_pth) as im:
+        old_size = im.size  # old_size[0] is in (width, height) format
+        if old_size == (desired_size, desired_size):
+            return False
+
+        ratio = float(desired_size)/max(old_size)
+        new_size = tuple([int(x*ratio) for x in old_size])
+        w = (desired_size-new_size[0])//2
+        h = (desired_size-new_size[1])//2
+
+        # LANCZOS replaced ANTIALIAS in PIL 10
+        im_filter = getattr(Image, "LANCZOS", None) or getattr(Image, "ANTIALIAS", None)
+        im = im.resize(new_size, im_filter)
+    new_im = Image.new("RGBA", (desired_size, desired_size), color=(0, 0, 0, 0))
+    new_im.paste(im, (w, h))
+    new_im.save(im_pth, optimize=True)
+    return True
+
+
+def variant_path(path, width, fmt) -> str:
+    """Path of the variant of the image at path at width in format fmt."""
+    stem = os.path.splitext(path)[0]
+    return f'{stem}-{width}w.{fmt}'
+
+
+def supported_formats(formats) -> list[str]:
+    """Return the formats of the variants Pillow can write."""
+    supported = []
+    for fmt in formats:
+        fmt = fmt.lower()
+        if fmt not in MIME_TYPES:
+            logger.warning('Unknown thumbnail format %r, expected one of %s', fmt, ', '.join(MIME_TYPES), once=True)
+        elif not features.check(fmt):
+            logger.warning('Thumbnail format %r is not supported by the installed Pillow', fmt, once=True)
+        else:
+            supported.append(fmt)
+    return supported
+
+
+def _outdated_variants(path, formats, widths):
+    mtime = os.path.getmtime(path)
+    with Image.open(path) as im:
+        width = im.width
+    return [
+        (w, fmt) for fmt in formats for w in widths
+        # Not upscaled
+        if w <= width and not (
+            os.path.isfile(variant_path(path, w, fmt))
+            and os.path.getmtime(variant_path(path, w, fmt)) >= mtime
+        )
+    ]
+
+
+def write_variants(path, formats, widths) -> list[str]:
+    """Write the variants of the image at path missing or older than it.
+
+    Returns the paths of the variants written.
+    """
+    written = []
+    outdated = _outdated_variants(path, formats, widths)
+    if not outdated:
+        return written
+    with Image.open(path) as im:
+        im.load()
+        for width, fmt in outdated:
+            height = max(1, round(im.height * width / im.width))
+            variant = im if width == im.width else im.resize((width, height), Image.LANCZOS)
+            target = variant_path(path, width, fmt)
+            fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(target))
+            os.close(fd)
+            try:
+                variant.save(tmp, format=fmt.upper())
+                os.replace(tmp, target)
+            except BaseException:
+                os.remove(tmp)
+                raise
+            written.append(target)
+    return written
+
+
+def _needs_processing(path, desired_size, formats, widths):
+    with Image.open(path) as im:
+        if im.size != (desired_size, desired_size):
+            return True
+    return bool(formats and _outdated_variants(path, formats, widths))
+
+
+def prepare_thumbnail(path, desired_size=DEFAULT_SIZE, formats=(), widths=()):
+    """Resize the thumbnail at path and write its variants, if needed."""
+    resize_pad(path, desired_size)
+    if formats:
+        write_variants(path, formats, widths)
+
+
+def prepare_thumbnails(paths, desired_size=DEFAULT_SIZE, formats=(), widths=(), workers=None):
+    """
+    Resize the thumbnails and write their variants in a process pool.
+
+    Only the thumbnails not already processed are, by at most workers
+    processes (defaults to the number of CPUs).
+    """
+    formats = supported_formats(formats)
+    pending = [
+        path for path in dict.fromkeys(paths)
+        if _needs_processing(path, desired_size, formats, widths)
+    ]
+    if not pending:
+        return
+    func = partial(prepare_thumbnail, desired_size=desired_size, formats=formats, widths=widths)
+    workers = min(workers or os.cpu_count() or 1, len(pending))
+    if workers == 1:
+        for path in pending:
+            func(path)
+        return
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn')) as executor:
+        list(executor.map(func, pending))
+
+
+def _output_variant(app, variant, docname):
+    # Copied to the output, returning its URL from the page.
+    relpath = os.path.relpath(variant, app.srcdir)
+    target = os.path.join(app.outdir, '_images', OUTPUT_DIRNAME, relpath)
+    if not os.path.isfile(target) or os.path.getmtime(target) < os.path.getmtime(variant):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copyfile(variant, target)
+    uri = '/'.join(['_images', OUTPUT_DIRNAME, *relpath.split(os.sep)])
+    return relative_uri(app.builder.get_target_uri(docname), uri)
+
+
+def add_thumbnail_sources(app, doctree, docname):
+    """Offer the variants of the gallery thumbnails of a page to the browsers."""
+    gallery_conf = app.config.nbsite_gallery_conf
+    formats = supported_formats(gallery_conf.get('thumbnail_formats') or ())
+    widths = gallery_conf.get('thumbnail_widths') or ()
+    if not formats or app.builder.format != 'html':
+        return
+    for node in list(doctree.findall(nodes.image)):
+        path = os.path.join(app.srcdir, node['uri'])
+        if os.path.basename(os.path.dirname(path)) != THUMBNAILS_DIRNAME:
+            continue
+        sources = []
+        for fmt in formats:
+            srcset = [
+                f'{_output_variant(app, variant_path(path, width, fmt), docname)} {width}w'
+                for width in widths if os.path.isfile(variant_path(path, width, fmt))
+            ]
+            if srcset:
+                sources.append(f'<source type="{MIME_TYPES[fmt]}" srcset="{", ".join(srcset)}" sizes="{SIZES}">')
+        if sources:
+            index = node.parent.index(node)
+            node.parent.insert(index, nodes.raw('', '<picture>' + ''.join(sources), format='html'))
+            node.parent.insert(index + 2, nodes.raw('', '</picture>', format='html'))
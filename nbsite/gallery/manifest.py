@@ -0,0 +1,98 @@
+"""
+Manifest of the thumbnails made by the gallery.
+
+The thumbnails generated or downloaded by the gallery are recorded in a
+manifest stored in the directory of the gallery, along with a key of
+their inputs: the code cells of the notebook and the thumbnail settings
+(see ``thumbnail_key``). A thumbnail whose key changed is stale and made
+again, the others being reused as they are. The thumbnails not recorded,
+e.g. added to the doc tree by hand, are always reused.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import tempfile
+
+from ..dependencies import file_hash
+from ..nbcache import notebook_cache_key
+
+# Not a .json file, which nbsite build copies to the built site.
+MANIFEST_FILENAME = '.nbsite-thumbnails'
+
+# Bumped when the thumbnails made from the same inputs change.
+KEY_VERSION = 1
+
+
+def thumbnail_key(path, settings) -> str:
+    """Return the key of the inputs of the thumbnail of an example.
+
+    Only the code cells of a notebook are part of the key, the other
+    examples being hashed as a whole.
+    """
+    h = hashlib.sha256()
+    h.update(repr(KEY_VERSION).encode('utf-8'))
+    inputs = None
+    if path.endswith('.ipynb'):
+        try:
+            inputs = notebook_cache_key(path)
+        except Exception:
+            # Not a valid notebook, which the build reports on its own.
+            pass
+    h.update((inputs or file_hash(path)).encode('utf-8'))
+    h.update(json.dumps(settings, sort_keys=True, default=str).encode('utf-8'))
+    return h.hexdigest()
+
+
+class ThumbnailManifest:
+    """
+    Keys of the thumbnails of a gallery, see thumbnail_key.
+
+    The thumbnails are named by their path relative to the gallery
+    directory, without extension. Only the thumbnails checked or recorded
+    since the manifest was loaded are saved, those of the removed
+    examples being dropped.
+    """
+
+    def __init__(self, gallery_dir):
+        self.gallery_dir = os.fspath(gallery_dir)
+        self.path = os.path.join(self.gallery_dir, MANIFEST_FILENAME)
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                self._recorded = json.load(f)['thumbnails']
+        except (OSError, ValueError, KeyError):
+            self._recorded = {}
+        self._current = {}
+
+    def _name(self, thumb_base) -> str:
+        return os.path.relpath(thumb_base, self.gallery_dir).replace(os.sep, '/')
+
+    def is_stale(self, thumb_base, key) -> bool:
+        """Whether the thumbnail at thumb_base was made from other inputs."""
+        name = self._name(thumb_base)
+        recorded = self._recorded.get(name)
+        if recorded is None:
+            return False
+        if recorded != key:
+            return True
+        self._current[name] = key
+        return False
+
+    def record(self, thumb_base, key):
+        """Record that the thumbnail at thumb_base was made from key."""
+        self._current[self._name(thumb_base)] = key
+
+    def save(self):
+        if self._current == self._recorded:
+            return
+        os.makedirs(self.gallery_dir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=self.gallery_dir)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({'thumbnails': dict(sorted(self._current.items()))}, f, indent=1)
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        self._recorded = dict(self._current)
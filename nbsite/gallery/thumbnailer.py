@@ -1,7 +1,9 @@
 from __future__ import unicode_literals
 
 import ast
+import base64
 import os
+import signal
 import subprocess
 import sys
 import tempfile
@@ -134,6 +136,61 @@ def thumbnail(obj, basename):
     return obj
 
 
+# Installed in the kernel executing a notebook for the documentation,
+# saving the first holoviews or panel object displayed as the thumbnail
+# (like thumbnail, without importing this module and thus switching the
+# matplotlib backend of the kernel).
+THUMBNAIL_HOOK = '''\
+def __nbsite_thumbnail_hook(basename):
+    import os, sys
+    from IPython import get_ipython
+
+    def hook(result):
+        obj = result.result
+        if obj is None or os.path.isfile(basename + '.png'):
+            return
+        try:
+            if 'holoviews' in sys.modules:
+                from holoviews.core import Dimensioned, Store
+                if isinstance(obj, Dimensioned):
+                    Store.renderers[Store.current_backend].save(obj, basename, fmt='png')
+                    return
+            if 'panel' in sys.modules:
+                from panel.viewable import Viewable
+                if isinstance(obj, Viewable):
+                    obj.save(basename + '.png')
+        except Exception:
+            pass
+
+    get_ipython().events.register('post_run_cell', hook)
+__nbsite_thumbnail_hook({basename!r})
+del __nbsite_thumbnail_hook
+'''
+
+
+def thumbnail_hook_code(basename):
+    """Code installing the hook saving the thumbnail to basename.png."""
+    return THUMBNAIL_HOOK.format(basename=os.fspath(basename))
+
+
+def output_thumbnail(notebook, path):
+    """
+    Write the last image/png output of an evaluated notebook to path.
+
+    Returns whether the notebook has such an output.
+    """
+    for cell in reversed(notebook.cells):
+        for output in reversed(cell.get('outputs', [])):
+            data = output.get('data', {}).get('image/png')
+            if data:
+                if isinstance(data, list):
+                    data = ''.join(data)
+                with open(path, 'wb') as f:
+                    f.write(base64.b64decode(data))
+                return True
+    return False
+
+
 class ThumbnailProcessor(Preprocessor):
 
     def __init__(self, basename, **kwargs):
@@ -151,16 +208,39 @@ class ThumbnailProcessor(Preprocessor):
     def __call__(self, nb, resources): return self.preprocess(nb,resources)
 
 
-def execute(code, cwd, env):
+def execute(code, cwd, env, timeout=None):
+    """
+    Execute the code in a Python subprocess, returning its return code.
+
+    The subprocess is killed and subprocess.TimeoutExpired raised if it
+    runs longer than timeout seconds. It runs in a session of its own, the
+    processes it started (e.g. the headless browser exporting a plot)
+    being killed with it.
+    """
     with tempfile.NamedTemporaryFile('wb', delete=True) as f:
         f.write(code)
         f.flush()
-        proc = subprocess.Popen([sys.executable, f.name], cwd=cwd, env=env)
-        proc.wait()
-        proc.kill()
+        proc = subprocess.Popen([sys.executable, f.name], cwd=cwd, env=env,
+                                start_new_session=os.name == 'posix')
+        try:
+            proc.wait(timeout=timeout)
+        finally:
+            _kill_process_group(proc)
+            proc.wait()
     return proc.returncode
 
 
+def _kill_process_group(proc):
+    if os.name != 'posix':
+        proc.kill()
+        return
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        # The subprocess exited, along with the processes it started.
+        pass
+
+
 def export_to_python(filename, preprocessors):
     import nbconvert
     import nbformat
@@ -281,8 +361,7 @@ def notebook_thumbnail(filename, subpath):
     basename = os.path.splitext(os.path.basename(filename))[0]
     dir_path = os.path.abspath(os.path.join(subpath, 'thumbnails'))
     absdirpath= os.path.abspath(os.path.join('.', dir_path))
-    if not os.path.exists(absdirpath):
-        os.makedirs(absdirpath)
+    os.makedirs(absdirpath, exist_ok=True)
 
     preprocessors = [OptsMagicProcessor(),
                      OutputMagicProcessor(),
@@ -0,0 +1,145 @@
+"""
+Pool of pre-started kernels used to execute notebooks.
+
+Starting a kernel and running the ``nbbuild_ipython_startup`` code (which
+usually imports holoviews, bokeh and matplotlib) takes several seconds
+per notebook. A KernelPool keeps kernels started with the startup code
+already executed; a kernel handed back to the pool is restarted in the
+background while the next notebook runs on another warm kernel.
+"""
+from __future__ import annotations
+
+import atexit
+import os
+import queue
+import threading
+
+from jupyter_client.manager import KernelManager
+
+
+class KernelPool:
+    """
+    Pool of warm kernels of a given kernel name and startup code.
+
+    Kernels are acquired with ``acquire`` and must be handed back with
+    ``release``, which restarts them (in a background thread) so that no
+    state leaks from a notebook to the next one.
+    """
+
+    def __init__(self, size=1, kernel_name='python3', startup_code=None, startup_timeout=60):
+        self.size = size
+        self.kernel_name = kernel_name
+        self.startup_code = startup_code
+        self.startup_timeout = startup_timeout
+        self._kernels = queue.Queue()
+        self._managers = []
+        self._lock = threading.Lock()
+        self._closed = False
+        for _ in range(size):
+            self._spawn(self._start)
+
+    def _spawn(self, func, *args):
+        threading.Thread(target=func, args=args, daemon=True).start()
+
+    def _warm_up(self, km):
+        kc = km.blocking_client()
+        kc.start_channels()
+        try:
+            kc.wait_for_ready(timeout=self.startup_timeout)
+            if self.startup_code:
+                kc.execute_interactive(
+                    self.startup_code, store_history=False, allow_stdin=False,
+                    timeout=self.startup_timeout, output_hook=lambda msg: None,
+                )
+        finally:
+            kc.stop_channels()
+
+    def _start(self):
+        # nbclient drives the execution with an asynchronous client.
+        km = KernelManager(kernel_name=self.kernel_name,
+                           client_class='jupyter_client.asynchronous.AsyncKernelClient')
+        with self._lock:
+            self._managers.append(km)
+        try:
+            km.start_kernel()
+            self._warm_up(km)
+        except Exception as e:
+            km = e
+        self._kernels.put(km)
+
+    def _restart(self, km):
+        try:
+            km.restart_kernel(now=True)
+            self._warm_up(km)
+        except Exception:
+            self._discard(km)
+            self._start()
+            return
+        if self._closed:
+            self._discard(km)
+        else:
+            self._kernels.put(km)
+
+    def _discard(self, km):
+        with self._lock:
+            if km in self._managers:
+                self._managers.remove(km)
+        try:
+            km.shutdown_kernel(now=True)
+        except Exception:
+            pass
+
+    def acquire(self, timeout=None) -> KernelManager:
+        """Return a warm kernel manager, waiting for one to be available."""
+        km = self._kernels.get(timeout=timeout)
+        if isinstance(km, Exception):
+            # Let the next caller try again with a fresh kernel.
+            self._spawn(self._start)
+            raise RuntimeError(f'Kernel failed to start: {km}') from km
+        if not km.is_alive():
+            self._discard(km)
+            self._spawn(self._start)
+            return self.acquire(timeout)
+        return km
+
+    def release(self, km):
+        """Hand a kernel back to the pool, restarting it in the background."""
+        if self._closed:
+            self._discard(km)
+        else:
+            self._spawn(self._restart, km)
+
+    def shutdown(self):
+        """Shut down all the kernels of the pool."""
+        self._closed = True
+        with self._lock:
+            managers = list(self._managers)
+        for km in managers:
+            self._discard(km)
+
+
+# The pools are keyed by the pid of the process that created them: the
+# pools inherited by a forked process (e.g. a Sphinx read worker) belong
+# to its parent, whose kernels it must neither use nor shut down.
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_kernel_pool(size, kernel_name, startup_code=None) -> KernelPool:
+    """Return the process wide KernelPool for the given settings."""
+    key = (os.getpid(), size, kernel_name, startup_code)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = KernelPool(size, kernel_name, startup_code)
+        return _pools[key]
+
+
+@atexit.register
+def shutdown_kernel_pools():
+    """Shut down the kernels of every pool created in this process."""
+    pid = os.getpid()
+    with _pools_lock:
+        keys = [key for key in _pools if key[0] == pid]
+        pools = [_pools.pop(key) for key in keys]
+    for pool in pools:
+        pool.shutdown()
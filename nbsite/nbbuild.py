@@ -29,36 +29,75 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 from __future__ import annotations
 
+import asyncio
 import copy
+import functools
 import glob
-import io
-import json
 import os
 import re
 import shutil
 import string
 import sys
+import tempfile
+import threading
+import time
 import typing
 
-from contextlib import contextmanager
+from collections import Counter, OrderedDict
+from concurrent.futures import (
+    ProcessPoolExecutor, ThreadPoolExecutor, as_completed,
+)
+from contextlib import contextmanager, nullcontext
+from multiprocessing import get_context
 from pathlib import Path
 
 import nbformat
 import sphinx
+import yaml
 
+from docutils import nodes
 from docutils.parsers.rst import Directive, directives
 from docutils.statemachine import string2lines
 from docutils.utils import new_document
+from jupyter_client.kernelspec import KernelSpecManager
+from jupyter_core.utils import run_sync
 from myst_nb import __version__ as _myst_version
 from myst_nb.sphinx_ import Parser
-from nbconvert import NotebookExporter, PythonExporter
+from nbconvert import PythonExporter
 from nbconvert.preprocessors import (
     CellExecutionError, ExecutePreprocessor, Preprocessor,
 )
 from packaging.version import Version
 from sphinx.util import logging
+from sphinx.util.osutil import relative_uri
 
+from . import __version__ as nbs_version
 from .cmd import _prepare_paths, hosts
+from .dependencies import (
+    METADATA_KEY, changed_dependencies, collect_dependencies,
+    notebook_dependencies, record_dependencies, tracker_code, written_files,
+)
+from .execstats import (
+    execution_started, kernel_peak_memory, notebook_stats, record_cell,
+    record_notebook,
+)
+from .kernelpool import get_kernel_pool
+from .nbcache import (
+    DEFAULT_MAX_SIZE, NotebookCache, default_cache_dir,
+    environment_fingerprint, merge_outputs, notebook_cache_key,
+)
+from .outputstore import (
+    DEFAULT_MIN_SIZE as OUTPUT_STORE_MIN_SIZE, STORE_DIRNAME, OutputStore,
+    resolve_outputs, store_outputs, stored_output,
+)
+from .profiling import (
+    bind, enable as enable_profiling, events_dir, span,
+)
+from .sharedassets import (
+    DEFAULT_MIN_SIZE as SHARED_PAYLOAD_MIN_SIZE,
+    STATIC_DIRNAME as SHARED_STATIC_DIRNAME, find_payloads, hoist_payloads,
+    remove_unused,
+)
 
 if typing.TYPE_CHECKING:
     from collections.abc import Iterable
@@ -89,6 +128,18 @@ interactivity_warning = (
 class ExecutePreprocessor1000(ExecutePreprocessor):
     """Sigh"""
     _ipython_startup = None
+    _kernel_cwd = None
+    _dependencies_log = None
+    _setup_code = None
+    _deadline = None
+
+    def _get_timeout(self, cell):
+        # The cells executing past the deadline of the notebook time out.
+        timeout = super()._get_timeout(cell)
+        if self._deadline is not None:
+            remaining = max(1, int(self._deadline - time.monotonic()))
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        return timeout
 
     @property
     def kc(self):
@@ -101,12 +152,22 @@ class ExecutePreprocessor1000(ExecutePreprocessor):
     @kc.setter
     def kc(self, v):
         self._kc = v
-        if v is not None and self._ipython_startup is not None:
+        code = self._ipython_startup
+        if self._kernel_cwd is not None:
+            # A kernel from the pool was started elsewhere, move it to the
+            # notebook directory (its startup code was already executed).
+            code = f'__import__("os").chdir({self._kernel_cwd!r})'
+        if self._dependencies_log is not None:
+            # After the startup code, whose imports are not dependencies.
+            code = '\n'.join(filter(None, [code, tracker_code(self._dependencies_log)]))
+        if self._setup_code is not None:
+            code = '\n'.join(filter(None, [code, self._setup_code]))
+        if v is not None and code is not None:
             # Ensure kernel is running and ready to receive execute_request messages.
             # This is important for ipykernel >= 7
             self._kc.kernel_info()
             self._kc.execute(
-                self._ipython_startup,
+                code,
                 silent=False,
                 store_history=False,
                 allow_stdin=False,
@@ -114,6 +175,16 @@ class ExecutePreprocessor1000(ExecutePreprocessor):
             )
 
 
+    async def async_execute_cell(self, cell, cell_index, execution_count=None, store_history=True):
+        start = time.perf_counter()
+        try:
+            return await super().async_execute_cell(cell, cell_index, execution_count, store_history)
+        finally:
+            if cell.cell_type == 'code':
+                provisioner = getattr(self.km, 'provisioner', None)
+                record_cell(cell, time.perf_counter() - start,
+                            kernel_peak_memory(getattr(provisioner, 'pid', None)))
+
     def handle_comm_msg(self, outs, msg, cell_index):
         """
         Comm messages are not handled correctly in some cases so we
@@ -146,7 +217,7 @@ class NotebookSlice(Preprocessor):
     def __init__(self, substring=None, end=None, offset=0, **kwargs):
         self.substring = substring
         self.end = end
-        self.offset = offset
+        self.offset = offset or 0
         super(NotebookSlice, self).__init__(**kwargs)
 
     def _find_slice(self, nbc, substring, endstr):
@@ -182,15 +253,68 @@ class NotebookSlice(Preprocessor):
         return (max([start,self.offset]),end)
 
     def preprocess(self, nb, resources):
-        nbc = copy.deepcopy(nb)
-        start,end = self._find_slice(nbc, self.substring, self.end)
-        nbc.cells = nbc.cells[start:end]
+        # A view of the selected cells, which are not copied.
+        start,end = self._find_slice(nb, self.substring, self.end)
+        nbc = nbformat.NotebookNode(nb)
+        nbc.cells = nb.cells[start:end]
         return nbc, resources
 
     def __call__(self, nb, resources):
         return self.preprocess(nb,resources)
 
 
+class SourceIndex:
+    """
+    Index of the source (.rst / .md) files of a doc tree.
+
+    Built once per build (see build_source_index), it lets
+    FixNotebookLinks resolve the candidate targets of the notebook links
+    in memory instead of looking them up on the filesystem. Paths outside
+    of the doc tree are still looked up on the filesystem.
+    """
+
+    def __init__(self, root: str, file_types=('rst', 'md'), exclude=()):
+        self.root = os.path.normpath(os.path.abspath(root))
+        suffixes = tuple('.' + file_type for file_type in file_types)
+        exclude = {os.path.normpath(os.path.abspath(path)) for path in exclude}
+        self._paths = set()
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            # e.g. the build directory inside of the doc tree
+            dirnames[:] = [d for d in dirnames if os.path.join(dirpath, d) not in exclude]
+            self._paths.update(
+                os.path.join(dirpath, filename) for filename in filenames
+                if filename.endswith(suffixes)
+            )
+
+    def __len__(self):
+        return len(self._paths)
+
+    def __contains__(self, file_path: str) -> bool:
+        file_path = os.path.normpath(file_path)
+        if not file_path.startswith(self.root + os.sep):
+            return os.path.isfile(file_path)
+        return file_path in self._paths
+
+
+_source_indexes = {}
+
+
+def build_source_index(app, env, docnames):
+    """Index the source files of the doc tree before the documents are read.
+
+    The index is built before Sphinx forks its parallel read workers, which
+    share it.
+    """
+    _source_indexes[env.srcdir] = SourceIndex(
+        env.srcdir, FixNotebookLinks.file_types, exclude=(app.outdir, app.doctreedir)
+    )
+
+
+def get_source_index(srcdir) -> SourceIndex | None:
+    """Return the index of the source files of srcdir, if it was built."""
+    return _source_indexes.get(srcdir)
+
+
 class FixNotebookLinks(Preprocessor):
     """
     Fixes relative notebook links by pointing to ReST or Markdown
@@ -209,24 +333,35 @@ class FixNotebookLinks(Preprocessor):
         r"((?:#[^)\s]*)?\))"    # Group 3: optional #fragment and closing )
     ))
 
-    def __init__(self, nb_path: str, **kwargs):
+    # Regex for matching a numbered notebook stem, e.g. "01-Some_Notebook"
+    number_prefix_regex = re.compile(r"\d+[ -_](.*)")
+
+    def __init__(self, nb_path: str, source_index: SourceIndex | None = None, **kwargs):
         # nb_path: the directory of the notebook, without a trailing slash
         self.nb_path = nb_path
+        self.source_index = source_index
+        # (link target, directory) of the links whose source file was not
+        # found, reported once for the whole build by the directive.
+        self.unresolved = []
         super(FixNotebookLinks, self).__init__(**kwargs)
 
     def preprocess_cell(self, cell, resources, index):
-        if cell['cell_type'] != 'markdown':
+        if cell['cell_type'] != 'markdown' or '.ipynb' not in cell['source']:
             return cell, resources
 
         cell['source'] = self.replace_notebook_links(
             markdown_text=cell['source'],
-            rootdir=self.nb_path
+            rootdir=self.nb_path,
+            source_index=self.source_index,
+            unresolved=self.unresolved,
         )
 
         return cell, resources
 
     @classmethod
-    def replace_notebook_links(cls, markdown_text: str, rootdir:str) -> str:
+    def replace_notebook_links(cls, markdown_text: str, rootdir:str,
+                               source_index: SourceIndex | None = None,
+                               unresolved: list | None = None) -> str:
         """Replaces notebook links in a markdown text.
 
         Parameters
@@ -237,12 +372,21 @@ class FixNotebookLinks(Preprocessor):
             The absolute path to the directory where the notebook that is being
             processed (which contains links) is located at, without a trailing
             slash.
+        source_index:
+            Index of the source files the link targets are looked up in,
+            the filesystem being used if None.
+        unresolved:
+            List the links whose source file is not found are appended to,
+            a warning being logged for each of them if None.
         """
         for nb_link, nb_filepath in cls._extract_links(markdown_text):
 
-            target_relpath = cls._get_sourcefile(rootdir, nb_filepath)
+            target_relpath = cls._get_sourcefile(rootdir, nb_filepath, source_index)
             if not target_relpath:
-                logger.warning('Source file for "%s" not found (path relative to "%s")', nb_filepath, rootdir)
+                if unresolved is None:
+                    logger.warning('Source file for "%s" not found (path relative to "%s")', nb_filepath, rootdir)
+                else:
+                    unresolved.append((nb_filepath, rootdir))
                 continue
 
             new_link = cls._create_target_link(nb_link, target_relpath)
@@ -251,7 +395,8 @@ class FixNotebookLinks(Preprocessor):
         return markdown_text
 
     @classmethod
-    def _get_sourcefile(cls, rootdir: str, nb_filepath: str) -> str | None:
+    def _get_sourcefile(cls, rootdir: str, nb_filepath: str,
+                        source_index: SourceIndex | None = None) -> str | None:
         """"Get the source (.rst / .md) file path for a notebook.
 
         Parameters
@@ -260,6 +405,8 @@ class FixNotebookLinks(Preprocessor):
             The location of the root notebook (where the link markdown is at)
         nb_filepath:
             Location of the notebook which source to find, relative to rootdir.
+        source_index:
+            Index of the source files, the filesystem being used if None.
 
         Returns
         -------
@@ -267,9 +414,10 @@ class FixNotebookLinks(Preprocessor):
             The source file path relative to root notebook. If the source file
             is not found, issues a warning and returns none.
         """
+        file_exists = cls._file_exists if source_index is None else source_index.__contains__
         for source_relpath in cls._iter_source_file_candidates(nb_filepath):
             target_abspath = os.path.normpath(os.path.join(rootdir, source_relpath))
-            if cls._file_exists(target_abspath):
+            if file_exists(target_abspath):
                 return source_relpath
 
     @classmethod
@@ -330,10 +478,10 @@ class FixNotebookLinks(Preprocessor):
         for extension in cls.file_types:
             yield f"{nb_path_without_extension}.{extension}"
 
-        for extension in cls.file_types:
-            directory, stem = os.path.split(nb_path_without_extension)
-            match = re.match(r"\d+[ -_](.*)", stem)
-            if match:
+        directory, stem = os.path.split(nb_path_without_extension)
+        match = cls.number_prefix_regex.match(stem)
+        if match:
+            for extension in cls.file_types:
                 yield os.path.join(directory, match.group(1) + '.' + extension).replace("\\", "/")
 
 
@@ -417,51 +565,572 @@ def nb_to_python(nb_path):
     return output
 
 
-def evaluate_notebook(nb_path, dest_path=None, skip_exceptions=False,
-                      skip_execute=None, timeout=300, ipython_startup=None,
-                      patterns_to_take_with_me=None):
+def _shallow_copy(notebook):
+    """Copy a notebook down to its outputs, sharing the output data.
 
-    if patterns_to_take_with_me is None:
-        patterns_to_take_with_me = []
+    The preprocessors and myst-nb replace the values of the cells and
+    outputs rather than mutate them, a shallow copy is enough to keep
+    the original notebook intact while it is written in the background.
+    """
+    nb = nbformat.NotebookNode(notebook)
+    nb.metadata = copy.deepcopy(notebook.metadata)
+    nb.cells = []
+    for cell in notebook.cells:
+        cell = nbformat.NotebookNode(cell)
+        if 'outputs' in cell:
+            cell.outputs = [nbformat.NotebookNode(output) for output in cell.outputs]
+        nb.cells.append(cell)
+    return nb
 
-    notebook = nbformat.read(nb_path, as_version=4)
-    kwargs = dict(timeout=timeout,
-                  kernel_name='python%s'%sys.version_info[0],
-                  allow_errors=skip_exceptions)
 
-    cwd = os.getcwd()
-    filedir, filename = os.path.split(nb_path)
-    os.chdir(filedir)
-    not_nb_runner = ExecutePreprocessor1000(**kwargs)
-    if ipython_startup is not None:
-        not_nb_runner._ipython_startup = ipython_startup
+# Evaluated notebooks parsed (or evaluated) during the build, shared by
+# the directives embedding the same notebook, e.g. with different slices.
+# Maps the path of the evaluated notebook to its (mtime, size), None
+# while it is being written, and the notebook, least recently used first.
+PARSED_NOTEBOOKS_SIZE = 8
+_parsed_notebooks = OrderedDict()
+_parsed_lock = threading.Lock()
+
+
+def _stat_key(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _cache_parsed_notebook(path, notebook, key=None):
+    with _parsed_lock:
+        _parsed_notebooks[path] = (key, notebook)
+        _parsed_notebooks.move_to_end(path)
+        while len(_parsed_notebooks) > PARSED_NOTEBOOKS_SIZE:
+            _parsed_notebooks.popitem(last=False)
+
+
+def read_evaluated_notebook(path):
+    """Read an evaluated notebook, parsed at most once while unchanged.
+
+    The notebook returned is shared and must not be modified.
+    """
+    path = os.path.abspath(path)
+    with _parsed_lock:
+        key, notebook = _parsed_notebooks.get(path, (None, None))
+    if notebook is not None and (key is None or key == _stat_key(path)):
+        with _parsed_lock:
+            if path in _parsed_notebooks:
+                _parsed_notebooks.move_to_end(path)
+        return notebook
+    future = _pending_write(path)
+    if future is not None:
+        future.result()
+    key = _stat_key(path)
+    notebook = nbformat.read(path, as_version=NOTEBOOK_VERSION)
+    _cache_parsed_notebook(path, notebook, key)
+    return notebook
+
+
+def clear_parsed_notebooks(*args):
+    """Release the evaluated notebooks parsed during the build."""
+    wait_for_notebook_writes()
+    with _parsed_lock:
+        _parsed_notebooks.clear()
+
+
+def _write_notebook(notebook, dest_path, cache=None, cache_key=None, side_files=()):
+    # Written to a temporary file first, an interrupted write must not
+    # leave a truncated notebook considered as already evaluated.
+    with span('notebook.write', notebook=dest_path):
+        tmp = dest_path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            nbformat.write(notebook, f)
+        os.replace(tmp, dest_path)
+        path = os.path.abspath(dest_path)
+        with _parsed_lock:
+            if _parsed_notebooks.get(path, (None, None))[1] is notebook:
+                _parsed_notebooks[path] = (_stat_key(path), notebook)
+        if cache_key is not None:
+            cache.store(cache_key, dest_path, side_files)
+
+
+_writer = None
+_pending_writes = {}
+_writes_lock = threading.Lock()
+
+
+def _pending_write(dest_path):
+    """Return the future of the background write of dest_path, if any."""
+    with _writes_lock:
+        if _writer is None or _writer[0] != os.getpid():
+            return None
+        return _pending_writes.get(os.path.abspath(dest_path))
+
+
+def write_notebook_in_background(notebook, dest_path, **kwargs):
+    """Write an evaluated notebook (see _write_notebook) in a background thread."""
+    global _writer
+    with _writes_lock:
+        # The thread of an executor inherited from a forked parent is gone.
+        if _writer is None or _writer[0] != os.getpid():
+            _writer = (os.getpid(), ThreadPoolExecutor(1, thread_name_prefix='nbsite-write'))
+            _pending_writes.clear()
+        _pending_writes[os.path.abspath(dest_path)] = _writer[1].submit(bind(_write_notebook), notebook, dest_path, **kwargs)
+
+
+def wait_for_notebook_writes(*args):
+    """Wait for the evaluated notebooks written in the background.
+
+    Can be connected to Sphinx events, their arguments being ignored.
+    """
+    with _writes_lock:
+        if _writer is None or _writer[0] != os.getpid():
+            return
+        pending = list(_pending_writes.items())
+        _pending_writes.clear()
+    for dest_path, future in pending:
+        try:
+            future.result()
+        except Exception as e:
+            logger.warning(f'Writing the evaluated notebook {dest_path} failed with {e}')
+
 
+def is_evaluated(nb_path, dest_path) -> bool:
+    """Whether the evaluated notebook at dest_path is up to date.
+
+    It is outdated when the data files read by its execution changed
+    since the execution started (see nbsite.dependencies).
+    """
+    if _pending_write(dest_path) is not None:
+        return True
     if not os.path.isfile(dest_path):
-        print('INFO: Writing evaluated notebook to {dest_path!s}'.format(
+        return False
+    notebook = read_evaluated_notebook(dest_path)
+    changed = changed_dependencies(
+        notebook, os.path.dirname(os.path.abspath(nb_path)),
+        # The notebooks evaluated by older versions only have their mtime.
+        since=execution_started(notebook) or os.path.getmtime(dest_path),
+    )
+    if changed:
+        print('INFO: Data files of the evaluated notebook {dest_path!s} changed ({files})'.format(
+            dest_path=os.path.abspath(dest_path), files=', '.join(changed)))
+        return False
+    return True
+
+
+async def _to_thread(func, *args, **kwargs):
+    # Unlike asyncio.to_thread, the context is not copied to the thread:
+    # the synchronous jupyter_client calls (e.g. KernelManager.is_alive)
+    # would find the running loop in it and fail. Only the profile of the
+    # build is passed on.
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, bind(functools.partial(func, *args, **kwargs)))
+
+
+KERNEL_NAME = 'python%s'%sys.version_info[0]
+
+
+def notebook_side_files(notebook) -> list[str]:
+    """Return the names of the side files moved next to an evaluated notebook."""
+    return notebook.metadata.get(METADATA_KEY, {}).get('side_files', [])
+
+
+async def async_evaluate_notebook(nb_path, dest_path=None, skip_exceptions=False,
+                                  skip_execute=None, timeout=300, ipython_startup=None,
+                                  patterns_to_take_with_me=None, cache=None, env_fingerprint=None,
+                                  kernel_pool_size=0, background_write=False, setup_code=None,
+                                  notebook_timeout=None):
+    """Evaluate a notebook, writing the evaluated notebook to dest_path.
+
+    Returns the evaluated notebook, or None when dest_path already
+    exists. With background_write, the evaluated notebook is written to
+    dest_path in a background thread, while the caller uses the notebook
+    returned, see wait_for_notebook_writes. setup_code is executed in the
+    kernel before the notebook, after the startup code, e.g. to install
+    hooks; it must not change the outputs, which are cached without it.
+    With notebook_timeout, the execution times out after that many
+    seconds, timeout being the limit of each cell.
+
+    The kernel runs in the directory of the notebook, the working
+    directory of the process being left alone, so that notebooks can be
+    evaluated concurrently (see execute_notebooks). The files matching
+    patterns_to_take_with_me written there by the notebook (see
+    nbsite.dependencies) or modified during its execution are moved next
+    to dest_path.
+    """
+    if patterns_to_take_with_me is None:
+        patterns_to_take_with_me = []
+
+    if is_evaluated(nb_path, dest_path):
+        print('INFO: Skipping existing evaluated notebook {dest_path!s}'.format(
             dest_path=os.path.abspath(dest_path)))
+        return None
+
+    notebook = await _to_thread(nbformat.read, nb_path, as_version=4)
+    kernel_name = KERNEL_NAME
+    filedir = os.path.dirname(os.path.abspath(nb_path))
+    cache_key = None
+    if cache is not None and not skip_execute:
+        cache_key = notebook_cache_key(
+            notebook, ipython_startup=ipython_startup, kernel_name=kernel_name,
+            env_fingerprint=env_fingerprint, allow_errors=skip_exceptions,
+        )
+        with span('notebook.cache_fetch', notebook=nb_path):
+            cached = await _to_thread(cache.load, cache_key, os.path.dirname(os.path.abspath(dest_path)))
+        changed = [] if cached is None else await _to_thread(changed_dependencies, cached, filedir)
+        if changed:
+            print('INFO: Data files of the cached notebook {nb_path!s} changed ({files}), executing it again'.format(
+                nb_path=nb_path, files=', '.join(changed)))
+            await _to_thread(cache.discard, cache_key)
+        elif cached is not None:
+            print('INFO: Restored evaluated notebook {dest_path!s} from cache'.format(
+                dest_path=os.path.abspath(dest_path)))
+            # Only the code cells are part of the key, the other cells
+            # (e.g. prose edits) are taken from the current notebook.
+            return await _hand_over_notebook(merge_outputs(notebook, cached), dest_path, background_write)
+
+    not_nb_runner = ExecutePreprocessor1000(
+        timeout=timeout, kernel_name=kernel_name, allow_errors=skip_exceptions,
+        # Started in the notebook directory, see NotebookClient.async_start_new_kernel
+        resources={'metadata': {'path': filedir}},
+    )
+    not_nb_runner.nb = notebook
+    pool = None
+    if kernel_pool_size and not skip_execute:
+        pool = get_kernel_pool(kernel_pool_size, kernel_name, ipython_startup)
+        not_nb_runner._kernel_cwd = filedir
+    elif ipython_startup is not None:
+        not_nb_runner._ipython_startup = ipython_startup
+    not_nb_runner._setup_code = setup_code
+
+    print('INFO: Writing evaluated notebook to {dest_path!s}'.format(
+        dest_path=os.path.abspath(dest_path)))
+    written = []
+    try:
+        if not skip_execute:
+            km = await _to_thread(pool.acquire) if pool else None
+            not_nb_runner.km = km
+            not_nb_runner.owns_km = km is None
+            fd, not_nb_runner._dependencies_log = tempfile.mkstemp(prefix='nbsite-dependencies-', suffix='.log')
+            os.close(fd)
+            started = time.time()
+            if notebook_timeout:
+                not_nb_runner._deadline = time.monotonic() + notebook_timeout
+            try:
+                start = time.perf_counter()
+                with span('notebook.execute', notebook=nb_path):
+                    try:
+                        await not_nb_runner.async_execute()
+                    finally:
+                        record_notebook(notebook, time.perf_counter() - start, started=started)
+            finally:
+                if km is not None:
+                    if not_nb_runner.kc is not None:
+                        not_nb_runner.kc.stop_channels()
+                    pool.release(km)
+                record_dependencies(notebook, await _to_thread(
+                    collect_dependencies, not_nb_runner._dependencies_log, filedir, since=started))
+                written = written_files(not_nb_runner._dependencies_log)
+                os.remove(not_nb_runner._dependencies_log)
+    except CellExecutionError as e:
+        print('')
+        print(e)
+        # Do not cache a partial execution, it may succeed next time.
+        cache_key = None
+
+    # Only the files written by this notebook are taken along: those seen
+    # by the tracker and those modified since the execution started, e.g.
+    # written by compiled libraries or subprocesses (see execute_notebooks).
+    side_files = []
+    written = {os.path.realpath(f) for f in written}
+    if not skip_execute:
+        for pattern in patterns_to_take_with_me:
+            for f in glob.glob(os.path.join(filedir, pattern)):
+                if os.path.realpath(f) not in written and os.path.getmtime(f) < started:
+                    continue
+                print("mv %s %s"%(f, os.path.dirname(dest_path)))
+                shutil.move(f,os.path.dirname(dest_path))
+                side_files.append(os.path.join(os.path.dirname(dest_path), os.path.basename(f)))
+        notebook.metadata.setdefault(METADATA_KEY, {})['side_files'] = [
+            os.path.basename(f) for f in side_files
+        ]
+    return await _hand_over_notebook(
+        notebook, dest_path, background_write,
+        cache=cache, cache_key=cache_key, side_files=side_files,
+    )
+
+
+evaluate_notebook = run_sync(async_evaluate_notebook)
+
+
+async def _hand_over_notebook(notebook, dest_path, background_write, **kwargs):
+    _cache_parsed_notebook(os.path.abspath(dest_path), notebook)
+    if background_write:
+        write_notebook_in_background(notebook, dest_path, **kwargs)
+    else:
+        await _to_thread(_write_notebook, notebook, dest_path, **kwargs)
+    return notebook
+
+
+# Settings of the build passed by ``nbsite build`` as nbbuild_<name> config
+# values, with the environment variable they used to be passed with (still
+# read when running sphinx-build directly) and their default.
+BUILD_CONTEXT = {
+    'project_name': ('PROJECT_NAME', ''),
+    'project_root': ('PROJECT_ROOT', ''),
+    'host': ('HOST', 'GitHub'),
+    'repo': ('REPO', ''),
+    'branch': ('BRANCH', 'main'),
+    'org': ('ORG', ''),
+    'doc': ('DOC', 'doc'),
+    'examples': ('EXAMPLES', 'examples'),
+    'examples_assets': ('EXAMPLES_ASSETS', 'assets'),
+    'binder': ('BINDER', 'none'),
+}
+
+
+def build_context(config):
+    """Return the settings of the build (see BUILD_CONTEXT)."""
+    context = {}
+    for name, (envvar, default) in BUILD_CONTEXT.items():
+        value = getattr(config, f'nbbuild_{name}', None)
+        context[name] = os.environ.get(envvar, default) if value is None else value
+    return context
+
+
+_notebook_caches = {}
+
+def get_notebook_cache(config):
+    """Return the NotebookCache configured by nbbuild_cache_dir, if any."""
+    cache_dir = config.nbbuild_cache_dir
+    if cache_dir is None:
+        return None
+    key = (cache_dir or default_cache_dir(), config.nbbuild_cache_max_size)
+    if key not in _notebook_caches:
+        _notebook_caches[key] = NotebookCache(*key)
+    return _notebook_caches[key]
+
+
+def kernel_executable(kernel_name) -> str:
+    """Return the Python executable of a kernel, this one when unknown."""
+    try:
+        executable = KernelSpecManager().get_kernel_spec(kernel_name).argv[0]
+    except Exception:
+        return sys.executable
+    # The native kernel runs with the executable of the process, see
+    # KernelManager.format_kernel_cmd.
+    if executable in ('python', 'python3', '{python}'):
+        return sys.executable
+    return shutil.which(executable) or sys.executable
+
+
+def get_env_fingerprint(config):
+    """Return the nbbuild_env_fingerprint, by default that of the kernel environment."""
+    fingerprint = config.nbbuild_env_fingerprint
+    if fingerprint == '':
+        return environment_fingerprint(kernel_executable(KERNEL_NAME))
+    return fingerprint
+
+
+def notebook_job_key(nb_path, skip_exceptions, config) -> str:
+    """Return the notebook_cache_key of a notebook executed with the build settings."""
+    return notebook_cache_key(
+        nb_path, ipython_startup=config.nbbuild_ipython_startup, kernel_name=KERNEL_NAME,
+        env_fingerprint=get_env_fingerprint(config), allow_errors=skip_exceptions,
+    )
+
+
+def execution_options(config):
+    """Return the evaluate_notebook options set in the Sphinx config."""
+    cache = get_notebook_cache(config)
+    return dict(
+        timeout=config.nbbuild_cell_timeout,
+        ipython_startup=config.nbbuild_ipython_startup,
+        patterns_to_take_with_me=config.nbbuild_patterns_to_take_along,
+        cache=cache,
+        # Only part of the cache keys.
+        env_fingerprint=None if cache is None else get_env_fingerprint(config),
+        kernel_pool_size=config.nbbuild_kernel_pool_size,
+    )
+
+
+async def async_evaluate_notebook_retrying(nb_path, dest_path, retries=5, **kwargs):
+    """Evaluate a notebook, retrying when the kernel dies."""
+    import zmq
+    for n in range(1, retries+1):
         try:
-            if not skip_execute:
-                not_nb_runner.preprocess(notebook,{})
-        except CellExecutionError as e:
-            print('')
-            print(e)
-        os.chdir(cwd)
-
-        if skip_execute:
-            with open(dest_path,'w', encoding='utf-8') as f:
-                nbformat.write(notebook, f)
-        else:
-            ne = NotebookExporter()
-            newnb, _ = ne.from_notebook_node(notebook)
-            with open(dest_path, 'w', encoding='utf-8') as f:
-                f.write(newnb)
-            for pattern in patterns_to_take_with_me:
-                for f in glob.glob(os.path.join(os.path.dirname(nb_path),pattern)):
-                    print("mv %s %s"%(f, os.path.dirname(dest_path)))
-                    shutil.move(f,os.path.dirname(dest_path))
+            return await async_evaluate_notebook(nb_path, dest_path, **kwargs)
+        except (zmq.error.ZMQError, RuntimeError) as e:
+            # Sometimes the kernel dies
+            print(f"{nb_path} failed with {e}, retrying ({n}/{retries})...", flush=True)
+
+
+evaluate_notebook_retrying = run_sync(async_evaluate_notebook_retrying)
+
+
+async def _execute_notebooks(jobs, concurrency, **options):
+    semaphore = asyncio.Semaphore(concurrency)
+    directory_locks = {}
+
+    async def execute(nb_path, dest_path, skip_exceptions, job_options=None):
+        job_options = dict(options, **(job_options or {}))
+        directory = os.path.dirname(os.path.abspath(nb_path))
+        directory_lock = nullcontext()
+        if job_options.get('patterns_to_take_with_me'):
+            directory_lock = directory_locks.setdefault(directory, asyncio.Lock())
+        async with directory_lock, semaphore:
+            try:
+                # The evaluated notebook is only handed over through dest_path.
+                await async_evaluate_notebook_retrying(
+                    nb_path, dest_path, skip_exceptions=skip_exceptions, **job_options
+                )
+            except Exception as e:
+                # The directive executes it again in the read phase.
+                logger.warning(f'Pre-executing {nb_path} failed with {e}')
+
+    await asyncio.gather(*(execute(*job) for job in jobs))
+
+
+def execute_notebooks(jobs, concurrency=1, **options):
+    """Evaluate notebooks concurrently in the current process.
+
+    jobs is a list of (notebook path, evaluated notebook path,
+    skip_exceptions) tuples, optionally followed by a dict of options
+    specific to the job, at most concurrency notebooks being executed at
+    the same time. When side files are taken along (see
+    async_evaluate_notebook), the notebooks of a directory are executed
+    one at a time, so that each takes along only its own files. Failures
+    are reported as warnings.
+    """
+    run_sync(_execute_notebooks)(jobs, concurrency, **options)
+
+
+_NOTEBOOK_DIRECTIVE_RE = re.compile(r"^\s*(?:\.\. notebook::|`{3,}\s*\{notebook\})\s+(\S+)\s+(\S+)")
+_DIRECTIVE_OPTION_RE = re.compile(r"^\s*:(\w+):\s*(.*?)\s*$")
+
+
+def _yaml_options(lines):
+    # The options of a MyST directive given as a YAML block, delimited
+    # by --- lines at the start of its content.
+    if not lines or lines[0].strip() != '---':
+        return {}
+    for end, line in enumerate(lines[1:], 1):
+        if line.strip() == '---':
+            break
     else:
-        print('INFO: Skipping existing evaluated notebook {dest_path!s}'.format(
-            dest_path=os.path.abspath(dest_path)))
+        return {}
+    try:
+        options = yaml.safe_load('\n'.join(lines[1:end]))
+    except yaml.YAMLError:
+        return {}
+    if not isinstance(options, dict):
+        return {}
+    # Passed as strings to the directive option converters, like the
+    # options of a field list.
+    return {str(name): '' if value is None else str(value) for name, value in options.items()}
+
+
+def find_notebook_directives(source_path):
+    """Find the notebook directives of a reST or MyST Markdown source file.
+
+    Returns a list of (notebook path, options) tuples, the notebook path
+    being the absolute path of the directive second argument. The options
+    are read from the field list (:name: value lines) following the
+    directive, or from its MyST YAML option block.
+    """
+    with open(source_path, encoding='utf-8') as f:
+        lines = f.read().splitlines()
+    source_dir = os.path.dirname(os.path.abspath(source_path))
+    found = []
+    for i, line in enumerate(lines):
+        match = _NOTEBOOK_DIRECTIVE_RE.match(line)
+        if not match:
+            continue
+        options = _yaml_options(lines[i+1:])
+        for option_line in lines[i+1:]:
+            option = _DIRECTIVE_OPTION_RE.match(option_line)
+            if not option:
+                break
+            options[option.group(1)] = option.group(2)
+        nb_abs_path = os.path.abspath(os.path.join(source_dir, match.group(2)))
+        found.append((nb_abs_path, options))
+    return found
+
+
+def find_notebook_jobs(env, docnames):
+    """Return the notebooks to execute for the documents.
+
+    The jobs are (notebook path, evaluated notebook path, skip_exceptions)
+    tuples for the notebooks embedded with the notebook directive, the
+    evaluated notebooks being written next to the documents. The notebooks
+    not to execute (skip_execute) or not found are left to the directive.
+    """
+    jobs = {}
+    for docname in docnames:
+        source_path = os.fspath(env.doc2path(docname))
+        if not source_path.endswith(('.rst', '.md')) or not os.path.isfile(source_path):
+            continue
+        for nb_abs_path, options in find_notebook_directives(source_path):
+            dest_path = os.path.join(os.path.dirname(source_path), os.path.basename(nb_abs_path))
+            if dest_path in jobs or bool(options.get('skip_execute')):
+                continue
+            if not os.path.isfile(nb_abs_path):
+                continue
+            jobs[dest_path] = (nb_abs_path, dest_path, 'skip_exceptions' in options)
+    return list(jobs.values())
+
+
+def split_notebook_jobs(jobs, workers):
+    """Split the notebook jobs between at most workers processes.
+
+    The notebooks of a directory all go to the same worker: they share
+    their side files (see nbbuild_patterns_to_take_along) and data files.
+    """
+    directories = {}
+    for job in jobs:
+        directories.setdefault(os.path.dirname(os.path.abspath(job[0])), []).append(job)
+    shares = [[] for _ in range(min(workers, len(directories)))]
+    # The largest directories first, each to the least loaded worker.
+    for directory_jobs in sorted(directories.values(), key=len, reverse=True):
+        min(shares, key=len).extend(directory_jobs)
+    return shares
+
+
+def run_notebook_jobs(jobs, config):
+    """Execute the notebook jobs (see find_notebook_jobs) with the build settings.
+
+    nbbuild_execution_concurrency notebooks are executed at a time in each
+    of the nbbuild_execution_workers processes, see split_notebook_jobs.
+    """
+    shares = split_notebook_jobs(jobs, max(1, config.nbbuild_execution_workers or 1))
+    workers = len(shares)
+    concurrency = config.nbbuild_execution_concurrency or os.cpu_count()
+    logger.info(f'Executing {len(jobs)} notebooks with {workers} workers '
+                f'running up to {concurrency} notebooks each...')
+    options = execution_options(config)
+    if workers <= 1:
+        execute_notebooks(jobs, concurrency, **options)
+        return
+    # The spawned workers must record their spans in the build profile.
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn'),
+                             initializer=enable_profiling, initargs=(events_dir(),)) as executor:
+        futures = [
+            executor.submit(execute_notebooks, share, concurrency, **options)
+            for share in shares
+        ]
+        for future in as_completed(futures):
+            future.result()
+
+
+def pre_execute_notebooks(app, env, docnames):
+    """Execute the notebooks of the documents about to be read.
+
+    The notebooks embedded with the notebook directive are executed ahead
+    of the read phase, decoupling the execution concurrency from Sphinx's
+    read chunking (see run_notebook_jobs). The directives then only render
+    the evaluated notebooks.
+    """
+    if not app.config.nbbuild_pre_execute:
+        return
+    jobs = [job for job in find_notebook_jobs(env, docnames) if not is_evaluated(job[0], job[1])]
+    if jobs:
+        run_notebook_jobs(jobs, app.config)
 
 
 @contextmanager
@@ -504,18 +1173,46 @@ def patch_project_doc2path(env, nb_path):
         env.project.doc2path = old_doc2path
 
 
-def render_notebook(nb_path, document, preprocessors=[]):
+@contextmanager
+def read_notebook_node(env, ntbk):
+    # myst-nb parses the notebook from the source text with the reader of
+    # its format, the reader is replaced by one returning the notebook
+    # node already in memory, avoiding a JSON round trip.
+    if not hasattr(env, 'mystnb_config'):
+        yield
+        return
+    old_formats = env.mystnb_config.custom_formats
+    env.mystnb_config.custom_formats = dict(old_formats, **{'.ipynb': (lambda text: ntbk, {}, False)})
+    try:
+        yield
+    finally:
+        env.mystnb_config.custom_formats = old_formats
+
+
+def render_notebook(nb_path, document, preprocessors=[], notebook=None):
+    """Render an evaluated notebook into docutils nodes.
+
+    The notebook is read from nb_path (see read_evaluated_notebook)
+    unless the evaluated notebook is passed, which is left unchanged.
+    """
+    with span('notebook.render', notebook=nb_path):
+        return _render_notebook(nb_path, document, preprocessors, notebook)
+
+
+def _render_notebook(nb_path, document, preprocessors, notebook=None):
     env = document.settings.env
     doc = new_document(nb_path, document.settings)
 
-    # Load notebook and run preprocessors
-    with open(nb_path, encoding='utf-8') as f:
-        text = f.read()
-
-    ntbk = nbformat.reads(text, as_version=NOTEBOOK_VERSION)
+    # Load notebook and run preprocessors, only the cells of the slice
+    # being copied before the other preprocessors modify them.
+    ntbk = notebook if notebook is not None else read_evaluated_notebook(nb_path)
+    for preprocessor in preprocessors:
+        if isinstance(preprocessor, NotebookSlice):
+            ntbk, _ = preprocessor(ntbk, {})
+    ntbk = _shallow_copy(ntbk)
     for preprocessor in preprocessors:
-        ntbk, _ = preprocessor(ntbk, {})
-    sio = io.StringIO(json.dumps(ntbk))
+        if not isinstance(preprocessor, NotebookSlice):
+            ntbk, _ = preprocessor(ntbk, {})
 
     parser = Parser()
     if _SPHINX_VERSION >= (9, 0, 0):
@@ -526,12 +1223,171 @@ def render_notebook(nb_path, document, preprocessors=[]):
     else:
         parser.env = env
 
-    with disable_execution(env), patch_project_doc2path(env, nb_path):
-        parser.parse(sio.read(), doc)
+    with disable_execution(env), patch_project_doc2path(env, nb_path), read_notebook_node(env, ntbk):
+        parser.parse('', doc)
 
     return doc.children
 
 
+# Data collected per document in the environment by the notebook
+# directive, purged with the document and merged back from the parallel
+# read workers.
+DOCUMENT_DATA = (
+    'nbsite_execution_stats', 'nbsite_unresolved_links',
+    'nbsite_stored_outputs', 'nbsite_payloads',
+)
+
+
+def _document_data(env, name):
+    if not hasattr(env, name):
+        setattr(env, name, {})
+    return getattr(env, name)
+
+
+def purge_document_data(app, env, docname):
+    for name in DOCUMENT_DATA:
+        if hasattr(env, name):
+            getattr(env, name).pop(docname, None)
+
+
+def merge_document_data(app, env, docnames, other):
+    for name in DOCUMENT_DATA:
+        if not hasattr(other, name):
+            continue
+        data = _document_data(env, name)
+        for docname in docnames:
+            if docname in getattr(other, name):
+                data[docname] = getattr(other, name)[docname]
+
+
+def record_build_start(app):
+    """Record the start of the build, see execution_stats."""
+    app.env.nbsite_build_started = time.time()
+
+
+def record_execution_stats(env, nb_path, notebook):
+    """Keep the execution statistics of a notebook of the current document."""
+    stats = notebook_stats(notebook, os.path.relpath(nb_path, env.srcdir))
+    if stats is None:
+        return
+    _document_data(env, 'nbsite_execution_stats').setdefault(env.docname, {})[nb_path] = stats
+
+
+def record_unresolved_links(env, unresolved):
+    """Keep the notebook links of the current document without a source file."""
+    _document_data(env, 'nbsite_unresolved_links').setdefault(env.docname, []).extend(unresolved)
+
+
+def report_unresolved_links(app, exception):
+    """Log the notebook links without a source file in a single warning."""
+    _source_indexes.pop(app.env.srcdir, None)
+    links = getattr(app.env, 'nbsite_unresolved_links', {})
+    lines = [
+        f'  {docname}: "{nb_filepath}" (path relative to "{rootdir}")'
+        for docname in sorted(links)
+        for nb_filepath, rootdir in dict.fromkeys(links[docname])
+    ]
+    if lines:
+        logger.warning('Source file not found for %d notebook link%s:\n%s',
+                       len(lines), 's' if len(lines) > 1 else '', '\n'.join(lines))
+
+
+def output_store(env) -> OutputStore:
+    """Return the store of the heavy outputs, kept along with the doctrees."""
+    return OutputStore(os.path.join(env.doctreedir, STORE_DIRNAME))
+
+
+def store_rendered_outputs(env, node_list):
+    """Move the heavy outputs of the rendered notebook out of the doctree.
+
+    They are put back when the doctree is resolved for writing, see
+    resolve_stored_outputs.
+    """
+    min_size = env.config.nbbuild_output_store_min_size
+    if min_size is None:
+        return
+    keys = store_outputs(node_list, output_store(env), min_size)
+    if keys:
+        _document_data(env, 'nbsite_stored_outputs').setdefault(env.docname, set()).update(keys)
+
+
+def resolve_stored_outputs(app, doctree, docname):
+    resolve_outputs(doctree, output_store(app.env))
+
+
+def clean_output_store(app, exception):
+    """Remove the stored outputs no longer referenced by a doctree."""
+    if exception is not None:
+        return
+    referenced = set().union(*getattr(app.env, 'nbsite_stored_outputs', {}).values())
+    store = output_store(app.env)
+    store.discard(store.keys() - referenced)
+
+
+def record_payloads(env, node_list):
+    """Count the inline scripts and styles of the rendered notebook.
+
+    The ones found in more than one document of the site are hoisted
+    into static files when the pages are written, see
+    hoist_shared_payloads.
+    """
+    min_size = env.config.nbbuild_shared_payload_min_size
+    if min_size is None:
+        return
+    payloads = _document_data(env, 'nbsite_payloads').setdefault(env.docname, set())
+    for root in node_list:
+        if isinstance(root, nodes.Node):
+            for node in root.findall(nodes.raw):
+                if 'html' in node.get('format', '').split():
+                    payloads.update(find_payloads(node.astext(), min_size))
+
+
+def select_shared_payloads(app, env):
+    """Select the payloads found in more than one document of the site.
+
+    The counts of the whole site are only known once all the documents
+    are read: the documents whose payloads got hoisted or inlined since
+    the previous build are returned to be written again, so that no
+    page references a hoisted file removed by clean_shared_payloads.
+    """
+    payloads = getattr(env, 'nbsite_payloads', {})
+    # The number of documents a payload is found in, not of occurrences.
+    counts = Counter()
+    for doc_payloads in payloads.values():
+        counts.update(set(doc_payloads))
+    shared = {digest for digest, count in counts.items() if count > 1}
+    changed = shared ^ getattr(env, 'nbsite_shared_payloads', set())
+    env.nbsite_shared_payloads = shared
+    return [docname for docname, doc_payloads in payloads.items() if changed.intersection(doc_payloads)]
+
+
+def hoist_shared_payloads(app, doctree, docname):
+    """Replace the shared inline scripts and styles of a page by static files."""
+    min_size = app.config.nbbuild_shared_payload_min_size
+    shared = getattr(app.env, 'nbsite_shared_payloads', None)
+    if min_size is None or not shared or app.builder.format != 'html':
+        return
+    static_dir = os.path.join(app.outdir, '_static', SHARED_STATIC_DIRNAME)
+    static_url = relative_uri(app.builder.get_target_uri(docname), f'_static/{SHARED_STATIC_DIRNAME}')
+    for node in list(doctree.findall(nodes.raw)):
+        if 'html' not in node.get('format', '').split():
+            continue
+        text = node.astext()
+        hoisted = hoist_payloads(text, shared, static_dir, static_url, min_size)
+        if hoisted != text:
+            node.replace_self(nodes.raw(node.rawsource, hoisted, **node.attributes))
+
+
+def clean_shared_payloads(app, exception):
+    """Remove the hoisted files no longer shared by the pages."""
+    if exception is not None or app.builder.format != 'html':
+        return
+    shared = set()
+    if app.config.nbbuild_shared_payload_min_size is not None:
+        shared = getattr(app.env, 'nbsite_shared_payloads', set())
+    remove_unused(os.path.join(app.outdir, '_static', SHARED_STATIC_DIRNAME), shared)
+
+
 class NotebookDirective(Directive):
     """Insert an evaluated notebook into a document
 
@@ -578,7 +1434,11 @@ class NotebookDirective(Directive):
         return link_rst
 
     def preprocessors(self, dest_dir):
-        preprocessors = [FixBackticksInDetails(), FixNotebookLinks(dest_dir)]
+        env = self.state.document.settings.env
+        preprocessors = [
+            FixBackticksInDetails(),
+            FixNotebookLinks(dest_dir, source_index=get_source_index(env.srcdir)),
+        ]
         if self.options.get('substring') or self.options.get('offset'):
             preprocessors.append(
                 NotebookSlice(
@@ -592,16 +1452,17 @@ class NotebookDirective(Directive):
         return preprocessors
 
     def interactivity_warning(self, nb_abs_path):
-        project_name = os.environ.get('PROJECT_NAME','')
-        project_root = os.environ.get('PROJECT_ROOT','')
-        host = os.environ.get('HOST','GitHub')
-        branch = os.environ.get('BRANCH','main')
-        repo = os.environ.get('REPO','')
-        org = os.environ.get('ORG','')
-        doc = os.environ.get('DOC','doc')
-        examples = os.environ.get('EXAMPLES','examples')
-        examples_assets = os.environ.get('EXAMPLES_ASSETS','assets')
-        binder = os.environ.get('BINDER','none')
+        context = build_context(self.state.document.settings.env.config)
+        project_name = context['project_name']
+        project_root = context['project_root']
+        host = context['host']
+        branch = context['branch']
+        repo = context['repo']
+        org = context['org']
+        doc = context['doc']
+        examples = context['examples']
+        examples_assets = context['examples_assets']
+        binder = context['binder']
 
         if repo == '' or project_name == '':
             project_name = repo = project_name or repo
@@ -635,27 +1496,29 @@ class NotebookDirective(Directive):
 
         os.makedirs(dest_dir, exist_ok=True)
 
-        # Evaluate Notebook and insert into Sphinx doc
-        import zmq
-        for n in range(1, 6):
-            try:
-                evaluate_notebook(
-                    nb_abs_path, dest_path,
-                    skip_exceptions='skip_exceptions' in self.options,
-                    skip_execute=self.options.get('skip_execute'),
-                    timeout=setup.config.nbbuild_cell_timeout,
-                    ipython_startup=setup.config.nbbuild_ipython_startup,
-                    patterns_to_take_with_me=setup.config.nbbuild_patterns_to_take_along
-                )
-                break
-            except (zmq.error.ZMQError, RuntimeError) as e:
-                # Sometimes the kernel dies
-                print(f"{nb_abs_path} failed with {e}, retrying ({n}/5)...", flush=True)
+        # Evaluate Notebook and insert into Sphinx doc, the evaluated
+        # notebook being written while it is rendered.
+        notebook = evaluate_notebook_retrying(
+            nb_abs_path, dest_path,
+            skip_exceptions='skip_exceptions' in self.options,
+            skip_execute=self.options.get('skip_execute'),
+            background_write=True,
+            **execution_options(self.state.document.settings.env.config)
+        )
+
+        if notebook is None:
+            notebook = read_evaluated_notebook(dest_path)
+        record_execution_stats(self.state.document.settings.env, nb_abs_path, notebook)
 
         preprocessors = self.preprocessors(dest_dir)
         rendered_nodes = render_notebook(
-            dest_path, self.state.document, preprocessors
+            dest_path, self.state.document, preprocessors, notebook=notebook
         )
+        record_payloads(self.state.document.settings.env, rendered_nodes)
+        store_rendered_outputs(self.state.document.settings.env, rendered_nodes)
+        for preprocessor in preprocessors:
+            if isinstance(preprocessor, FixNotebookLinks) and preprocessor.unresolved:
+                record_unresolved_links(self.state.document.settings.env, preprocessor.unresolved)
 
         link_rst = self.link_rst(nb_basename, nb_abs_path, dest_path)
         if 'disable_interactivity_warning' not in self.options:
@@ -666,25 +1529,59 @@ class NotebookDirective(Directive):
             include_lines = string2lines(link_rst, convert_whitespace=True)
             self.state_machine.insert_input(include_lines, rst_file)
 
-        # add dependency
+        # add dependencies, the evaluated notebook being removed (e.g. with
+        # --overwrite) must trigger a rebuild of the page, as well as a
+        # change of the data files read by the notebook.
         self.state.document.settings.record_dependencies.add(nb_abs_path)
-
-        # TODO: doubt this is doing anything
-        # clean up png files left behind by notebooks.
-        png_files = glob.glob("*.png")
-        for file in png_files:
-            os.remove(file)
+        self.state.document.settings.record_dependencies.add(dest_path)
+        for path in notebook_dependencies(notebook, nb_filepath):
+            self.state.document.settings.record_dependencies.add(path)
 
         return rendered_nodes
 
 
 def setup(app):
-    setup.app = app
-    setup.config = app.config
-    setup.confdir = app.confdir
-
     app.add_config_value('nbbuild_cell_timeout',300,'html')
     app.add_config_value('nbbuild_ipython_startup',"from nbsite.ipystartup import *",'html')
     app.add_config_value('nbbuild_patterns_to_take_along',["*.json", "json_*"],'html')
-
+    app.add_config_value('nbbuild_cache_dir','','html')
+    app.add_config_value('nbbuild_cache_max_size',DEFAULT_MAX_SIZE,'html')
+    app.add_config_value('nbbuild_env_fingerprint','','html')
+
+    app.add_config_value('nbbuild_pre_execute',True,'html')
+    app.add_config_value('nbbuild_execution_workers',None,'html')
+    app.add_config_value('nbbuild_execution_concurrency',None,'html')
+    app.add_config_value('nbbuild_kernel_pool_size',0,'html')
+    app.add_config_value('nbbuild_output_store_min_size',OUTPUT_STORE_MIN_SIZE,'env')
+    app.add_config_value('nbbuild_shared_payload_min_size',SHARED_PAYLOAD_MIN_SIZE,'env')
+    for name in BUILD_CONTEXT:
+        app.add_config_value(f'nbbuild_{name}',None,'env')
+
+    app.add_node(stored_output)
     app.add_directive('notebook', NotebookDirective)
+    # Before the gallery executes notebooks for their thumbnails.
+    app.connect('builder-inited', record_build_start, priority=100)
+    app.connect('env-before-read-docs', pre_execute_notebooks)
+    app.connect('env-before-read-docs', build_source_index)
+    app.connect('env-purge-doc', purge_document_data)
+    app.connect('env-merge-info', merge_document_data)
+    app.connect('env-updated', select_shared_payloads)
+    # The stored outputs are put back before their payloads are hoisted.
+    app.connect('doctree-resolved', resolve_stored_outputs)
+    app.connect('doctree-resolved', hoist_shared_payloads)
+    # The evaluated notebooks written in the background must be on disk
+    # once their document is read, e.g. before a read worker exits.
+    app.connect('doctree-read', wait_for_notebook_writes)
+    app.connect('build-finished', clear_parsed_notebooks)
+    app.connect('build-finished', report_unresolved_links)
+    app.connect('build-finished', clean_output_store)
+    app.connect('build-finished', clean_shared_payloads)
+
+    # The directive state is local to the document being read: notebooks
+    # are evaluated to files next to it and the dependencies are recorded
+    # in the document settings, merged back by Sphinx.
+    return {
+        "version": nbs_version,
+        "parallel_read_safe": True,
+        "parallel_write_safe": True,
+    }
@@ -0,0 +1,274 @@
+"""
+Persistent, content-addressed cache of executed notebooks.
+
+Evaluated notebooks (and the side files moved along with them, see
+``nbbuild_patterns_to_take_along``) are stored in a directory outside of
+the doc tree, keyed on a hash of everything that influences the
+execution result. The cache is therefore shared across branches,
+checkouts and output directories, and a notebook whose code is identical
+to a previous run is never executed again: the markdown and raw cells
+of a notebook that only differs by them are merged into the outputs of
+the previous run (see ``merge_outputs``).
+
+The cache is bounded in size, the least recently used entries being
+evicted first.
+"""
+from __future__ import annotations
+
+import functools
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+
+import nbformat
+import portalocker
+
+DEFAULT_MAX_SIZE = 5 * 1024 ** 3
+
+# Fraction of max_size the cache is brought back to when evicting, so
+# that the entries are not scanned again on every store of a full cache.
+EVICTION_TARGET = 0.9
+
+NOTEBOOK_FILENAME = 'notebook.ipynb'
+FILES_DIRNAME = 'files'
+
+
+def default_cache_dir() -> str:
+    """Return the default location of the notebook cache.
+
+    ``NBSITE_CACHE_DIR`` takes precedence, then ``XDG_CACHE_HOME`` and
+    finally ``~/.cache``.
+    """
+    if os.environ.get('NBSITE_CACHE_DIR'):
+        return os.environ['NBSITE_CACHE_DIR']
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'nbsite', 'notebooks')
+
+
+# Describes the environment of a Python executable: its version and the
+# distributions installed, see environment_fingerprint.
+ENVIRONMENT_CODE = """\
+import importlib.metadata, sys
+print(sys.version)
+for dist in sorted(set('%s==%s' % (d.metadata['Name'], d.version) for d in importlib.metadata.distributions())):
+    print(dist)
+"""
+
+
+@functools.lru_cache
+def environment_fingerprint(executable=None) -> str:
+    """Return a hash of the Python environment of executable.
+
+    The version of Python and the distributions installed in the
+    environment (defaults to the one of this process) are hashed, so that
+    the cache keys change when a package is upgraded.
+    """
+    result = subprocess.run(
+        [executable or sys.executable, '-c', ENVIRONMENT_CODE],
+        capture_output=True, text=True, check=True,
+    )
+    return hashlib.sha256(result.stdout.encode('utf-8')).hexdigest()
+
+
+# Bumped when the key computation changes.
+KEY_VERSION = 2
+
+# Cell metadata changing how a code cell is executed.
+EXECUTION_METADATA = ('tags',)
+
+# Notebook and cell metadata recorded by the execution, see merge_outputs.
+EXECUTED_METADATA = ('language_info', 'widgets', 'execution', 'nbsite')
+
+
+def notebook_cache_key(notebook, ipython_startup=None, kernel_name=None,
+                       env_fingerprint=None, allow_errors=False) -> str:
+    """Compute the cache key of a notebook execution.
+
+    Only the code cells (their source, order and tags) are part of the
+    key, the other cells not influencing the execution.
+
+    Parameters
+    ----------
+    notebook: NotebookNode | str
+        The source (unevaluated) notebook, or its path.
+    ipython_startup: str | None
+        Code executed in the kernel before the first cell.
+    kernel_name: str | None
+        Name of the kernel the notebook is executed with.
+    env_fingerprint: str | None
+        String identifying the execution environment, e.g. the
+        environment_fingerprint of the kernel or a hash of a lock file.
+    allow_errors: bool
+        Whether cell errors are recorded as outputs instead of aborting.
+    """
+    if not isinstance(notebook, nbformat.NotebookNode):
+        notebook = nbformat.read(notebook, as_version=4)
+    h = hashlib.sha256()
+    h.update(repr(KEY_VERSION).encode('utf-8'))
+    for cell in notebook.cells:
+        if cell.cell_type != 'code':
+            continue
+        metadata = {name: cell.metadata.get(name) for name in EXECUTION_METADATA}
+        h.update(b'\0')
+        h.update(cell.source.encode('utf-8'))
+        h.update(b'\0')
+        h.update(repr(sorted(metadata.items())).encode('utf-8'))
+    for part in (ipython_startup, kernel_name, env_fingerprint, bool(allow_errors)):
+        h.update(b'\0')
+        h.update(repr(part).encode('utf-8'))
+    return h.hexdigest()
+
+
+def merge_outputs(notebook, evaluated):
+    """Return the notebook with the outputs of an evaluated notebook.
+
+    The evaluated notebook must have the same code cells (see
+    notebook_cache_key), the cells of notebook are kept with the outputs
+    of the code cells and the metadata recorded by the execution taken
+    from evaluated.
+    """
+    merged = nbformat.NotebookNode(notebook)
+    merged.metadata = nbformat.NotebookNode(notebook.metadata)
+    for name in EXECUTED_METADATA:
+        if name in evaluated.metadata:
+            merged.metadata[name] = evaluated.metadata[name]
+    executed = iter([cell for cell in evaluated.cells if cell.cell_type == 'code'])
+    merged.cells = []
+    for cell in notebook.cells:
+        if cell.cell_type == 'code':
+            cell = nbformat.NotebookNode(cell)
+            executed_cell = next(executed)
+            cell.outputs = executed_cell.outputs
+            cell.execution_count = executed_cell.execution_count
+            cell.metadata = nbformat.NotebookNode(cell.metadata)
+            for name in EXECUTED_METADATA:
+                if name in executed_cell.metadata:
+                    cell.metadata[name] = executed_cell.metadata[name]
+        merged.cells.append(cell)
+    return merged
+
+
+def _dir_size(path) -> int:
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return size
+
+
+class NotebookCache:
+    """
+    Store of evaluated notebooks keyed by ``notebook_cache_key``.
+
+    Each entry is a directory containing the evaluated notebook and the
+    side files it produced. Writes are atomic so that several builds can
+    share the same cache concurrently.
+    """
+
+    def __init__(self, cache_dir=None, max_size=DEFAULT_MAX_SIZE):
+        self.cache_dir = os.path.abspath(cache_dir or default_cache_dir())
+        self.max_size = max_size
+        # Size of the cache as of the last eviction plus the entries
+        # stored since by this process, None until the first eviction.
+        self._size = None
+        self._size_lock = threading.Lock()
+
+    def _entry_dir(self, key) -> str:
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def __contains__(self, key) -> bool:
+        return os.path.isfile(os.path.join(self._entry_dir(key), NOTEBOOK_FILENAME))
+
+    def load(self, key, dest_dir):
+        """Return the cached notebook, copying its side files to dest_dir.
+
+        Returns None when the entry was not found.
+        """
+        entry = self._entry_dir(key)
+        try:
+            notebook = nbformat.read(os.path.join(entry, NOTEBOOK_FILENAME), as_version=4)
+        except FileNotFoundError:
+            return None
+        self._restore(entry, dest_dir)
+        return notebook
+
+    def _restore(self, entry, dest_dir):
+        files_dir = os.path.join(entry, FILES_DIRNAME)
+        if os.path.isdir(files_dir):
+            shutil.copytree(files_dir, dest_dir, dirs_exist_ok=True)
+        try:
+            # The entry mtime records the last access, used for LRU eviction.
+            os.utime(entry)
+        except OSError:
+            pass
+
+    def store(self, key, nb_path, side_files=()):
+        """Add an evaluated notebook and its side files to the cache."""
+        entry = self._entry_dir(key)
+        if key in self:
+            return
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix='.tmp-', dir=os.path.dirname(entry))
+        try:
+            shutil.copyfile(nb_path, os.path.join(tmp, NOTEBOOK_FILENAME))
+            files_dir = os.path.join(tmp, FILES_DIRNAME)
+            for path in side_files:
+                target = os.path.join(files_dir, os.path.basename(path))
+                os.makedirs(files_dir, exist_ok=True)
+                if os.path.isdir(path):
+                    shutil.copytree(path, target)
+                else:
+                    shutil.copyfile(path, target)
+            size = _dir_size(tmp)
+            try:
+                os.rename(tmp, entry)
+            except OSError:
+                # Another build stored the same entry in the meantime.
+                return
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        with self._size_lock:
+            if self._size is not None:
+                self._size += size
+            # The cache is only scanned when it may exceed max_size.
+            if self.max_size is not None and (self._size is None or self._size > self.max_size):
+                self.evict()
+
+    def discard(self, key):
+        """Remove an entry from the cache, e.g. once found outdated."""
+        shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits max_size.
+
+        The cache is brought back to EVICTION_TARGET of max_size.
+        """
+        if self.max_size is None or not os.path.isdir(self.cache_dir):
+            return
+        with portalocker.Lock(os.path.join(self.cache_dir, '.lock'), 'a', timeout=60):
+            entries = []
+            for shard in os.scandir(self.cache_dir):
+                if not shard.is_dir():
+                    continue
+                for entry in os.scandir(shard.path):
+                    if entry.is_dir() and not entry.name.startswith('.tmp-'):
+                        entries.append((entry.stat().st_mtime, _dir_size(entry.path), entry.path))
+            total = sum(size for _, size, _ in entries)
+            if total > self.max_size:
+                for _, size, path in sorted(entries):
+                    if total <= self.max_size * EVICTION_TARGET:
+                        break
+                    shutil.rmtree(path, ignore_errors=True)
+                    total -= size
+            self._size = total
+
+    def clear(self):
+        """Remove every entry from the cache."""
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
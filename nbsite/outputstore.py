@@ -0,0 +1,116 @@
+"""
+Out-of-band storage of the heavy outputs of the rendered notebooks.
+
+The raw HTML of the notebook outputs (e.g. the HTML and JSON of a bokeh
+or holoviews plot) can weigh megabytes per page. Kept in the doctrees,
+it is pickled to the doctree files and shipped between the Sphinx
+worker processes. The outputs larger than ``nbbuild_output_store_min_size``
+are instead written once to a content-addressed store next to the
+doctrees and replaced by ``stored_output`` placeholder nodes when the
+notebook is rendered (see ``store_outputs``), the payloads being put
+back when the doctrees are resolved for writing (see
+``resolve_outputs``).
+"""
+from __future__ import annotations
+
+import hashlib
+import os
+import tempfile
+
+from docutils import nodes
+
+# Directory of the store, relative to the doctrees directory.
+STORE_DIRNAME = 'nbsite_outputs'
+
+DEFAULT_MIN_SIZE = 16 * 1024
+
+
+class stored_output(nodes.General, nodes.Element):
+    """Placeholder of a raw node whose text is kept in an OutputStore."""
+
+
+class OutputStore:
+    """
+    Content-addressed store of the outputs, keyed on their SHA-256.
+
+    Writes are atomic so that the parallel read workers can store the
+    same output concurrently.
+    """
+
+    def __init__(self, directory):
+        self.directory = os.fspath(directory)
+
+    def _path(self, key) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def put(self, text: str) -> str:
+        """Store text and return its key."""
+        data = text.encode('utf-8')
+        key = hashlib.sha256(data).hexdigest()
+        path = self._path(key)
+        if not os.path.isfile(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(path))
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp, path)
+            except BaseException:
+                os.remove(tmp)
+                raise
+        return key
+
+    def get(self, key) -> str:
+        """Return the text stored under key."""
+        with open(self._path(key), encoding='utf-8') as f:
+            return f.read()
+
+    def keys(self) -> set[str]:
+        """Return the keys of all the stored outputs."""
+        keys = set()
+        if os.path.isdir(self.directory):
+            for shard in os.scandir(self.directory):
+                if shard.is_dir():
+                    keys.update(e.name for e in os.scandir(shard.path) if not e.name.startswith('.tmp-'))
+        return keys
+
+    def discard(self, keys):
+        """Remove the outputs stored under keys."""
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+
+def store_outputs(node_list, store, min_size=DEFAULT_MIN_SIZE) -> set[str]:
+    """Replace the large raw nodes in node_list by placeholders, in place.
+
+    Returns the keys of the stored outputs.
+    """
+    keys = set()
+    for root in node_list:
+        if not isinstance(root, nodes.Node):
+            continue
+        for node in list(root.findall(nodes.raw)):
+            text = node.astext()
+            if len(text) < min_size:
+                continue
+            key = store.put(text)
+            placeholder = stored_output(key=key, format=node.get('format', ''), **{
+                name: node[name] for name in node.basic_attributes if node[name]
+            })
+            if node is root:
+                node_list[node_list.index(node)] = placeholder
+            else:
+                node.replace_self(placeholder)
+            keys.add(key)
+    return keys
+
+
+def resolve_outputs(doctree, store):
+    """Put the stored outputs back in place of their placeholders."""
+    for placeholder in list(doctree.findall(stored_output)):
+        attributes = {name: placeholder[name] for name in placeholder.basic_attributes if placeholder[name]}
+        text = store.get(placeholder['key'])
+        placeholder.replace_self(nodes.raw('', text, format=placeholder['format'], **attributes))
@@ -0,0 +1,282 @@
+"""
+Memory-aware scheduling of the Sphinx parallel read and write workers.
+
+Sphinx forks one worker per chunk of documents, up to the number of
+processes it is given. With notebook-heavy chunks the workers (and the
+kernels they start) can exhaust the memory of the machine and get
+killed, failing the whole build. MemoryAwareParallelTasks replaces
+Sphinx's ParallelTasks during a build to:
+
+* resubmit the chunk of a worker that died to a fresh worker;
+* when a memory budget is given (and psutil is installed), watch the
+  memory used by the workers and their children, only start a new
+  worker when it is expected to fit in the budget and stop the most
+  recently started worker, resubmitting its chunk later, when the
+  budget is exceeded.
+
+Every recovery is reported as a warning and collected in the list
+yielded by ``memory_aware_parallel``.
+"""
+from __future__ import annotations
+
+import multiprocessing
+import re
+import threading
+import time
+
+from contextlib import contextmanager
+
+import sphinx.builders
+
+from sphinx.errors import SphinxParallelError
+from sphinx.util import logging
+from sphinx.util.parallel import ParallelTasks
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two samples of the workers memory.
+SAMPLE_INTERVAL = 0.5
+
+_SIZE_RE = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?\s*$', re.IGNORECASE)
+_SIZE_UNITS = {'': 1, 'k': 1024, 'm': 1024**2, 'g': 1024**3, 't': 1024**4}
+
+
+def parse_memory_size(size) -> int | None:
+    """Convert a memory size like 512M or 16GiB to a number of bytes."""
+    if size is None or isinstance(size, int):
+        return size
+    match = _SIZE_RE.match(str(size))
+    if not match:
+        raise ValueError(f'Invalid memory size {size!r}, expected e.g. 512M or 16G')
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2).lower()])
+
+
+def _format_size(size) -> str:
+    return f'{size / 1024**2:.0f}MiB'
+
+
+def _process_memory(pid) -> int:
+    """Memory used by a process and its children (e.g. kernels) in bytes."""
+    try:
+        proc = psutil.Process(pid)
+        processes = [proc] + proc.children(recursive=True)
+    except psutil.Error:
+        return 0
+    total = 0
+    for p in processes:
+        try:
+            # The unique set size does not count the pages shared with the
+            # parent process after the fork.
+            total += p.memory_full_info().uss
+        except psutil.AccessDenied:
+            total += p.memory_info().rss
+        except psutil.Error:
+            pass
+    return total
+
+
+def _kill_process_tree(proc):
+    if psutil is not None:
+        try:
+            children = psutil.Process(proc.pid).children(recursive=True)
+        except psutil.Error:
+            children = []
+        for child in children:
+            try:
+                child.kill()
+            except psutil.Error:
+                pass
+    proc.terminate()
+    proc.join()
+
+
+class MemoryAwareParallelTasks(ParallelTasks):
+    """
+    ParallelTasks resubmitting the chunks of dead workers and keeping the
+    workers within a memory budget.
+
+    Parameters
+    ----------
+    nproc: int
+        Maximum number of concurrent workers.
+    max_memory: int | None
+        Memory budget of the workers in bytes, None for no budget.
+    max_retries: int
+        Number of times the chunk of a dead worker is resubmitted before
+        failing the build.
+    events: list | None
+        List the recovery events are appended to.
+    """
+
+    def __init__(self, nproc, max_memory=None, max_retries=2, events=None):
+        super().__init__(nproc)
+        self.max_memory = max_memory if psutil is not None else None
+        self.max_retries = max_retries
+        self.events = [] if events is None else events
+        self._funcs = {}
+        self._failures = {}
+        self._started = {}
+        self._memory = {}
+        self._peak_memory = 0
+        self._last_sample = 0
+
+    def add_task(self, task_func, arg=None, result_func=None):
+        self._funcs[self._taskid] = task_func
+        super().add_task(task_func, arg, result_func)
+
+    def _join_one(self) -> bool:
+        joined_any = False
+        for tid, pipe in self._precvs.items():
+            proc = self._procs[tid]
+            if pipe.poll():
+                try:
+                    exc, logs, result = pipe.recv()
+                except EOFError:
+                    self._recover(tid, 'died')
+                    joined_any = True
+                    break
+                if exc:
+                    raise SphinxParallelError(*result)
+                for log in logs:
+                    logger.handle(log)
+                self._result_funcs.pop(tid)(self._args.pop(tid), result)
+                proc.join()
+                self._precvs.pop(tid)
+                self._forget(tid)
+                self._pworking -= 1
+                joined_any = True
+                break
+            # The result is sent before the worker exits, so a worker that
+            # exited with nothing to read died (e.g. killed by the OOM killer).
+            if proc.exitcode is not None and not pipe.poll():
+                self._recover(tid, 'died')
+                joined_any = True
+                break
+
+        self._watch_memory()
+        while self._precvs_waiting and self._pworking < self.nproc:
+            if self._pworking and not self._fits_in_budget():
+                break
+            newtid, newprecv = self._precvs_waiting.popitem()
+            self._precvs[newtid] = newprecv
+            self._procs[newtid].start()
+            self._started[newtid] = time.monotonic()
+            self._pworking += 1
+
+        return joined_any
+
+    def _forget(self, tid):
+        self._funcs.pop(tid, None)
+        self._failures.pop(tid, None)
+        self._started.pop(tid, None)
+        self._memory.pop(tid, None)
+
+    def _recover(self, tid, reason):
+        proc = self._procs[tid]
+        if reason == 'died':
+            proc.join()
+            self._failures[tid] = self._failures.get(tid, 0) + 1
+            if self._failures[tid] > self.max_retries:
+                raise SphinxParallelError(
+                    f'parallel worker died {self._failures[tid]} times '
+                    f'(exit code {proc.exitcode}) while processing {self._args[tid]!r}', ''
+                )
+        else:
+            _kill_process_tree(proc)
+        event = {
+            'reason': reason,
+            'exitcode': proc.exitcode,
+            'memory': self._memory.get(tid, 0),
+            'attempt': self._failures.get(tid, 0),
+            'arg': self._args[tid],
+        }
+        self.events.append(event)
+        logger.warning(
+            'parallel worker %s (exit code %s, %s), resubmitting its chunk to a fresh worker',
+            reason, event['exitcode'], _format_size(event['memory']),
+        )
+        self._precvs.pop(tid).close()
+        self._started.pop(tid, None)
+        self._memory.pop(tid, None)
+        self._pworking -= 1
+        precv, psend = multiprocessing.Pipe(False)
+        context = multiprocessing.get_context('fork')
+        self._procs[tid] = context.Process(
+            target=self._process, args=(psend, self._funcs[tid], self._args[tid])
+        )
+        self._precvs_waiting[tid] = precv
+
+    def _fits_in_budget(self) -> bool:
+        if self.max_memory is None:
+            return True
+        # Workers not sampled yet are expected to use as much as the
+        # largest worker seen so far.
+        used = sum(self._memory.get(tid, self._peak_memory) for tid in self._precvs)
+        return used + self._peak_memory <= self.max_memory
+
+    def _watch_memory(self):
+        if self.max_memory is None or not self._precvs:
+            return
+        now = time.monotonic()
+        if now - self._last_sample < SAMPLE_INTERVAL:
+            return
+        self._last_sample = now
+        for tid in self._precvs:
+            memory = _process_memory(self._procs[tid].pid)
+            self._memory[tid] = memory
+            self._peak_memory = max(self._peak_memory, memory)
+        if self._pworking > 1 and sum(self._memory.values()) > self.max_memory:
+            # The most recently started worker loses the least work.
+            newest = max(self._started, key=self._started.get)
+            self._recover(newest, 'stopped over the memory budget')
+
+
+_local = threading.local()
+_installed = 0
+_install_lock = threading.Lock()
+
+
+def _parallel_tasks(nproc):
+    # Sphinx creates the tasks in the thread running the build, so that
+    # concurrent builds each get their own settings.
+    settings = getattr(_local, 'settings', None)
+    if settings is None:
+        return ParallelTasks(nproc)
+    return MemoryAwareParallelTasks(nproc, **settings)
+
+
+@contextmanager
+def memory_aware_parallel(max_memory=None, max_retries=2):
+    """Schedule the Sphinx parallel workers with MemoryAwareParallelTasks.
+
+    Applies to the builds run by the current thread, yielding the list
+    the recovery events are appended to. While in use by any thread,
+    sphinx.builders.ParallelTasks is replaced by a factory creating the
+    tasks with the settings of the thread running the build, the builds
+    of the other threads getting Sphinx's ParallelTasks.
+    """
+    global _installed
+    max_memory = parse_memory_size(max_memory)
+    if max_memory is not None and psutil is None:
+        logger.warning('psutil is required to limit the memory used by the parallel workers, '
+                       'install it to enable --max-memory')
+    events = []
+    previous = getattr(_local, 'settings', None)
+    _local.settings = dict(max_memory=max_memory, max_retries=max_retries, events=events)
+    with _install_lock:
+        if not _installed:
+            sphinx.builders.ParallelTasks = _parallel_tasks
+        _installed += 1
+    try:
+        yield events
+    finally:
+        _local.settings = previous
+        with _install_lock:
+            _installed -= 1
+            if not _installed:
+                sphinx.builders.ParallelTasks = ParallelTasks
@@ -0,0 +1,250 @@
+"""
+Timing report of a build, enabled with ``nbsite build --profile``.
+
+Phases of the build are wrapped in ``span`` context managers which are
+no-ops unless profiling is enabled. Every process (including the
+notebook pre-execution workers and the Sphinx parallel read/write
+workers) appends its spans to its own file in the events directory, and
+``write_report`` merges them into:
+
+* ``profile.json``: the time spent per phase and the individual spans,
+  longest first.
+* ``profile.trace.json``: a Chrome trace, which can be opened with
+  chrome://tracing, https://ui.perfetto.dev or https://speedscope.app.
+
+The events directory is a context variable, so that the builds running
+concurrently in threads of a process each have their own profile. The
+threads the build hands work over to do not inherit it, the functions
+they run being bound to the profile of the build with ``bind``.
+"""
+from __future__ import annotations
+
+import functools
+import glob
+import json
+import os
+import shutil
+import threading
+import time
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+REPORT_FILENAME = 'profile.json'
+TRACE_FILENAME = 'profile.trace.json'
+EVENTS_DIRNAME = 'events'
+
+_events_dir = ContextVar('nbsite_profile_events_dir', default=None)
+_lock = threading.Lock()
+
+
+def enable(events_dir):
+    """Record the spans of the current context in events_dir (None disables it).
+
+    The context is e.g. the main thread of a worker process.
+    """
+    if events_dir is not None:
+        os.makedirs(events_dir, exist_ok=True)
+    _events_dir.set(events_dir)
+
+
+def disable():
+    """Stop recording spans."""
+    enable(None)
+
+
+def events_dir():
+    """Return the directory the spans are recorded in, None if disabled."""
+    return _events_dir.get()
+
+
+def bind(func):
+    """Return func recording its spans in the profile of the caller.
+
+    To be used for the functions run in other threads, e.g. by a
+    ThreadPoolExecutor, which do not inherit the context of the caller.
+    """
+    events = _events_dir.get()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        token = _events_dir.set(events)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _events_dir.reset(token)
+    return wrapper
+
+
+def _record(events, event):
+    path = os.path.join(events, f'events-{os.getpid()}.jsonl')
+    line = json.dumps(event, default=str) + '\n'
+    with _lock, open(path, 'a', encoding='utf-8') as f:
+        f.write(line)
+
+
+@contextmanager
+def span(name, **args):
+    """Time the enclosed block, the category being the name prefix.
+
+    Extra keyword arguments (e.g. the notebook path) are stored along with
+    the timing and used to break down the report.
+    """
+    events = _events_dir.get()
+    if events is None:
+        yield
+        return
+    start = time.time()
+    counter = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record(events, {
+            'name': name,
+            'cat': name.split('.')[0],
+            'ts': start,
+            'dur': time.perf_counter() - counter,
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'args': args,
+        })
+
+
+def _timed(method, name, arg_name=None):
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        span_args = {arg_name: args[0]} if arg_name and args else {}
+        with span(name, **span_args):
+            return method(*args, **kwargs)
+    return wrapper
+
+
+def profile_builder(builder):
+    """Time the read and write phases of a Sphinx builder, per document.
+
+    The methods are wrapped on the instance so that they are timed in the
+    forked parallel workers too.
+    """
+    builder.read = _timed(builder.read, 'sphinx.read')
+    builder.read_doc = _timed(builder.read_doc, 'sphinx.read_doc', 'docname')
+    builder.write = _timed(builder.write, 'sphinx.write')
+    builder.write_doc = _timed(builder.write_doc, 'sphinx.write_doc', 'docname')
+    builder.finish = _timed(builder.finish, 'sphinx.finish')
+
+
+def load_events(events_dir):
+    """Load the spans recorded in events_dir, sorted by start time."""
+    events = []
+    for path in glob.glob(os.path.join(events_dir, 'events-*.jsonl')):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                # A worker killed mid-write leaves a truncated line.
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    pass
+    return sorted(events, key=lambda e: e['ts'])
+
+
+def summarize(events):
+    """Aggregate the spans per name: count, total and maximum duration."""
+    phases = {}
+    for event in events:
+        phase = phases.setdefault(event['name'], {
+            'name': event['name'], 'category': event['cat'],
+            'count': 0, 'total': 0.0, 'max': 0.0,
+        })
+        phase['count'] += 1
+        phase['total'] += event['dur']
+        phase['max'] = max(phase['max'], event['dur'])
+    return sorted(phases.values(), key=lambda p: p['total'], reverse=True)
+
+
+def summarize_gallery_sections(events):
+    """Aggregate the thumbnail fetch and generation time per gallery section."""
+    sections = {}
+    for event in events:
+        if not event['name'].startswith('gallery.thumbnail_'):
+            continue
+        args = event['args']
+        key = (args.get('gallery'), args.get('section'), args.get('backend'))
+        section = sections.setdefault(key, {
+            'gallery': key[0], 'section': key[1], 'backend': key[2],
+            'items': 0, 'fetch': 0.0, 'generate': 0.0,
+        })
+        if event['name'] == 'gallery.thumbnail_fetch':
+            section['items'] += 1
+            section['fetch'] += event['dur']
+        else:
+            section['generate'] += event['dur']
+    return sorted(sections.values(), key=lambda s: s['fetch'] + s['generate'], reverse=True)
+
+
+def write_report(profile_dir):
+    """Merge the recorded spans into the JSON report and the Chrome trace.
+
+    Returns the path to the JSON report.
+    """
+    events = load_events(os.path.join(profile_dir, EVENTS_DIRNAME))
+    t0 = events[0]['ts'] if events else 0
+    wall = max((e['ts'] + e['dur'] for e in events), default=t0) - t0
+    report = {
+        'wall_time': wall,
+        'phases': summarize(events),
+        'gallery_sections': summarize_gallery_sections(events),
+        'spans': [
+            {
+                'name': e['name'], 'category': e['cat'], 'start': e['ts'] - t0,
+                'duration': e['dur'], 'pid': e['pid'], 'args': e['args'],
+            }
+            for e in sorted(events, key=lambda e: e['dur'], reverse=True)
+        ],
+    }
+    report_path = os.path.join(profile_dir, REPORT_FILENAME)
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=1, default=str)
+
+    trace = {
+        'displayTimeUnit': 'ms',
+        'traceEvents': [
+            {
+                'name': e['name'], 'cat': e['cat'], 'ph': 'X',
+                'ts': (e['ts'] - t0) * 1e6, 'dur': e['dur'] * 1e6,
+                'pid': e['pid'], 'tid': e['tid'], 'args': e['args'],
+            }
+            for e in events
+        ],
+    }
+    with open(os.path.join(profile_dir, TRACE_FILENAME), 'w', encoding='utf-8') as f:
+        json.dump(trace, f, default=str)
+    return report_path
+
+
+def print_summary(report_path, limit=10):
+    """Print the phases taking the longest time from a JSON report."""
+    with open(report_path, encoding='utf-8') as f:
+        report = json.load(f)
+    print('Build profile ({:.1f}s wall time) written to {}'.format(report['wall_time'], report_path))
+    for phase in report['phases'][:limit]:
+        print('  {total:9.2f}s  {count:5d}x  {name}'.format(**phase))
+
+
+@contextmanager
+def profiled(profile_dir):
+    """Profile the enclosed build, writing the report to profile_dir.
+
+    Does nothing if profile_dir is None.
+    """
+    if profile_dir is None:
+        yield
+        return
+    events = os.path.join(profile_dir, EVENTS_DIRNAME)
+    shutil.rmtree(events, ignore_errors=True)
+    os.makedirs(events)
+    token = _events_dir.set(events)
+    try:
+        with span('build'):
+            yield
+    finally:
+        _events_dir.reset(token)
+        print_summary(write_report(profile_dir))
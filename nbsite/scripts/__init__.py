@@ -5,10 +5,17 @@ from ._build_llms_txt import (
 )
 from ._clean_dist_html import clean_dist_html
 from ._fix_links import fix_links
+from ._postprocess_html import (
+    HTML_TRANSFORMS, HtmlTransform, postprocess_html, register_html_transform,
+)
 
 __all__ = (
     "clean_dist_html",
     "fix_links",
+    "HTML_TRANSFORMS",
+    "HtmlTransform",
+    "postprocess_html",
+    "register_html_transform",
     "IndexCategory",
     "LlmsBuildConfig",
     "LlmsSection",
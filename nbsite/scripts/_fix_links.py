@@ -7,11 +7,9 @@ import os
 import re
 import warnings
 
-from concurrent.futures import ThreadPoolExecutor
-from functools import partial
-from pathlib import Path
-
-from bs4 import BeautifulSoup
+from ._postprocess_html import (
+    postprocess_html, process_html_file, register_html_transform,
+)
 
 # TODO: holoviews specific links e.g. to reference manual...doc & generalize
 
@@ -70,10 +68,21 @@ def find_autolinkable():
 
 
 
-def component_links(text, path):
-    autolinkable = find_autolinkable()
+def _needs_autolinks(path):
+    return ('user_guide' in path) or ('getting_started' in path)
+
+
+def prepare_autolinks(options, paths):
+    # Computed once for all the files, importing holoviews is slow.
+    if 'autolinkable' not in options:
+        options['autolinkable'] = find_autolinkable() if any(map(_needs_autolinks, paths)) else {}
+
 
-    if ('user_guide' in path) or ('getting_started' in path):
+def component_links(text, path, autolinkable=None):
+    if autolinkable is None:
+        autolinkable = find_autolinkable()
+
+    if _needs_autolinks(path):
         for clstype, listing in autolinkable.items():
             for (clsname, replacement) in list(listing):
                 try:
@@ -83,25 +92,25 @@ def component_links(text, path):
     return text
 
 
-def cleanup_links(path, inspect_links=False):
-    """
-    Use inspect_links to get a list of all the external links in the site
-    """
-    with open(path) as f:
-        text = f.read()
+def autolink_components(text, html_file):
+    return component_links(text, html_file.path, html_file.options['autolinkable'])
 
-#    if 'BokehJS does not appear to have successfully loaded' in text:
-#        for k, v in BOKEH_REPLACEMENTS.items():
-#            text = text.replace(k, v)
 
-    text = component_links(text, path)
-    soup = BeautifulSoup(text, features="html.parser")
+def fix_notebook_links(soup, html_file):
+    """
+    Point the relative links to notebooks to the HTML pages. With the
+    inspect_links option, report all the external links.
+    """
+    path = html_file.path
+    inspect_links = html_file.options.get('inspect_links', False)
+    modified = False
     for a in soup.find_all('a'):
         href = a.get('href', '')
         if '.ipynb' in href and 'http' not in href:
  #           for k, v in LINK_REPLACEMENTS.items():
  #               href = href.replace(k, v)
             a['href'] = href.replace('.ipynb', '.html')
+            modified = True
 
             # check to make sure that path exists, if not, try un-numbered version
             try_path = os.path.join(os.path.dirname(path), a['href'])
@@ -114,11 +123,17 @@ def cleanup_links(path, inspect_links=False):
                 else:
                     also_tried = 'Also tried: {}'.format(name) if name != num_name else ''
                     msg = 'Found missing link {} in: {}. {}'.format(a['href'], path, also_tried)
-                    warnings.warn(msg)
+                    html_file.warn(msg)
 
-        if inspect_links and 'http' in a['href']:
-            print(a['href'])
+        if inspect_links and 'http' in a.get('href', ''):
+            html_file.info(a['href'])
+    return modified
 
+
+def fix_asset_images(soup, html_file):
+    """Point the images of missing assets to the parent directory if found there."""
+    path = html_file.path
+    modified = False
     for img in soup.find_all('img'):
         src = img.get('src', '')
         if 'http' not in src and 'assets' in src:
@@ -127,15 +142,57 @@ def cleanup_links(path, inspect_links=False):
                 also_tried = os.path.join('..', src)
                 if os.path.exists(os.path.join(os.path.dirname(path), also_tried)):
                     img['src'] = also_tried
+                    modified = True
                 else:
                     msg = f'Found reference to missing image {src} in: {path}. Also tried: {also_tried}'
-                    warnings.warn(msg)
-    with open(path, 'w', encoding='utf-8') as f:
-        f.write(str(soup))
+                    html_file.warn(msg)
+    return modified
+
+
+# The transforms are sent to the worker processes, so they must be picklable
+# (i.e. module level functions, not lambdas).
+def _has_autolinkable_code(text, html_file):
+    return _needs_autolinks(html_file.path) and '<code' in text
+
+
+def _has_links_to_fix(text, html_file):
+    return '.ipynb' in text or html_file.options.get('inspect_links', False)
+
+
+def _has_asset_images(text, html_file):
+    return 'assets' in text and '<img' in text
+
+
+LINK_TRANSFORMS = [
+    register_html_transform(
+        'autolink_components', autolink_components, text=True,
+        applies=_has_autolinkable_code,
+        prepare=prepare_autolinks,
+    ),
+    register_html_transform(
+        'fix_notebook_links', fix_notebook_links,
+        applies=_has_links_to_fix,
+    ),
+    register_html_transform(
+        'fix_asset_images', fix_asset_images,
+        applies=_has_asset_images,
+    ),
+]
+
+
+def cleanup_links(path, inspect_links=False):
+    """
+    Use inspect_links to get a list of all the external links in the site
+    """
+    options = {'inspect_links': inspect_links}
+    prepare_autolinks(options, [path])
+    _, _, messages = process_html_file(path, LINK_TRANSFORMS, options)
+    for kind, message in messages:
+        if kind == 'warning':
+            warnings.warn(message)
+        else:
+            print(message)
+
 
 def fix_links(build_dir, inspect_links=False):
-    files = map(os.fspath, Path(build_dir).rglob("*.html"))
-    with ThreadPoolExecutor() as executor:
-        func = partial(cleanup_links, inspect_links=inspect_links)
-        # list to force execution and raise potential exception
-        list(executor.map(func, files))
+    postprocess_html(build_dir, transforms=LINK_TRANSFORMS, inspect_links=inspect_links)
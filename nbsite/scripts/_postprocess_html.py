@@ -0,0 +1,216 @@
+"""Single-pass post-processing of the HTML output of a build.
+
+The output tree is walked once: the Sphinx leftovers are removed (see
+``clean_dist_html``) and every HTML file goes through the registered
+transforms, in parallel. Transforms come in two stages:
+
+* text transforms receive and return the raw HTML text;
+* soup transforms receive the BeautifulSoup of the file, parsed at most
+  once and only if a transform applies to the file, and return whether
+  they modified it.
+
+A file is only written back when its content changed.
+"""
+
+from __future__ import annotations
+
+import os
+import shutil
+import warnings
+
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable
+
+from bs4 import BeautifulSoup
+
+# Sphinx leftovers removed from the output.
+CLEAN_DIRS = (".doctrees", "_sources")
+CLEAN_EXTENSIONS = (".ipynb",)
+
+# Below this number of files, the pool startup costs more than it saves.
+MIN_FILES_PER_WORKER = 32
+
+
+@dataclass(frozen=True)
+class HtmlTransform:
+    """A transform applied to the HTML files of the output.
+
+    The functions must be picklable (defined at the module level) as
+    the files are processed in worker processes.
+    ``func(text_or_soup, html_file)`` returns the new text for a text
+    transform, and whether the soup was modified for a soup transform.
+    ``applies(text, html_file)`` cheaply tells whether the transform has
+    anything to do with a file, avoiding parsing files no transform
+    applies to. ``prepare(options, paths)`` runs once in the main process
+    before the files are processed, e.g. to compute data stored in the
+    options shared with the workers.
+    """
+
+    name: str
+    func: Callable[[Any, HtmlFile], Any]
+    text: bool = False
+    applies: Callable[[str, HtmlFile], bool] | None = None
+    prepare: Callable[[dict, list], None] | None = None
+
+
+class HtmlFile:
+    """An HTML file being post-processed, collecting the messages for it."""
+
+    def __init__(self, path, options):
+        self.path = path
+        self.options = options
+        self.messages = []
+
+    def warn(self, message):
+        self.messages.append(("warning", message))
+
+    def info(self, message):
+        self.messages.append(("info", message))
+
+
+HTML_TRANSFORMS: list[HtmlTransform] = []
+
+
+def register_html_transform(name, func, text=False, applies=None, prepare=None):
+    """Register a transform run on every HTML file by postprocess_html.
+
+    Registering a transform with the name of an existing one replaces it.
+    """
+    transform = HtmlTransform(name, func, text=text, applies=applies, prepare=prepare)
+    for i, existing in enumerate(HTML_TRANSFORMS):
+        if existing.name == name:
+            HTML_TRANSFORMS[i] = transform
+            break
+    else:
+        HTML_TRANSFORMS.append(transform)
+    return transform
+
+
+def process_html_file(path, transforms, options):
+    """Run the transforms on an HTML file, writing it only if changed.
+
+    Returns (path, changed, messages).
+    """
+    html_file = HtmlFile(path, options)
+    with open(path, encoding="utf-8") as f:
+        original = f.read()
+    text = original
+    for transform in transforms:
+        if transform.text and (transform.applies is None or transform.applies(text, html_file)):
+            text = transform.func(text, html_file)
+    soup_transforms = [
+        t for t in transforms
+        if not t.text and (t.applies is None or t.applies(text, html_file))
+    ]
+    if soup_transforms:
+        soup = BeautifulSoup(text, features="html.parser")
+        modified = False
+        for transform in soup_transforms:
+            modified = transform.func(soup, html_file) or modified
+        if modified:
+            text = str(soup)
+    changed = text != original
+    if changed:
+        # Replaced rather than written in place, not to modify the source
+        # of a file hardlinked into the output (see copy_files).
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp, path)
+    return path, changed, html_file.messages
+
+
+def _process_html_files(paths, transforms, options):
+    return [process_html_file(path, transforms, options) for path in paths]
+
+
+def walk_output(output, clean=False, dry_run=False):
+    """Walk the output once, returning its HTML files.
+
+    With clean, the Sphinx leftovers (CLEAN_DIRS and the notebooks) are
+    removed, or only listed with dry_run.
+    """
+    htmldir = os.path.abspath(output)
+    html_files = []
+    for root, dirs, files in os.walk(htmldir):
+        if clean and root == htmldir:
+            for folder in CLEAN_DIRS:
+                if folder not in dirs:
+                    continue
+                dirs.remove(folder)
+                if dry_run:
+                    print("would remove", folder)
+                else:
+                    print("removing", folder)
+                    shutil.rmtree(os.path.join(root, folder), ignore_errors=True)
+        for name in files:
+            path = os.path.join(root, name)
+            ext = os.path.splitext(name)[1].lower()
+            if ext == ".html":
+                html_files.append(path)
+            elif clean and ext in CLEAN_EXTENSIONS:
+                relpath = os.path.relpath(path, htmldir)
+                if dry_run:
+                    print("would remove", relpath)
+                else:
+                    print("removing", relpath)
+                    os.remove(path)
+    return sorted(html_files)
+
+
+def postprocess_html(output, transforms=None, clean=False, dry_run=False, workers=None, **options):
+    """Post-process the HTML output of a build in a single walk.
+
+    Parameters
+    ----------
+    output: str
+        The output directory of the build.
+    transforms: list[HtmlTransform] | None
+        The transforms to run, defaults to the registered ones.
+    clean: bool
+        Whether to remove the Sphinx leftovers, see clean_dist_html.
+    dry_run: bool
+        Only list the files clean would remove.
+    workers: int | None
+        Number of processes the HTML files are processed with, defaults
+        to the number of CPUs.
+    **options:
+        Options made available to the transforms, e.g. inspect_links.
+
+    Returns the list of the HTML files that were modified.
+    """
+    if transforms is None:
+        transforms = list(HTML_TRANSFORMS)
+    if clean:
+        if dry_run:
+            print("This is just a dry-run of removing files from:", os.path.abspath(output))
+        else:
+            print("Removing files from:", os.path.abspath(output))
+    paths = walk_output(output, clean=clean, dry_run=dry_run)
+    if not transforms or not paths:
+        return []
+    for transform in transforms:
+        if transform.prepare is not None:
+            transform.prepare(options, paths)
+
+    workers = min(workers or os.cpu_count() or 1, len(paths) // MIN_FILES_PER_WORKER)
+    if workers <= 1:
+        results = _process_html_files(paths, transforms, options)
+    else:
+        chunksize = max(1, len(paths) // (workers * 4))
+        chunks = [paths[i:i+chunksize] for i in range(0, len(paths), chunksize)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_process_html_files, chunk, transforms, options) for chunk in chunks]
+            results = [result for future in futures for result in future.result()]
+
+    changed = []
+    for path, file_changed, messages in results:
+        for kind, message in messages:
+            if kind == "warning":
+                warnings.warn(message)
+            else:
+                print(message)
+        if file_changed:
+            changed.append(path)
+    return changed
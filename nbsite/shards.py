@@ -0,0 +1,118 @@
+"""
+Sharded execution of the notebooks of a doc tree.
+
+``nbsite execute --shard i/N`` executes the i-th of N shards of the
+notebooks embedded in the doc tree (including the gallery ones) into an
+artifact directory, mirroring the doc tree: the evaluated notebooks and
+the side files moved along with them (see
+``nbbuild_patterns_to_take_along``). A notebook is assigned to a shard
+from a hash of its path relative to the doc tree, the partition being
+the same on every machine and stable when notebooks are added or
+removed.
+
+The manifest of a shard records, for each notebook, the files of its
+artifacts and the ``notebook_cache_key`` of its execution: executing a
+shard again only executes the notebooks changed since.
+
+The artifacts of the N shards, e.g. produced by the jobs of a CI matrix,
+are merged by copying them into the same directory, which is consumed by
+``nbsite build --executed``: the evaluated notebooks are installed in
+the doc tree before the build, which then executes nothing.
+"""
+from __future__ import annotations
+
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+
+MANIFEST_PREFIX = 'nbsite-shard-'
+
+MANIFEST_TEMPLATE = MANIFEST_PREFIX + '{index}-of-{count}.json'
+
+
+def parse_shard(spec: str) -> tuple[int, int]:
+    """Parse a shard specification 'i/N' into (i, N), i counting from 1."""
+    match = re.fullmatch(r'\s*(\d+)\s*/\s*(\d+)\s*', spec)
+    if not match:
+        raise ValueError(f'Invalid shard {spec!r}, expected i/N, e.g. 1/4')
+    index, count = int(match.group(1)), int(match.group(2))
+    if not 1 <= index <= count:
+        raise ValueError(f'Invalid shard {spec!r}, i must be between 1 and N')
+    return index, count
+
+
+def shard_of(path: str, count: int) -> int:
+    """Return the shard (counting from 1) of a path relative to the doc tree."""
+    key = path.replace(os.sep, '/').encode('utf-8')
+    return int(hashlib.sha256(key).hexdigest(), 16) % count + 1
+
+
+def write_manifest(artifact_dir, index, count, notebooks):
+    """Record the notebooks executed by a shard in the artifact directory.
+
+    notebooks maps the path of the evaluated notebooks relative to the
+    doc tree to their 'key' and the 'files' of their artifacts (the
+    evaluated notebook and its side files), '/' separated.
+    """
+    os.makedirs(artifact_dir, exist_ok=True)
+    path = os.path.join(artifact_dir, MANIFEST_TEMPLATE.format(index=index, count=count))
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'shard': index, 'count': count, 'notebooks': dict(sorted(notebooks.items()))}, f, indent=1)
+    return path
+
+
+def read_manifest(artifact_dir, index, count) -> dict:
+    """Return the notebooks recorded by a previous execution of a shard, see write_manifest."""
+    path = os.path.join(artifact_dir, MANIFEST_TEMPLATE.format(index=index, count=count))
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)['notebooks']
+    except (OSError, ValueError, KeyError):
+        return {}
+
+
+def read_manifests(artifact_dir) -> list[dict]:
+    """Return the manifests of the merged artifacts, checking they are complete.
+
+    Raises an Exception if a shard is missing or if the shards do not
+    agree on their number.
+    """
+    manifests = []
+    for path in sorted(glob.glob(os.path.join(artifact_dir, MANIFEST_PREFIX + '*.json'))):
+        with open(path, encoding='utf-8') as f:
+            manifests.append(json.load(f))
+    if not manifests:
+        raise Exception(f'No executed notebooks found in {artifact_dir}, run `nbsite execute` first.')
+    counts = {manifest['count'] for manifest in manifests}
+    if len(counts) > 1:
+        raise Exception(f'The artifacts in {artifact_dir} were executed with different numbers of shards: {sorted(counts)}')
+    count = counts.pop()
+    missing = sorted(set(range(1, count + 1)) - {manifest['shard'] for manifest in manifests})
+    if missing:
+        raise Exception('The artifacts in {} are missing the shards {} of {}'.format(
+            artifact_dir, ', '.join(map(str, missing)), count))
+    return manifests
+
+
+def install_artifacts(artifact_dir, doc_dir) -> list[str]:
+    """Copy the merged artifacts of all the shards into the doc tree.
+
+    Only the files recorded in the manifests are installed, not those
+    left over by previous executions. Returns the paths of the files
+    installed.
+    """
+    installed = []
+    for manifest in read_manifests(artifact_dir):
+        for notebook in manifest['notebooks'].values():
+            for relpath in notebook['files']:
+                src = os.path.join(artifact_dir, *relpath.split('/'))
+                if not os.path.isfile(src):
+                    raise Exception(f'The artifact {src} of shard {manifest["shard"]} is missing')
+                dest = os.path.join(doc_dir, *relpath.split('/'))
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                shutil.copy2(src, dest)
+                installed.append(dest)
+    return installed
@@ -10,7 +10,6 @@ import sys
 
 import nbsite as _nbsite
 
-from nbsite import nbbuild
 from nbsite.util import base_version  # noqa
 
 NBSITE_DIR = _pathlib.Path(_nbsite.__file__).parent
@@ -282,9 +281,17 @@ def setup(app):
     except ImportError:
         print('no param_formatter (no param?)')
 
-    nbbuild.setup(app)
+    # Registered as an extension (rather than calling nbbuild.setup) for
+    # Sphinx to know it is safe to read and write in parallel.
+    app.setup_extension('nbsite.nbbuild')
     app.connect("builder-inited", remove_mystnb_static)
 
     # hv_sidebar_dropdown
     app.add_config_value('nbsite_hv_sidebar_dropdown', {}, 'html')
     app.connect("html-page-context", add_hv_sidebar_dropdown_context)
+
+    return {
+        "version": _nbsite.__version__,
+        "parallel_read_safe": True,
+        "parallel_write_safe": True,
+    }
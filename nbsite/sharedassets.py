@@ -0,0 +1,114 @@
+"""
+Hoisting of the scripts and styles repeated across notebook outputs.
+
+HoloViews, Bokeh and Panel embed the same large loader scripts and
+extension code in the outputs of every notebook, and often of every
+cell. The inline ``<script>`` and ``<style>`` blocks of the rendered
+outputs are hashed when the notebooks are read (see ``find_payloads``);
+the ones found in more than one page of the site are written once to a
+content-hashed static file, referenced from the pages in place of the
+inline block (see ``hoist_payloads``), so that the browsers cache them
+across pages.
+"""
+from __future__ import annotations
+
+import hashlib
+import os
+import re
+import tempfile
+
+DEFAULT_MIN_SIZE = 4 * 1024
+
+# Directory of the hoisted files, relative to the _static directory.
+STATIC_DIRNAME = 'nbsite'
+
+PAYLOAD_REGEX = re.compile(r'<(script|style)\b([^>]*)>(.*?)</\1\s*>', re.IGNORECASE | re.DOTALL)
+
+TYPE_REGEX = re.compile(r'''\btype\s*=\s*["']?([^"'\s>]*)''', re.IGNORECASE)
+
+SRC_REGEX = re.compile(r'\bsrc\s*=', re.IGNORECASE)
+
+# Scripts of other types are data blocks, e.g. the JSON of a Bokeh
+# document, which cannot be loaded from a file. Modules are left inline
+# too, their relative imports being resolved against the URL of the
+# script.
+SCRIPT_TYPES = ('', 'text/javascript', 'application/javascript')
+
+EXTENSIONS = {'script': '.js', 'style': '.css'}
+
+
+def payload_hash(body: str) -> str:
+    return hashlib.sha256(body.encode('utf-8')).hexdigest()[:32]
+
+
+def _hoistable(match, min_size) -> bool:
+    tag, attributes, body = match.groups()
+    if len(body) < min_size or not body.strip():
+        return False
+    if tag.lower() == 'script':
+        if SRC_REGEX.search(attributes):
+            return False
+        script_type = TYPE_REGEX.search(attributes)
+        return (script_type.group(1).lower() if script_type else '') in SCRIPT_TYPES
+    return True
+
+
+def find_payloads(html: str, min_size=DEFAULT_MIN_SIZE) -> list[str]:
+    """Return the hashes of the inline scripts and styles that could be hoisted."""
+    if '<script' not in html and '<style' not in html:
+        return []
+    return [
+        payload_hash(match.group(3)) for match in PAYLOAD_REGEX.finditer(html)
+        if _hoistable(match, min_size)
+    ]
+
+
+def static_filename(tag: str, digest: str) -> str:
+    return digest + EXTENSIONS[tag.lower()]
+
+
+def hoist_payloads(html: str, hoisted, static_dir, static_url, min_size=DEFAULT_MIN_SIZE) -> str:
+    """Replace the inline scripts and styles whose hash is in hoisted.
+
+    The payloads are written to static_dir (if not already there) and
+    referenced with static_url, the URL of static_dir from the page.
+    """
+    def replace(match):
+        if not _hoistable(match, min_size):
+            return match.group(0)
+        tag, attributes, body = match.groups()
+        digest = payload_hash(body)
+        if digest not in hoisted:
+            return match.group(0)
+        filename = static_filename(tag, digest)
+        _write_static(os.path.join(static_dir, filename), body)
+        url = f'{static_url}/{filename}'
+        if tag.lower() == 'script':
+            return f'<script{attributes} src="{url}"></script>'
+        return f'<link rel="stylesheet" href="{url}"{attributes}>'
+
+    return PAYLOAD_REGEX.sub(replace, html)
+
+
+def remove_unused(static_dir, hoisted):
+    """Remove the hoisted files of static_dir whose hash is not in hoisted."""
+    if not os.path.isdir(static_dir):
+        return
+    for filename in os.listdir(static_dir):
+        digest, ext = os.path.splitext(filename)
+        if ext in EXTENSIONS.values() and digest not in hoisted:
+            os.remove(os.path.join(static_dir, filename))
+
+
+def _write_static(path, body):
+    if os.path.isfile(path):
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8', newline='') as f:
+            f.write(body)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
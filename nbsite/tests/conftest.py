@@ -3,6 +3,8 @@ import sys
 
 from contextlib import suppress
 
+import pytest
+
 if sys.platform == "win32":
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 
@@ -10,3 +12,9 @@ with suppress(ImportError):
     # If we don't import here it will crash test on macOS in multiprocessing
     # https://github.com/giampaolo/psutil/issues/2713
     import psutil  # noqa: F401
+
+
+@pytest.fixture(autouse=True)
+def _isolated_notebook_cache(tmp_path, monkeypatch):
+    # Never share executed notebooks with the user cache or between tests.
+    monkeypatch.setenv("NBSITE_CACHE_DIR", str(tmp_path / "nbsite_cache"))
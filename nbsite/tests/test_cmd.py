@@ -1,9 +1,12 @@
 import json
+import os
 import shutil
+import sys
 
 import pytest
 
-from nbsite.cmd import build, generate_rst
+from nbsite.cmd import build, execute, generate_rst
+from nbsite.gallery.manifest import MANIFEST_FILENAME, ThumbnailManifest
 
 # Note: a lot of this setup is copied from the new (2018-11-01) test in
 # pyct. Potentially this could be consolidated at some point. The fixture
@@ -413,6 +416,18 @@ def test_build_with_just_one_rst(tmp_project_with_docs_skeleton):
     assert not (project / "builtdocs" / "First_Notebook.html").is_file()
     assert (project / "builtdocs" / ".nojekyll").is_file()
 
+@pytest.mark.slow
+def test_build_does_not_publish_the_thumbnail_manifest(tmp_project_with_docs_skeleton):
+    project = tmp_project_with_docs_skeleton
+    (project / "doc" / "Zeroth_Notebook.rst").write_text(EXAMPLE_0_RST)
+    manifest = ThumbnailManifest(project / "doc" / "gallery")
+    manifest.record(project / "doc" / "gallery" / "thumbnails" / "example", "key")
+    manifest.save()
+    build('html', str(project / "builtdocs"), project_root=str(project), examples_assets='')
+    assert (project / "doc" / "gallery" / MANIFEST_FILENAME).is_file()
+    assert not list((project / "builtdocs").rglob(MANIFEST_FILENAME))
+    assert not list((project / "builtdocs").rglob("thumbnails.json"))
+
 @pytest.mark.slow
 def test_build_deletes_by_default(tmp_project_with_docs_skeleton):
     project = tmp_project_with_docs_skeleton
@@ -432,12 +447,13 @@ def test_build_with_clean_dry_run_does_not_delete(tmp_project_with_docs_skeleton
     (project / "doc" / "Zeroth_Notebook.rst").write_text(EXAMPLE_0_RST)
     (project / "doc" / "First_Notebook.rst").write_text(EXAMPLE_1_RST)
     build('html', str(project / "builtdocs"), project_root=str(project), examples_assets='', clean_dry_run=True)
-    assert (project / "builtdocs" / ".doctrees").is_dir()
+    assert (project / "builtdocs" / "_sources").is_dir()
     assert (project / "builtdocs" / "First_Notebook.html").is_file()
     # Used to test for 12, bumped to 13 as the sphinx-design extension
     # adds a `_sphinx_design_static` folder in `builtdocs/`.
     # Further incremented when sphinx-rediraffe was added as it adds _rediraffe_redirected.json
-    assert len(list((project / "builtdocs").iterdir())) == 14
+    # Decremented when the doctrees were moved out of `builtdocs/`.
+    assert len(list((project / "builtdocs").iterdir())) == 13
 
 @pytest.mark.slow
 def test_build_copies_json(tmp_project_with_docs_skeleton):
@@ -508,3 +524,296 @@ def test_build_with_keep_numbers_passes_even_when_link_target_does_not_exist(tmp
     assert '<a class="reference internal" href="0_Zeroth_Notebook.html"><span class="std std-doc">right number' in html
     assert '<span class="xref myst">wrong number</span>' in html
     assert '<span class="xref myst">no number</span>' in html
+
+@pytest.mark.slow
+def test_build_restores_evaluated_notebooks_from_cache(tmp_project_with_docs_skeleton, capfd):
+    project = tmp_project_with_docs_skeleton
+    (project / "doc" / "First_Notebook.rst").write_text(EXAMPLE_1_RST)
+    build('html', str(project / "builtdocs"), project_root=str(project), examples_assets='', overwrite=True)
+    first = (project / "doc" / "1_First_Notebook.ipynb").read_text()
+    assert "Restored evaluated notebook" not in capfd.readouterr().out
+    build('html', str(project / "builtdocs"), project_root=str(project), examples_assets='', overwrite=True)
+    assert "Restored evaluated notebook" in capfd.readouterr().out
+    assert (project / "doc" / "1_First_Notebook.ipynb").read_text() == first
+
+@pytest.mark.slow
+def test_build_pre_executes_notebooks(tmp_project_with_docs_skeleton, capfd):
+    project = tmp_project_with_docs_skeleton
+    (project / "doc" / "Zeroth_Notebook.rst").write_text(EXAMPLE_0_RST)
+    (project / "doc" / "First_Notebook.rst").write_text(EXAMPLE_1_RST)
+    (project / "doc" / "conf.py").write_text(CONF_CONTENT + "nbbuild_execution_workers = 2\n")
+    build('html', str(project / "builtdocs"), project_root=str(project), examples_assets='')
+    # The directives only render the notebooks executed ahead of the read phase.
+    assert capfd.readouterr().out.count("Skipping existing evaluated notebook") == 2
+    assert (project / "doc" / "0_Zeroth_Notebook.ipynb").is_file()
+    assert (project / "doc" / "1_First_Notebook.ipynb").is_file()
+
+@pytest.mark.slow
+def test_build_is_incremental(tmp_project_with_docs_skeleton):
+    project = tmp_project_with_docs_skeleton
+    (project / "doc" / "Zeroth_Notebook.rst").write_text(EXAMPLE_0_RST)
+    (project / "doc" / "First_Notebook.rst").write_text(EXAMPLE_1_RST)
+    build('html', str(project / "builtdocs"), project_root=str(project), examples_assets='')
+    doctrees = project / ".nbsite" / "doctrees"
+    assert (doctrees / "environment.pickle").is_file()
+    assert not (project / "builtdocs" / ".doctrees").exists()
+    first_mtime = (doctrees / "First_Notebook.doctree").stat().st_mtime_ns
+    zeroth_mtime = (doctrees / "Zeroth_Notebook.doctree").stat().st_mtime_ns
+
+    (project / "doc" / "Zeroth_Notebook.rst").write_text(EXAMPLE_0_RST + "\nSome more text.\n")
+    build('html', str(project / "builtdocs"), project_root=str(project), examples_assets='')
+    assert (doctrees / "First_Notebook.doctree").stat().st_mtime_ns == first_mtime
+    assert (doctrees / "Zeroth_Notebook.doctree").stat().st_mtime_ns != zeroth_mtime
+    assert "Some more text." in (project / "builtdocs" / "Zeroth_Notebook.html").read_text()
+
+    build('html', str(project / "builtdocs"), project_root=str(project), examples_assets='', fresh=True)
+    assert (doctrees / "First_Notebook.doctree").stat().st_mtime_ns != first_mtime
+
+@pytest.mark.slow
+def test_build_with_profile(tmp_project_with_docs_skeleton):
+    project = tmp_project_with_docs_skeleton
+    (project / "doc" / "Zeroth_Notebook.rst").write_text(EXAMPLE_0_RST)
+    (project / "doc" / "First_Notebook.rst").write_text(EXAMPLE_1_RST)
+    build('html', str(project / "builtdocs"), project_root=str(project), examples_assets='', profile=True)
+    report = json.loads((project / ".nbsite" / "profile" / "profile.json").read_text())
+    phases = {phase['name'] for phase in report['phases']}
+    assert {
+        'build', 'sphinx.init', 'sphinx.read', 'sphinx.read_doc', 'sphinx.write',
+        'sphinx.write_doc', 'notebook.execute', 'notebook.write', 'notebook.render', 'copy_files',
+        'postprocess_html',
+    } <= phases
+    rendered = {span['args']['notebook'] for span in report['spans'] if span['name'] == 'notebook.render'}
+    assert len(rendered) == 2
+    assert (project / ".nbsite" / "profile" / "profile.trace.json").is_file()
+
+@pytest.mark.slow
+@pytest.mark.parametrize("conf", [
+    CONF_CONTENT,
+    # shared_conf loaded as an extension instead of through conf.setup
+    CONF_CONTENT + "del setup\nextensions = extensions + ['nbsite.shared_conf']\n",
+], ids=["conf-setup", "extension"])
+def test_build_reads_and_writes_in_parallel(tmp_project_with_docs_skeleton, monkeypatch, conf):
+    from sphinx.builders import Builder
+
+    project = tmp_project_with_docs_skeleton
+    (project / "doc" / "conf.py").write_text(conf)
+    (project / "doc" / "Zeroth_Notebook.rst").write_text(EXAMPLE_0_RST)
+    (project / "doc" / "First_Notebook.rst").write_text(EXAMPLE_1_RST)
+
+    calls = []
+    for method in ('_read_parallel', '_write_parallel'):
+        orig = getattr(Builder, method)
+        def spy(self, docnames, nproc, _orig=orig, _method=method):
+            calls.append(_method)
+            return _orig(self, docnames, nproc)
+        monkeypatch.setattr(Builder, method, spy)
+    monkeypatch.setattr("os.cpu_count", lambda: 2)
+
+    build('html', str(project / "builtdocs"), project_root=str(project), examples_assets='')
+    assert calls == ['_read_parallel', '_write_parallel']
+    assert (project / "builtdocs" / "First_Notebook.html").is_file()
+
+@pytest.mark.slow
+def test_concurrent_builds_do_not_share_settings(tmp_project_with_docs_skeleton, tmp_path, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+
+    project = tmp_project_with_docs_skeleton
+    (project / "doc" / "First_Notebook.rst").write_text(EXAMPLE_1_RST)
+    other = tmp_path / "other_project"
+    shutil.copytree(project, other)
+    for name in ('PROJECT_NAME', 'BRANCH', 'REPO'):
+        monkeypatch.delenv(name, raising=False)
+
+    def build_branch(project, branch):
+        build('html', str(project / "builtdocs"), project_root=str(project), examples_assets='',
+              org='holoviz', repo='nbsite', branch=branch)
+        return (project / "builtdocs" / "First_Notebook.html").read_text()
+
+    with ThreadPoolExecutor(2) as executor:
+        main = executor.submit(build_branch, project, 'main')
+        dev = executor.submit(build_branch, other, 'dev')
+        main, dev = main.result(), dev.result()
+    assert 'holoviz/nbsite/main/examples/1_First_Notebook.ipynb' in main
+    assert 'holoviz/nbsite/dev/examples/1_First_Notebook.ipynb' in dev
+    assert 'BRANCH' not in os.environ
+    assert 'PROJECT_NAME' not in os.environ
+
+@pytest.mark.slow
+def test_build_with_slices_of_one_notebook(tmp_project_with_docs_skeleton, capfd):
+    project = tmp_project_with_docs_skeleton
+    (project / "doc" / "First_Notebook.rst").write_text(EXAMPLE_1_RST + """
+.. notebook:: test_project ../examples/1_First_Notebook.ipynb
+    :substring: wrong number
+    :end: no number
+    :disable_interactivity_warning: True
+""")
+    build('html', str(project / "builtdocs"), project_root=str(project), examples_assets='')
+    html = (project / "builtdocs" / "First_Notebook.html").read_text()
+    assert html.count("another temporary notebook") == 1
+    assert html.count("Here is a ref to it with") == 4
+    assert capfd.readouterr().out.count("Writing evaluated notebook") == 1
+
+@pytest.mark.slow
+def test_build_reports_notebook_execution(tmp_project_with_docs_skeleton):
+    project = tmp_project_with_docs_skeleton
+    nb = {
+        "cells": [{"cell_type": "code", "execution_count": None, "metadata": {}, "outputs": [],
+                   "source": "import time\ntime.sleep(0.5)\nprint('slept')"}],
+        "metadata": {}, "nbformat": 4, "nbformat_minor": 2,
+    }
+    (project / "examples" / "Slow.ipynb").write_text(json.dumps(nb))
+    (project / "doc" / "Slow.rst").write_text("Slow\n====\n\n.. notebook:: test_project ../examples/Slow.ipynb\n")
+    build('html', str(project / "builtdocs"), project_root=str(project), examples_assets='')
+    report = json.loads((project / ".nbsite" / "execution.json").read_text())
+    assert [r["notebook"] for r in report["notebooks"]] == ["../examples/Slow.ipynb"]
+    cell = report["cells"][0]
+    assert cell["duration"] >= 0.5
+    assert cell["output_size"] == len("slept\n")
+    assert cell["source"] == "import time"
+    if sys.platform.startswith("linux"):
+        assert cell["peak_memory"] > 0
+
+    # The statistics are kept with the evaluated notebook and the environment,
+    # but not measured by a build executing nothing.
+    build('html', str(project / "builtdocs"), project_root=str(project), examples_assets='', max_cell_time=0.1)
+    report = json.loads((project / ".nbsite" / "execution.json").read_text())
+    assert report["notebooks"][0]["cached"]
+
+    nb["cells"][0]["source"] += "\nprint('again')"
+    (project / "examples" / "Slow.ipynb").write_text(json.dumps(nb))
+    with pytest.raises(Exception, match="Slow.ipynb cell 0 .* took"):
+        build('html', str(project / "builtdocs"), project_root=str(project), examples_assets='',
+              max_cell_time=0.1, overwrite=True)
+
+
+@pytest.mark.slow
+def test_build_reports_unresolved_notebook_links(tmp_project_with_docs_skeleton, monkeypatch):
+    from nbsite import nbbuild
+
+    warnings = []
+    monkeypatch.setattr(nbbuild.logger, "warning", lambda msg, *args: warnings.append(msg % args))
+    project = tmp_project_with_docs_skeleton
+    nb = {
+        "cells": [{"cell_type": "markdown", "metadata": {},
+                   "source": "See [this](Other.ipynb), [that](Missing.ipynb) and [again](Missing.ipynb)"}],
+        "metadata": {}, "nbformat": 4, "nbformat_minor": 2,
+    }
+    (project / "examples" / "Links.ipynb").write_text(json.dumps(nb))
+    (project / "doc" / "Links.rst").write_text("Links\n=====\n\n.. notebook:: test_project ../examples/Links.ipynb\n")
+    (project / "doc" / "Other.rst").write_text("Other\n=====\n")
+    build('html', str(project / "builtdocs"), project_root=str(project), examples_assets='')
+    # A single warning for the whole build, listing each link once.
+    assert len(warnings) == 1
+    assert warnings[0].startswith("Source file not found for 1 notebook link:\n")
+    assert 'Links: "Missing.ipynb"' in warnings[0]
+    html = (project / "builtdocs" / "Links.html").read_text()
+    assert "Other.html" in html
+
+
+@pytest.mark.slow
+def test_execute_shards_then_build(tmp_project_with_docs_skeleton, capfd):
+    project = tmp_project_with_docs_skeleton
+    (project / "doc" / "Zeroth_Notebook.rst").write_text(EXAMPLE_0_RST)
+    (project / "doc" / "First_Notebook.rst").write_text(EXAMPLE_1_RST)
+    artifacts = project / "executed"
+    # e.g. the jobs of a CI matrix, their artifacts being merged.
+    for shard in ["1/2", "2/2"]:
+        execute(shard=shard, output=str(artifacts), project_root=str(project), examples_assets='')
+    assert (artifacts / "0_Zeroth_Notebook.ipynb").is_file()
+    assert (artifacts / "1_First_Notebook.ipynb").is_file()
+    assert not (project / "doc" / "0_Zeroth_Notebook.ipynb").exists()
+    manifests = [json.loads(path.read_text()) for path in sorted(artifacts.glob("nbsite-shard-*.json"))]
+    assert sorted(nb for m in manifests for nb in m["notebooks"]) == ["0_Zeroth_Notebook.ipynb", "1_First_Notebook.ipynb"]
+
+    # Only the notebooks edited since are executed again.
+    nb = json.loads((project / "examples" / "1_First_Notebook.ipynb").read_text())
+    nb["cells"].append({"cell_type": "code", "execution_count": None, "metadata": {}, "outputs": [],
+                        "source": "print('edited')"})
+    (project / "examples" / "1_First_Notebook.ipynb").write_text(json.dumps(nb))
+    # Not installed, not being in a manifest.
+    (artifacts / "Leftover.ipynb").write_text("{}")
+    capfd.readouterr()
+    for shard in ["1/2", "2/2"]:
+        execute(shard=shard, output=str(artifacts), project_root=str(project), examples_assets='')
+    out = capfd.readouterr().out
+    assert out.count("Writing evaluated notebook") == 1
+    assert "edited" in (artifacts / "1_First_Notebook.ipynb").read_text()
+
+    build('html', str(project / "builtdocs"), project_root=str(project), examples_assets='', executed=str(artifacts))
+    out = capfd.readouterr().out
+    assert "Writing evaluated notebook" not in out
+    assert out.count("Skipping existing evaluated notebook") == 2
+    assert (project / "builtdocs" / "First_Notebook.html").is_file()
+    assert not (project / "doc" / "Leftover.ipynb").exists()
+
+
+@pytest.mark.slow
+def test_build_rebuilds_pages_when_data_files_change(tmp_project_with_docs_skeleton):
+    project = tmp_project_with_docs_skeleton
+    (project / "examples" / "scores.csv").write_text(DATA_FILE_0_CONTENT)
+    nb = {
+        "cells": [{"cell_type": "code", "execution_count": None, "metadata": {}, "outputs": [],
+                   "source": "print('rows:', len(open('scores.csv').read().split()) - 1)"}],
+        "metadata": {}, "nbformat": 4, "nbformat_minor": 2,
+    }
+    (project / "examples" / "Data.ipynb").write_text(json.dumps(nb))
+    (project / "doc" / "Scores.rst").write_text("Scores\n======\n\n.. notebook:: test_project ../examples/Data.ipynb\n")
+    build('html', str(project / "builtdocs"), project_root=str(project), examples_assets='')
+    assert "rows: 3" in (project / "builtdocs" / "Scores.html").read_text()
+
+    (project / "examples" / "scores.csv").write_text(DATA_FILE_1_CONTENT)
+    build('html', str(project / "builtdocs"), project_root=str(project), examples_assets='')
+    assert "rows: 6" in (project / "builtdocs" / "Scores.html").read_text()
+
+
+@pytest.mark.slow
+def test_build_stores_heavy_outputs_out_of_doctrees(tmp_project_with_docs_skeleton):
+    project = tmp_project_with_docs_skeleton
+    nb = {
+        "cells": [{"cell_type": "code", "execution_count": None, "metadata": {}, "outputs": [],
+                   "source": "from IPython.display import HTML\nHTML('<div id=\"heavy\">' + 'x' * 100000 + '</div>')"}],
+        "metadata": {}, "nbformat": 4, "nbformat_minor": 2,
+    }
+    (project / "examples" / "Heavy.ipynb").write_text(json.dumps(nb))
+    (project / "doc" / "Heavy_Page.rst").write_text("Heavy\n=====\n\n.. notebook:: test_project ../examples/Heavy.ipynb\n")
+    build('html', str(project / "builtdocs"), project_root=str(project), examples_assets='')
+    doctrees = project / ".nbsite" / "doctrees"
+    assert (doctrees / "Heavy_Page.doctree").stat().st_size < 100000
+    assert len(list((doctrees / "nbsite_outputs").glob("*/*"))) == 1
+    assert '<div id="heavy">' + 'x' * 100000 in (project / "builtdocs" / "Heavy_Page.html").read_text()
+
+    # The outputs no longer referenced are removed.
+    (project / "doc" / "Heavy_Page.rst").write_text("Heavy\n=====\n\nNo more notebook.\n")
+    build('html', str(project / "builtdocs"), project_root=str(project), examples_assets='')
+    assert not list((doctrees / "nbsite_outputs").glob("*/*"))
+
+
+@pytest.mark.slow
+def test_build_hoists_scripts_shared_by_notebook_outputs(tmp_project_with_docs_skeleton):
+    project = tmp_project_with_docs_skeleton
+    source = "from IPython.display import HTML\nHTML('<script>var loaded = \"' + 'x' * 10000 + '\";</script>')"
+    nb = {
+        "cells": [{"cell_type": "code", "execution_count": None, "metadata": {}, "outputs": [], "source": source}],
+        "metadata": {}, "nbformat": 4, "nbformat_minor": 2,
+    }
+    for name in ("Loader_One", "Loader_Two"):
+        (project / "examples" / f"{name}.ipynb").write_text(json.dumps(nb))
+        (project / "doc" / f"{name}_Page.rst").write_text(f"{name}\n==========\n\n.. notebook:: test_project ../examples/{name}.ipynb\n")
+    build('html', str(project / "builtdocs"), project_root=str(project), examples_assets='')
+
+    hoisted = list((project / "builtdocs" / "_static" / "nbsite").glob("*.js"))
+    assert len(hoisted) == 1
+    assert hoisted[0].read_text() == 'var loaded = "' + 'x' * 10000 + '";'
+    for name in ("Loader_One", "Loader_Two"):
+        html = (project / "builtdocs" / f"{name}_Page.html").read_text()
+        assert 'x' * 10000 not in html
+        assert f'<script src="_static/nbsite/{hoisted[0].name}"></script>' in html
+
+    # Once no longer shared, the script is inlined again in the page left
+    # and the hoisted file is removed.
+    (project / "doc" / "Loader_Two_Page.rst").write_text("Loader_Two\n==========\n\nNo more notebook.\n")
+    build('html', str(project / "builtdocs"), project_root=str(project), examples_assets='')
+    assert not list((project / "builtdocs" / "_static" / "nbsite").glob("*.js"))
+    html = (project / "builtdocs" / "Loader_One_Page.html").read_text()
+    assert 'var loaded = "' + 'x' * 10000 in html
+    assert "_static/nbsite/" not in html
@@ -0,0 +1,79 @@
+import os
+import subprocess
+import sys
+
+import nbformat
+
+from nbsite.dependencies import (
+    changed_dependencies, collect_dependencies, file_hash,
+    notebook_dependencies, record_dependencies, tracker_code, written_files,
+)
+
+
+def test_tracker_logs_files_read_and_written(tmp_path):
+    (tmp_path / "data.csv").write_text("a,b\n")
+    log = tmp_path / "deps.log"
+    code = tracker_code(log) + "\n".join([
+        "import json, os",
+        "open('data.csv').read()",
+        "open('data.csv').read()",
+        "open('out.txt', 'w').write('x')",
+        "open('out.txt').read()",
+        "os.close(os.open('raw.bin', os.O_WRONLY | os.O_CREAT))",
+    ])
+    subprocess.run([sys.executable, "-c", code], cwd=tmp_path, check=True)
+    entries = log.read_text().splitlines()
+    # Unfiltered, e.g. the modules imported are logged too.
+    assert entries.count(f"r {tmp_path / 'data.csv'}") == 1
+    assert f"w {tmp_path / 'out.txt'}" in entries
+    assert written_files(log) == [str(tmp_path / "out.txt"), str(tmp_path / "raw.bin")]
+    # The files written are outputs of the notebook, even when read back.
+    assert collect_dependencies(log, tmp_path) == {"data.csv": file_hash(tmp_path / "data.csv")}
+
+
+def test_collect_dependencies_keeps_data_files(tmp_path):
+    (tmp_path / "data").mkdir()
+    (tmp_path / "data" / "a.csv").write_text("a\n")
+    log = tmp_path / "deps.log"
+    log.write_text("\n".join([
+        f"r {tmp_path / 'data' / 'a.csv'}",
+        f"r {tmp_path / 'missing.csv'}",
+        f"r {os.__file__}",
+        f"r {log}",
+    ]) + "\n")
+    nb_dir = tmp_path / "examples"
+    assert collect_dependencies(log, nb_dir) == {"../data/a.csv": file_hash(tmp_path / "data" / "a.csv")}
+    assert collect_dependencies(tmp_path / "no.log", nb_dir) == {}
+
+
+def test_collect_dependencies_excludes_the_kernel_environment(tmp_path):
+    (tmp_path / "kernel_env" / "lib").mkdir(parents=True)
+    (tmp_path / "kernel_env" / "lib" / "module.py").write_text("")
+    (tmp_path / "data.csv").write_text("a\n")
+    entries = [f"r {tmp_path / 'kernel_env' / 'lib' / 'module.py'}", f"r {tmp_path / 'data.csv'}"]
+    log = tmp_path / "deps.log"
+    log.write_text("\n".join(entries) + "\n")
+    # Without the prefixes of the kernel, those of the build process.
+    assert sorted(collect_dependencies(log, tmp_path)) == ["data.csv", "kernel_env/lib/module.py"]
+    log.write_text("\n".join([f"x {tmp_path / 'kernel_env'}", *entries]) + "\n")
+    assert sorted(collect_dependencies(log, tmp_path)) == ["data.csv"]
+
+    # Modified during the execution, the content read is unknown.
+    mtime = os.path.getmtime(tmp_path / "data.csv")
+    assert collect_dependencies(log, tmp_path, since=mtime - 1) == {"data.csv": ""}
+
+
+def test_changed_dependencies(tmp_path):
+    (tmp_path / "a.csv").write_text("a\n")
+    (tmp_path / "b.csv").write_text("b\n")
+    nb = nbformat.v4.new_notebook()
+    record_dependencies(nb, {name: file_hash(tmp_path / name) for name in ["a.csv", "b.csv"]})
+    assert notebook_dependencies(nb, tmp_path) == [str(tmp_path / "a.csv"), str(tmp_path / "b.csv")]
+    assert changed_dependencies(nb, tmp_path) == []
+
+    (tmp_path / "a.csv").write_text("changed\n")
+    os.remove(tmp_path / "b.csv")
+    assert changed_dependencies(nb, tmp_path) == ["a.csv", "b.csv"]
+    # Files not modified since are not hashed again.
+    mtime = os.path.getmtime(tmp_path / "a.csv")
+    assert changed_dependencies(nb, tmp_path, since=mtime) == ["b.csv"]
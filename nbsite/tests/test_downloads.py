@@ -0,0 +1,99 @@
+import hashlib
+import socket
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from nbsite.gallery.downloads import DownloadClient
+from nbsite.gallery.gen import _resolve_thumbnail
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Serves the files of the server with an ETag, like a CDN would."""
+
+    def do_GET(self):
+        self.server.seen.append((self.path, self.headers.get('If-None-Match')))
+        data = self.server.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        etag = '"%s"' % hashlib.sha256(data).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    httpd.files, httpd.seen = {}, []
+    httpd.url = f'http://127.0.0.1:{httpd.server_address[1]}'
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_fetch_revalidates_cached_downloads(server, tmp_path):
+    server.files['/thumb.png'] = b'first'
+    client = DownloadClient(cache_dir=str(tmp_path / 'cache'))
+    assert client.fetch(server.url + '/thumb.png') == b'first'
+    assert client.fetch(server.url + '/thumb.png') == b'first'
+    assert server.seen[0][1] is None
+    assert server.seen[1][1] is not None  # revalidated, answered with a 304
+
+    server.files['/thumb.png'] = b'second'
+    assert client.fetch(server.url + '/thumb.png') == b'second'
+    assert client.fetch(server.url + '/missing.png') is None
+
+
+def test_offline_mode_only_uses_the_cache(server, tmp_path):
+    server.files['/thumb.png'] = b'content'
+    DownloadClient(cache_dir=str(tmp_path / 'cache')).fetch(server.url + '/thumb.png')
+    seen = len(server.seen)
+
+    client = DownloadClient(cache_dir=str(tmp_path / 'cache'), offline=True)
+    assert client.fetch(server.url + '/thumb.png') == b'content'
+    assert client.fetch(server.url + '/other.png') is None
+    assert len(server.seen) == seen
+
+
+def test_unreachable_host_is_not_contacted_again(tmp_path, monkeypatch):
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    client = DownloadClient(cache_dir=None, timeout=2)
+    calls = []
+    get = client.session.get
+    monkeypatch.setattr(client.session, 'get', lambda *args, **kwargs: calls.append(args) or get(*args, **kwargs))
+    assert client.fetch(f'http://127.0.0.1:{port}/thumb.png') is None
+    assert client.fetch(f'http://127.0.0.1:{port}/thumb.gif') is None
+    assert len(calls) == 1
+    client.reset()
+    assert client.fetch(f'http://127.0.0.1:{port}/thumb.png') is None
+    assert len(calls) == 2
+
+
+def test_resolve_thumbnail_falls_back_to_gif(server, tmp_path):
+    server.files['/gallery/example.gif'] = b'GIF89a'
+    client = DownloadClient(cache_dir=str(tmp_path / 'cache'))
+    retcode, thumb_path, extension, verb = _resolve_thumbnail(
+        server.url + '/gallery/example', str(tmp_path / 'doc'), 'example',
+        download=True, no_image_thumb=False, client=client,
+    )
+    assert (retcode, extension, verb) == (0, 'gif', 'Successfully downloaded')
+    with open(thumb_path, 'rb') as f:
+        assert f.read() == b'GIF89a'
+    assert [path for path, _ in server.seen] == ['/gallery/example.png', '/gallery/example.gif']
@@ -0,0 +1,78 @@
+import json
+
+import nbformat
+
+from nbsite.execstats import (
+    check_thresholds, execution_stats, notebook_stats, output_size,
+    print_report, record_cell, record_notebook, write_report,
+)
+
+
+def _evaluated(name, durations, started=None):
+    nb = nbformat.v4.new_notebook(cells=[nbformat.v4.new_markdown_cell("# Title")])
+    for i, duration in enumerate(durations):
+        cell = nbformat.v4.new_code_cell(f"step({i})\nmore()")
+        cell.outputs = [nbformat.v4.new_output("stream", text="x" * 10)]
+        record_cell(cell, duration, peak_memory=100 * (i + 1))
+        nb.cells.append(cell)
+    record_notebook(nb, sum(durations) + 1, started=started)
+    return notebook_stats(nb, name)
+
+
+def test_output_size():
+    outputs = [
+        nbformat.v4.new_output("stream", text="abc"),
+        nbformat.v4.new_output("display_data", data={"text/plain": "12345", "application/json": {"a": 1}}),
+    ]
+    assert output_size(outputs) == 3 + 5 + len('{"a": 1}')
+
+
+def test_notebook_stats():
+    stats = _evaluated("nb.ipynb", [0.5, 2])
+    assert stats["duration"] == 3.5
+    assert stats["peak_memory"] == 200
+    assert stats["output_size"] == 20
+    assert [(c["index"], c["source"], c["duration"]) for c in stats["cells"]] == [(1, "step(0)", 0.5), (2, "step(1)", 2)]
+    assert notebook_stats(nbformat.v4.new_notebook(), "unexecuted.ipynb") is None
+
+
+def test_write_report_sorts_by_duration(tmp_path):
+    records = [_evaluated("fast.ipynb", [0.1]), _evaluated("slow.ipynb", [3, 0.2])]
+    write_report(records, tmp_path / "report" / "execution.json")
+    report = json.loads((tmp_path / "report" / "execution.json").read_text())
+    assert [r["notebook"] for r in report["notebooks"]] == ["slow.ipynb", "fast.ipynb"]
+    assert [(c["notebook"], c["duration"]) for c in report["cells"]] == [
+        ("slow.ipynb", 3), ("slow.ipynb", 0.2), ("fast.ipynb", 0.1)
+    ]
+
+
+def test_check_thresholds():
+    records = [_evaluated("fast.ipynb", [0.1]), _evaluated("slow.ipynb", [3, 0.2])]
+    assert check_thresholds(records) == []
+    assert check_thresholds(records, max_notebook_time=2) == ["slow.ipynb took 4.2s to execute (limit 2s)"]
+    assert check_thresholds(records, max_cell_time=1) == ["slow.ipynb cell 1 (step(0)) took 3.0s to execute (limit 1s)"]
+
+
+def test_statistics_executed_before_the_build_are_cached(tmp_path, capsys):
+    from types import SimpleNamespace
+
+    env = SimpleNamespace(nbsite_build_started=100, nbsite_execution_stats={
+        "page": {"old.ipynb": _evaluated("old.ipynb", [3], started=50)},
+        "other": {"new.ipynb": _evaluated("new.ipynb", [2], started=120)},
+        "unknown": {"unknown.ipynb": _evaluated("unknown.ipynb", [5])},
+    })
+    records = execution_stats(env)
+    assert {r["notebook"]: r["cached"] for r in records} == {
+        "old.ipynb": True, "new.ipynb": False, "unknown.ipynb": True,
+    }
+    # Only the notebooks executed by the build are checked.
+    assert check_thresholds(records, max_notebook_time=1, max_cell_time=1) == [
+        "new.ipynb took 3.0s to execute (limit 1s)",
+        "new.ipynb cell 1 (step(0)) took 2.0s to execute (limit 1s)",
+    ]
+    report = write_report(records, tmp_path / "execution.json")
+    assert [c["cached"] for c in report["cells"]] == [True, True, False]
+    print_report(report, "execution.json")
+    out = capsys.readouterr().out
+    assert "2 cached from previous executions" in out
+    assert "old.ipynb  (cached)" in out
@@ -0,0 +1,155 @@
+import json
+import os
+import subprocess
+import time
+
+from types import SimpleNamespace
+
+import pytest
+
+from PIL import Image
+
+from nbsite.gallery.gen import generate_output_thumbnails, generate_thumbnails
+from nbsite.gallery.images import prepare_thumbnails, variant_path
+from nbsite.gallery.manifest import (
+    MANIFEST_FILENAME, ThumbnailManifest, thumbnail_key,
+)
+from nbsite.gallery.thumbnailer import execute
+from nbsite.nbcache import DEFAULT_MAX_SIZE, NotebookCache, notebook_cache_key
+
+
+def _notebook(path, source):
+    nb = {
+        "cells": [{"cell_type": "code", "execution_count": None, "metadata": {}, "outputs": [], "source": source}],
+        "metadata": {}, "nbformat": 4, "nbformat_minor": 2,
+    }
+    path.write_text(json.dumps(nb))
+    return str(path)
+
+
+def test_generate_thumbnails_in_order_with_timeout(tmp_path):
+    files = [
+        _notebook(tmp_path / "slow.ipynb", "import time\ntime.sleep(60)"),
+        _notebook(tmp_path / "ok.ipynb", "import time\ntime.sleep(1)\ndone = True"),
+        _notebook(tmp_path / "error.ipynb", "raise ValueError('no thumbnail')"),
+        _notebook(tmp_path / "ok_too.ipynb", "import time\ntime.sleep(1)\ndone = True"),
+    ]
+    start = time.perf_counter()
+    retcodes = generate_thumbnails(files, str(tmp_path / "dest"), '', workers=4, timeout=3)
+    assert time.perf_counter() - start < 30
+    assert retcodes[1] == retcodes[3] == 0
+    assert retcodes[0] and retcodes[2]
+    assert (tmp_path / "dest" / "thumbnails").is_dir()
+
+
+@pytest.mark.skipif(os.name != "posix", reason="process groups are POSIX only")
+def test_execute_kills_the_processes_started_on_timeout(tmp_path):
+    heartbeat = tmp_path / "heartbeat"
+    child = f"import time\nwhile True:\n    open({str(heartbeat)!r}, 'a').write('.')\n    time.sleep(0.1)\n"
+    code = (
+        "import subprocess, sys, time\n"
+        f"subprocess.Popen([sys.executable, '-c', {child!r}])\n"
+        "time.sleep(60)\n"
+    )
+    with pytest.raises(subprocess.TimeoutExpired):
+        execute(code.encode(), str(tmp_path), dict(os.environ), timeout=5)
+    beats = heartbeat.read_text()
+    time.sleep(1)
+    # The process started by the script no longer runs.
+    assert heartbeat.read_text() == beats
+
+
+PNG_SOURCE = """\
+import io
+from IPython.display import Image
+from PIL import Image as PILImage
+buf = io.BytesIO()
+PILImage.new('RGB', (8, 4), 'red').save(buf, 'PNG')
+Image(data=buf.getvalue())"""
+
+
+def test_generate_output_thumbnails(tmp_path):
+    examples = tmp_path / "examples"
+    examples.mkdir()
+    files = [
+        _notebook(examples / "plot.ipynb", PNG_SOURCE),
+        _notebook(examples / "no_plot.ipynb", "done = True"),
+        _notebook(examples / "skipped.ipynb", PNG_SOURCE),
+        _notebook(examples / "slow.ipynb", "import time\ntime.sleep(120)"),
+    ]
+    dest = tmp_path / "doc"
+    config = SimpleNamespace(
+        nbbuild_cell_timeout=300, nbbuild_ipython_startup=None, nbbuild_patterns_to_take_along=[],
+        nbbuild_cache_dir=str(tmp_path / "cache"), nbbuild_cache_max_size=DEFAULT_MAX_SIZE, nbbuild_env_fingerprint=None,
+        nbbuild_kernel_pool_size=0, nbbuild_execution_concurrency=1,
+    )
+    start = time.perf_counter()
+    retcodes = generate_output_thumbnails(
+        SimpleNamespace(config=config), files, str(dest), skipped=[files[2]], workers=3, timeout=20,
+    )
+
+    # The slow notebook is interrupted after the thumbnail timeout, not the cell timeout.
+    assert time.perf_counter() - start < 60
+    assert retcodes == [0, 1, 1, 1]
+    with Image.open(dest / "thumbnails" / "plot.png") as im:
+        assert im.size == (8, 4)
+    # The notebook directive gets the notebooks evaluated for their thumbnail from the cache.
+    assert not list(dest.glob("*.ipynb"))
+    cache = NotebookCache(str(tmp_path / "cache"), DEFAULT_MAX_SIZE)
+    assert all(notebook_cache_key(f, kernel_name="python3") in cache for f in files[:2])
+
+
+def test_thumbnail_key_depends_on_code_cells_and_settings(tmp_path):
+    path = _notebook(tmp_path / "example.ipynb", "x = 1")
+    settings = {"thumbnail_size": (400, 280), "script_prefix": ""}
+    key = thumbnail_key(path, settings)
+
+    nb = json.loads((tmp_path / "example.ipynb").read_text())
+    nb["cells"].append({"cell_type": "markdown", "metadata": {}, "source": "Some prose"})
+    (tmp_path / "example.ipynb").write_text(json.dumps(nb))
+    assert thumbnail_key(path, settings) == key
+    assert thumbnail_key(path, dict(settings, thumbnail_size=(200, 140))) != key
+    _notebook(tmp_path / "example.ipynb", "x = 2")
+    assert thumbnail_key(path, settings) != key
+
+
+def test_thumbnail_manifest(tmp_path):
+    gallery = tmp_path / "gallery"
+    manifest = ThumbnailManifest(gallery)
+    assert not manifest.is_stale(gallery / "thumbnails" / "hand_made", "key")
+    manifest.record(gallery / "thumbnails" / "generated", "key")
+    manifest.record(gallery / "thumbnails" / "removed", "key")
+    manifest.save()
+    assert json.loads((gallery / MANIFEST_FILENAME).read_text())["thumbnails"] == {
+        "thumbnails/generated": "key", "thumbnails/removed": "key",
+    }
+
+    manifest = ThumbnailManifest(gallery)
+    assert not manifest.is_stale(gallery / "thumbnails" / "generated", "key")
+    assert manifest.is_stale(gallery / "thumbnails" / "generated", "other")
+    manifest.save()
+    # Only the thumbnails still in the gallery are kept.
+    assert json.loads((gallery / MANIFEST_FILENAME).read_text())["thumbnails"] == {"thumbnails/generated": "key"}
+
+
+def test_prepare_thumbnails_is_idempotent(tmp_path):
+    paths = []
+    for i in range(3):
+        path = tmp_path / f"thumb_{i}.png"
+        Image.new("RGB", (800, 400), "blue").save(path)
+        paths.append(str(path))
+    prepare_thumbnails(paths, desired_size=500, formats=["webp"], widths=[250, 500, 1000], workers=2)
+
+    for path in paths:
+        with Image.open(path) as im:
+            assert im.size == (500, 500)
+        with Image.open(variant_path(path, 250, "webp")) as im:
+            assert im.size == (250, 250)
+        assert os.path.isfile(variant_path(path, 500, "webp"))
+        # Not upscaled
+        assert not os.path.isfile(variant_path(path, 1000, "webp"))
+
+    mtimes = [os.path.getmtime(path) for path in paths + [variant_path(paths[0], 250, "webp")]]
+    time.sleep(0.01)
+    prepare_thumbnails(paths, desired_size=500, formats=["webp"], widths=[250, 500])
+    assert [os.path.getmtime(path) for path in paths + [variant_path(paths[0], 250, "webp")]] == mtimes
@@ -0,0 +1,23 @@
+import os
+
+from nbsite import kernelpool
+from nbsite.kernelpool import get_kernel_pool, shutdown_kernel_pools
+
+
+def test_kernel_pools_are_not_shared_with_forked_processes(monkeypatch):
+    pool = get_kernel_pool(0, "python3")
+    assert get_kernel_pool(0, "python3") is pool
+
+    # As seen from a forked process, e.g. a Sphinx read worker.
+    parent = os.getpid()
+    monkeypatch.setattr(os, "getpid", lambda: parent + 1)
+    child_pool = get_kernel_pool(0, "python3")
+    assert child_pool is not pool
+    shutdown_kernel_pools()
+    assert child_pool._closed
+    assert not pool._closed
+
+    monkeypatch.undo()
+    shutdown_kernel_pools()
+    assert pool._closed
+    assert not kernelpool._pools
@@ -1,9 +1,15 @@
 import os
 import textwrap
 
+import nbformat
 import pytest
 
-from nbsite.nbbuild import FixNotebookLinks
+from nbsite.nbbuild import (
+    FixNotebookLinks, NotebookSlice, SkipOutput, SourceIndex, _shallow_copy,
+    build_context, evaluate_notebook, execute_notebooks,
+    find_notebook_directives, read_evaluated_notebook, split_notebook_jobs,
+    wait_for_notebook_writes,
+)
 
 
 class TestFixNotebookLinks:
@@ -154,3 +160,318 @@ class TestFixNotebookLinks:
 
         processor = FixNotebookLinksMockFiles(nb_dir)
         assert processor.replace_notebook_links(text, nb_dir) == expected_output
+
+    def test_replace_notebook_links_with_source_index(self, tmp_path):
+        doc = tmp_path / "doc"
+        (doc / "user_guide").mkdir(parents=True)
+        (doc / "_build").mkdir()
+        (doc / "user_guide" / "first.rst").write_text("")
+        (doc / "Second_Notebook.md").write_text("")
+        (doc / "_build" / "Third.rst").write_text("")
+        (tmp_path / "outside.rst").write_text("")
+        index = SourceIndex(doc, exclude=[doc / "_build"])
+        assert len(index) == 2
+
+        nb = nbformat.v4.new_notebook(cells=[
+            nbformat.v4.new_markdown_cell(
+                "[a](first.ipynb) [b](../02-Second_Notebook.ipynb#spam) [c](../_build/Third.ipynb)"
+            ),
+            nbformat.v4.new_markdown_cell("[d](../../outside.ipynb) [e](missing.ipynb)"),
+        ])
+        processor = FixNotebookLinks(str(doc / "user_guide"), source_index=index)
+        nb, _ = processor(nb, {})
+        assert nb.cells[0].source == "[a](first.rst) [b](../Second_Notebook.md#spam) [c](../_build/Third.ipynb)"
+        # Files outside of the indexed doc tree are looked up on the filesystem.
+        assert nb.cells[1].source == "[d](../../outside.rst) [e](missing.ipynb)"
+        assert processor.unresolved == [
+            ("../_build/Third.ipynb", str(doc / "user_guide")),
+            ("missing.ipynb", str(doc / "user_guide")),
+        ]
+
+
+def test_find_notebook_directives(tmp_path):
+    rst = tmp_path / "doc" / "page.rst"
+    rst.parent.mkdir()
+    rst.write_text(textwrap.dedent(
+        """
+        Title
+        =====
+
+        .. notebook:: project ../examples/first.ipynb
+            :offset: 0
+            :skip_execute: True
+
+        .. notebook:: project ../examples/second.ipynb
+            :skip_exceptions:
+
+        Some text.
+        """
+    ))
+    md = tmp_path / "doc" / "page.md"
+    md.write_text("# Title\n\n```{notebook} project ../examples/third.ipynb\n```\n")
+
+    examples = tmp_path / "examples"
+    assert find_notebook_directives(rst) == [
+        (str(examples / "first.ipynb"), {"offset": "0", "skip_execute": "True"}),
+        (str(examples / "second.ipynb"), {"skip_exceptions": ""}),
+    ]
+    assert find_notebook_directives(md) == [(str(examples / "third.ipynb"), {})]
+
+    md.write_text(textwrap.dedent(
+        """
+        # Title
+
+        ```{notebook} project ../examples/third.ipynb
+        ---
+        skip_execute: true
+        offset: 2
+        skip_exceptions:
+        ---
+        ```
+
+        ```{notebook} project ../examples/fourth.ipynb
+        :offset: 1
+        ```
+        """
+    ))
+    assert find_notebook_directives(md) == [
+        (str(examples / "third.ipynb"), {"skip_execute": "True", "offset": "2", "skip_exceptions": ""}),
+        (str(examples / "fourth.ipynb"), {"offset": "1"}),
+    ]
+
+
+def test_build_context_prefers_config_to_environment(monkeypatch):
+    from types import SimpleNamespace
+
+    monkeypatch.setenv('BRANCH', 'from-env')
+    monkeypatch.setenv('REPO', 'from-env')
+    monkeypatch.delenv('ORG', raising=False)
+    context = build_context(SimpleNamespace(nbbuild_branch='from-config'))
+    assert context['branch'] == 'from-config'
+    assert context['repo'] == 'from-env'
+    assert context['org'] == ''
+    assert context['host'] == 'GitHub'
+
+
+
+def test_split_notebook_jobs_by_directory(tmp_path):
+    jobs = [
+        (str(tmp_path / directory / f"{name}.ipynb"), str(tmp_path / "doc" / f"{name}.ipynb"), False)
+        for directory, name in [("a", "a1"), ("b", "b1"), ("a", "a2"), ("c", "c1"), ("a", "a3")]
+    ]
+    shares = split_notebook_jobs(jobs, 2)
+    assert [[os.path.basename(job[0]) for job in share] for share in shares] == [
+        ["a1.ipynb", "a2.ipynb", "a3.ipynb"], ["b1.ipynb", "c1.ipynb"],
+    ]
+    assert split_notebook_jobs(jobs, 8) == [jobs[0::2], [jobs[1]], [jobs[3]]]
+    assert split_notebook_jobs(jobs, 1) == [jobs[0::2] + [jobs[1], jobs[3]]]
+
+@pytest.mark.slow
+def test_evaluate_notebook_with_kernel_pool(tmp_path):
+    for name, source in [("a", "print(x, os.getcwd())\ny = 1"), ("b", "print(x, 'y' in dir())")]:
+        (tmp_path / name).mkdir()
+        nb = nbformat.v4.new_notebook(cells=[nbformat.v4.new_code_cell("import os\n" + source)])
+        nbformat.write(nb, tmp_path / name / "nb.ipynb")
+        evaluate_notebook(
+            str(tmp_path / name / "nb.ipynb"), str(tmp_path / name / "evaluated.ipynb"),
+            ipython_startup="x = 42", kernel_pool_size=1,
+        )
+
+    # The startup code ran in the warm kernel, moved to the notebook directory.
+    outputs = nbformat.read(tmp_path / "a" / "evaluated.ipynb", as_version=4).cells[0].outputs
+    assert outputs[0]["text"] == f"42 {tmp_path / 'a'}\n"
+    # The recycled kernel was restarted before being reused.
+    outputs = nbformat.read(tmp_path / "b" / "evaluated.ipynb", as_version=4).cells[0].outputs
+    assert outputs[0]["text"] == "42 False\n"
+
+
+@pytest.mark.slow
+def test_evaluate_notebook_hands_over_notebook_in_memory(tmp_path):
+    nb = nbformat.v4.new_notebook(cells=[
+        nbformat.v4.new_markdown_cell("See [other](other.ipynb)"),
+        nbformat.v4.new_code_cell("print('hello')"),
+    ])
+    nbformat.write(nb, tmp_path / "nb.ipynb")
+    dest_path = str(tmp_path / "evaluated.ipynb")
+    notebook = evaluate_notebook(str(tmp_path / "nb.ipynb"), dest_path, background_write=True)
+    assert notebook.cells[1].outputs[0]["text"] == "hello\n"
+
+    # Preprocessing the copy rendered does not modify the notebook written.
+    copy = _shallow_copy(notebook)
+    copy, _ = FixNotebookLinks(str(tmp_path))(copy, {})
+    copy, _ = SkipOutput("print")(copy, {})
+    assert copy.cells[1].outputs == []
+    wait_for_notebook_writes()
+    assert nbformat.read(dest_path, as_version=4) == notebook
+    assert notebook.cells[0].source == "See [other](other.ipynb)"
+    assert not os.path.exists(dest_path + ".tmp")
+    # Already evaluated notebooks are read by the renderer.
+    assert evaluate_notebook(str(tmp_path / "nb.ipynb"), dest_path) is None
+
+
+def test_notebook_slice_does_not_copy_cells():
+    nb = nbformat.v4.new_notebook(cells=[
+        nbformat.v4.new_markdown_cell(source) for source in ["intro", "start here", "middle", "the end", "after"]
+    ])
+    sliced, _ = NotebookSlice("start", "end")(nb, {})
+    assert [cell.source for cell in sliced.cells] == ["start here", "middle", "the end"]
+    assert all(a is b for a, b in zip(sliced.cells, nb.cells[1:4]))
+    assert len(nb.cells) == 5
+
+
+def test_read_evaluated_notebook_is_parsed_once(tmp_path):
+    path = tmp_path / "evaluated.ipynb"
+    nbformat.write(nbformat.v4.new_notebook(cells=[nbformat.v4.new_markdown_cell("a")]), path)
+    first = read_evaluated_notebook(str(path))
+    assert read_evaluated_notebook(str(path)) is first
+
+    nbformat.write(nbformat.v4.new_notebook(cells=[nbformat.v4.new_markdown_cell("changed")]), path)
+    os.utime(path, ns=(0, 0))
+    assert read_evaluated_notebook(str(path)).cells[0].source == "changed"
+
+
+@pytest.mark.slow
+def test_evaluate_notebook_merges_prose_edits_from_cache(tmp_path, capfd):
+    from nbsite.nbcache import NotebookCache
+
+    cache = NotebookCache(tmp_path / "cache")
+    nb = nbformat.v4.new_notebook(cells=[
+        nbformat.v4.new_markdown_cell("A tpyo"),
+        nbformat.v4.new_code_cell("import random\nprint(random.random())"),
+    ])
+    nbformat.write(nb, tmp_path / "nb.ipynb")
+    first = evaluate_notebook(str(tmp_path / "nb.ipynb"), str(tmp_path / "first.ipynb"), cache=cache)
+
+    nb.cells[0].source = "A typo"
+    nbformat.write(nb, tmp_path / "nb.ipynb")
+    capfd.readouterr()
+    second = evaluate_notebook(str(tmp_path / "nb.ipynb"), str(tmp_path / "second.ipynb"), cache=cache)
+    assert "Restored evaluated notebook" in capfd.readouterr().out
+    assert second.cells[0].source == "A typo"
+    assert second.cells[1].outputs == first.cells[1].outputs
+    assert nbformat.read(tmp_path / "second.ipynb", as_version=4) == second
+
+
+@pytest.mark.slow
+def test_execute_notebooks_concurrently_in_notebook_directories(tmp_path):
+    cwd = os.getcwd()
+    jobs = []
+    for name in ["a", "b"]:
+        (tmp_path / name).mkdir()
+        nb = nbformat.v4.new_notebook(cells=[nbformat.v4.new_code_cell(
+            "import os, time\nstart = time.time()\ntime.sleep(2)\nprint(os.getcwd(), start, time.time())"
+        )])
+        nbformat.write(nb, tmp_path / name / "nb.ipynb")
+        jobs.append((str(tmp_path / name / "nb.ipynb"), str(tmp_path / name / "evaluated.ipynb"), False))
+    execute_notebooks(jobs, concurrency=2, ipython_startup=None)
+    assert os.getcwd() == cwd
+
+    intervals = []
+    for name in ["a", "b"]:
+        outputs = nbformat.read(tmp_path / name / "evaluated.ipynb", as_version=4).cells[0].outputs
+        kernel_cwd, start, end = outputs[0]["text"].split()
+        assert kernel_cwd == str(tmp_path / name)
+        intervals.append((float(start), float(end)))
+    # The cells of both notebooks were running at the same time.
+    (start_a, end_a), (start_b, end_b) = intervals
+    assert start_a < end_b and start_b < end_a
+
+
+@pytest.mark.slow
+def test_execute_notebooks_takes_along_the_side_files_they_wrote(tmp_path):
+    examples = tmp_path / "ex"
+    examples.mkdir()
+    (examples / "data.json").write_text("[1, 2]")
+    jobs = []
+    for name in ["A", "B"]:
+        nb = nbformat.v4.new_notebook(cells=[nbformat.v4.new_code_cell(
+            f"import json, time\ndata = json.load(open('data.json'))\ntime.sleep(1)\n"
+            f"json.dump(data, open('json_{name}.json', 'w'))\ntime.sleep(1)\n"
+            # Not seen by the tracker, e.g. written by a compiled library.
+            "import subprocess, sys\n"
+            f"subprocess.run([sys.executable, '-c', \"open('{name}_export.json', 'w').write('{{}}')\"])"
+        )])
+        nbformat.write(nb, examples / f"{name}.ipynb")
+        (tmp_path / name.lower()).mkdir()
+        jobs.append((str(examples / f"{name}.ipynb"), str(tmp_path / name.lower() / f"{name}.ipynb"), False))
+    execute_notebooks(jobs, concurrency=2, ipython_startup=None, patterns_to_take_with_me=["*.json", "json_*"])
+
+    assert sorted(os.listdir(tmp_path / "a")) == ["A.ipynb", "A_export.json", "json_A.json"]
+    assert sorted(os.listdir(tmp_path / "b")) == ["B.ipynb", "B_export.json", "json_B.json"]
+    # The data file read by the notebooks stays in place.
+    assert sorted(os.listdir(examples)) == ["A.ipynb", "B.ipynb", "data.json"]
+
+@pytest.mark.slow
+def test_evaluate_notebook_tracks_data_files(tmp_path, capfd):
+    from nbsite.nbcache import NotebookCache
+
+    cache = NotebookCache(tmp_path / "cache")
+    (tmp_path / "data.csv").write_text("a,b\n1,2\n")
+    nb = nbformat.v4.new_notebook(cells=[nbformat.v4.new_code_cell(
+        "print(open('data.csv').read().splitlines()[-1])\nopen('out.txt', 'w').write('x')"
+    )])
+    nbformat.write(nb, tmp_path / "nb.ipynb")
+    dest_path = str(tmp_path / "evaluated.ipynb")
+    notebook = evaluate_notebook(str(tmp_path / "nb.ipynb"), dest_path, ipython_startup="import json", cache=cache)
+    assert notebook.cells[0].outputs[0]["text"] == "1,2\n"
+    # Only the files read, the file written is not a dependency.
+    assert list(notebook.metadata["nbsite"]["dependencies"]) == ["data.csv"]
+    assert evaluate_notebook(str(tmp_path / "nb.ipynb"), dest_path, cache=cache) is None
+
+    # Touching a data file without changing it keeps the evaluated notebook.
+    os.utime(tmp_path / "data.csv", (os.path.getmtime(dest_path) + 10,) * 2)
+    assert evaluate_notebook(str(tmp_path / "nb.ipynb"), dest_path, cache=cache) is None
+
+    (tmp_path / "data.csv").write_text("a,b\n3,4\n")
+    os.utime(tmp_path / "data.csv", (os.path.getmtime(dest_path) + 10,) * 2)
+    capfd.readouterr()
+    notebook = evaluate_notebook(str(tmp_path / "nb.ipynb"), dest_path, ipython_startup="import json", cache=cache)
+    out = capfd.readouterr().out
+    assert "Data files of the evaluated notebook" in out
+    # The cached execution is outdated too.
+    assert "Data files of the cached notebook" in out
+    assert notebook.cells[0].outputs[0]["text"] == "3,4\n"
+    assert nbformat.read(dest_path, as_version=4).cells[0].outputs[0]["text"] == "3,4\n"
+
+
+@pytest.mark.slow
+def test_evaluate_notebook_detects_data_files_changed_during_execution(tmp_path):
+    from nbsite.nbbuild import is_evaluated
+
+    (tmp_path / "data.csv").write_text("a,b\n1,2\n")
+    nb = nbformat.v4.new_notebook(cells=[nbformat.v4.new_code_cell(
+        "import subprocess, sys\nprint(open('data.csv').read())\n"
+        # Not seen as written by the notebook, e.g. another process.
+        "subprocess.run([sys.executable, '-c', \"open('data.csv', 'w').write('a,b\\\\n3,4\\\\n')\"])"
+    )])
+    nbformat.write(nb, tmp_path / "nb.ipynb")
+    dest_path = str(tmp_path / "evaluated.ipynb")
+    notebook = evaluate_notebook(str(tmp_path / "nb.ipynb"), dest_path, ipython_startup=None)
+    assert notebook.cells[0].outputs[0]["text"] == "a,b\n1,2\n\n"
+    assert (tmp_path / "data.csv").read_text() == "a,b\n3,4\n"
+    assert notebook.metadata["nbsite"]["dependencies"] == {"data.csv": ""}
+    assert not is_evaluated(str(tmp_path / "nb.ipynb"), dest_path)
+
+
+def test_select_shared_payloads_counts_the_documents():
+    from types import SimpleNamespace
+
+    from docutils import nodes
+
+    from nbsite.nbbuild import record_payloads, select_shared_payloads
+
+    # Repeated in a single document, a script is not shared.
+    script = "<script>" + "x" * 100 + "</script>"
+    env = SimpleNamespace(config=SimpleNamespace(nbbuild_shared_payload_min_size=10), docname="one")
+    record_payloads(env, [nodes.raw("", script * 2, format="html"), nodes.raw("", script, format="html")])
+    assert select_shared_payloads(None, env) == []
+
+    env = SimpleNamespace(nbsite_payloads={"one": {"a", "b"}, "two": {"a"}, "three": {"c"}})
+    assert select_shared_payloads(None, env) == ["one", "two"]
+    assert env.nbsite_shared_payloads == {"a"}
+    assert select_shared_payloads(None, env) == []
+
+    del env.nbsite_payloads["two"]
+    # The document left with a payload no longer shared is written again.
+    assert select_shared_payloads(None, env) == ["one"]
+    assert env.nbsite_shared_payloads == set()
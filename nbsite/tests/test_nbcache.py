@@ -0,0 +1,111 @@
+import os
+
+import nbformat
+
+from nbsite.nbcache import (
+    NotebookCache, environment_fingerprint, merge_outputs, notebook_cache_key,
+)
+
+
+def _write(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content)
+    return path
+
+
+def _notebook(*cells):
+    return nbformat.v4.new_notebook(cells=[
+        nbformat.v4.new_code_cell(source[5:]) if source.startswith("code:") else nbformat.v4.new_markdown_cell(source)
+        for source in cells
+    ])
+
+
+def test_notebook_cache_key_depends_on_inputs(tmp_path):
+    nb = tmp_path / "nb.ipynb"
+    nbformat.write(_notebook("# Title", "code:x = 1"), nb)
+    key = notebook_cache_key(nb, ipython_startup="import os", kernel_name="python3")
+    assert key == notebook_cache_key(nb, ipython_startup="import os", kernel_name="python3")
+    assert key != notebook_cache_key(nb, ipython_startup="", kernel_name="python3")
+    assert key != notebook_cache_key(nb, ipython_startup="import os", kernel_name="python3", env_fingerprint="abc")
+    assert key != notebook_cache_key(nb, ipython_startup="import os", kernel_name="python3", allow_errors=True)
+    nbformat.write(_notebook("# Title", "code:x = 2"), nb)
+    assert key != notebook_cache_key(nb, ipython_startup="import os", kernel_name="python3")
+
+
+def test_notebook_cache_key_ignores_non_code_cells():
+    key = notebook_cache_key(_notebook("# Title", "code:x = 1", "code:x"))
+    assert key == notebook_cache_key(_notebook("# New title", "Some prose", "code:x = 1", "code:x"))
+    assert key != notebook_cache_key(_notebook("# Title", "code:x", "code:x = 1"))
+    tagged = _notebook("# Title", "code:x = 1", "code:x")
+    tagged.cells[1].metadata.tags = ["raises-exception"]
+    assert key != notebook_cache_key(tagged)
+
+
+def test_merge_outputs_keeps_new_prose():
+    evaluated = _notebook("# Title", "code:print(1)", "Typo")
+    evaluated.cells[1].outputs = [nbformat.v4.new_output("stream", text="1\n")]
+    evaluated.cells[1].execution_count = 1
+    evaluated.metadata.language_info = {"name": "python"}
+    edited = _notebook("# Title", "Added", "code:print(1)", "Fixed typo")
+    merged = merge_outputs(edited, evaluated)
+    assert [cell.source for cell in merged.cells] == ["# Title", "Added", "print(1)", "Fixed typo"]
+    assert merged.cells[2].outputs[0].text == "1\n"
+    assert merged.cells[2].execution_count == 1
+    assert merged.metadata.language_info.name == "python"
+    assert edited.cells[2].outputs == []
+
+
+def test_notebook_cache_store_and_load(tmp_path):
+    cache = NotebookCache(tmp_path / "cache")
+    evaluated = tmp_path / "build" / "nb.ipynb"
+    evaluated.parent.mkdir()
+    nbformat.write(_notebook("# Evaluated"), evaluated)
+    side_file = _write(tmp_path / "build" / "plot.json", "{}")
+    assert cache.load("abcd", tmp_path / "other") is None
+
+    cache.store("abcd", evaluated, [side_file])
+    assert "abcd" in cache
+
+    dest_dir = tmp_path / "other"
+    dest_dir.mkdir()
+    assert cache.load("abcd", dest_dir).cells[0].source == "# Evaluated"
+    assert (dest_dir / "plot.json").read_text() == "{}"
+
+
+def test_notebook_cache_evicts_least_recently_used(tmp_path):
+    cache = NotebookCache(tmp_path / "cache", max_size=25)
+    evaluated = _write(tmp_path / "nb.ipynb", "x" * 10)
+    cache.store("aa01", evaluated)
+    cache.store("aa02", evaluated)
+    # Mark the first entry as the least recently used one.
+    os.utime(cache._entry_dir("aa01"), (0, 0))
+    cache.store("aa03", evaluated)
+    assert "aa01" not in cache
+    assert "aa02" in cache
+    assert "aa03" in cache
+
+
+def test_notebook_cache_only_scans_the_entries_when_full(tmp_path, monkeypatch):
+    cache = NotebookCache(tmp_path / "cache", max_size=35)
+    evaluated = _write(tmp_path / "nb.ipynb", "x" * 10)
+    scans = []
+    evict = cache.evict
+    monkeypatch.setattr(cache, "evict", lambda: scans.append(1) or evict())
+    for key in ("aa01", "aa02", "aa03"):
+        cache.store(key, evaluated)
+    # Once to get the size of the cache.
+    assert len(scans) == 1
+    cache.store("aa04", evaluated)
+    assert len(scans) == 2
+    # Brought back under the target size.
+    assert sum(key in cache for key in ("aa01", "aa02", "aa03", "aa04")) == 3
+
+
+def test_environment_fingerprint_changes_with_the_installed_packages(tmp_path, monkeypatch):
+    fingerprint = environment_fingerprint.__wrapped__()
+    assert fingerprint == environment_fingerprint.__wrapped__()
+
+    # As if a package was installed or upgraded.
+    _write(tmp_path / "site" / "nbsite_fake-1.0.dist-info" / "METADATA", "Name: nbsite-fake\nVersion: 1.0\n")
+    monkeypatch.setenv("PYTHONPATH", str(tmp_path / "site"))
+    assert environment_fingerprint.__wrapped__() != fingerprint
@@ -0,0 +1,47 @@
+import pickle
+
+from docutils import nodes
+
+from nbsite.outputstore import (
+    OutputStore, resolve_outputs, store_outputs, stored_output,
+)
+
+
+def _rendered(payload):
+    container = nodes.container(classes=["cell_output"])
+    container += nodes.raw("", "<b>small</b>", format="html")
+    container += nodes.raw("", payload, format="html", classes=["output", "text_html"])
+    return [nodes.paragraph(text="Some text"), container, nodes.raw("", payload, format="html")]
+
+
+def test_store_outputs_replaces_large_raw_nodes(tmp_path):
+    store = OutputStore(tmp_path / "store")
+    payload = "<div>" + "x" * 1000 + "</div>"
+    node_list = _rendered(payload)
+    keys = store_outputs(node_list, store, min_size=100)
+
+    assert len(keys) == 1
+    assert store.keys() == keys
+    assert isinstance(node_list[2], stored_output)
+    placeholder = node_list[1][1]
+    assert isinstance(placeholder, stored_output)
+    assert placeholder["classes"] == ["output", "text_html"]
+    assert node_list[1][0].astext() == "<b>small</b>"
+    assert len(pickle.dumps(node_list)) < len(payload)
+
+    doctree = nodes.document(None, None)
+    doctree.extend(node_list)
+    resolve_outputs(doctree, store)
+    raws = list(doctree.findall(nodes.raw))
+    assert [raw.astext() for raw in raws] == ["<b>small</b>", payload, payload]
+    assert raws[1]["classes"] == ["output", "text_html"]
+    assert raws[1]["format"] == "html"
+
+
+def test_output_store_discard(tmp_path):
+    store = OutputStore(tmp_path / "store")
+    first, second = store.put("first"), store.put("second")
+    assert store.put("first") == first
+    assert store.get(second) == "second"
+    store.discard({first, "unknown"})
+    assert store.keys() == {second}
@@ -0,0 +1,88 @@
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import sphinx.builders
+
+from sphinx.errors import SphinxParallelError
+from sphinx.util.parallel import ParallelTasks, parallel_available
+
+from nbsite.parallel import (
+    MemoryAwareParallelTasks, memory_aware_parallel, parse_memory_size,
+)
+
+pytestmark = pytest.mark.skipif(not parallel_available, reason="Sphinx parallel builds require fork")
+
+
+def _die_once(marker):
+    if not os.path.exists(marker):
+        open(marker, 'w').close()
+        # Simulates a worker killed by the OOM killer.
+        os._exit(137)
+    return 'done'
+
+
+def _always_die(arg):
+    os._exit(137)
+
+
+def _allocate(size):
+    data = bytearray(b'\x01') * size
+    time.sleep(1.5)
+    return len(data)
+
+
+def test_parse_memory_size():
+    assert parse_memory_size(None) is None
+    assert parse_memory_size(1024) == 1024
+    assert parse_memory_size('512') == 512
+    assert parse_memory_size('512M') == 512 * 1024**2
+    assert parse_memory_size('16G') == 16 * 1024**3
+    assert parse_memory_size('1.5GiB') == int(1.5 * 1024**3)
+    with pytest.raises(ValueError):
+        parse_memory_size('lots')
+
+
+def test_dead_worker_chunk_is_resubmitted(tmp_path):
+    results = []
+    tasks = MemoryAwareParallelTasks(2)
+    for i in range(3):
+        tasks.add_task(_die_once, str(tmp_path / f'marker{i}'), lambda arg, result: results.append(result))
+    tasks.join()
+    assert results == ['done'] * 3
+    assert [event['reason'] for event in tasks.events] == ['died'] * 3
+    assert all(event['exitcode'] == 137 for event in tasks.events)
+
+
+def test_worker_dying_repeatedly_fails(tmp_path):
+    tasks = MemoryAwareParallelTasks(2, max_retries=1)
+    tasks.add_task(_always_die, 'chunk')
+    with pytest.raises(SphinxParallelError):
+        tasks.join()
+    assert len(tasks.events) == 1
+
+
+def test_workers_are_kept_within_memory_budget():
+    pytest.importorskip('psutil')
+    size = 100 * 1024**2
+    results = []
+    tasks = MemoryAwareParallelTasks(4, max_memory=250 * 1024**2)
+    for _ in range(4):
+        tasks.add_task(_allocate, size, lambda arg, result: results.append(result))
+    tasks.join()
+    assert results == [size] * 4
+    assert tasks.events
+    assert all(event['reason'] != 'died' for event in tasks.events)
+
+
+def test_memory_aware_parallel_applies_to_the_current_thread():
+    with memory_aware_parallel('1G'):
+        tasks = sphinx.builders.ParallelTasks(2)
+        assert isinstance(tasks, MemoryAwareParallelTasks)
+        assert tasks.max_memory == 1024**3
+        with ThreadPoolExecutor(1) as executor:
+            other = executor.submit(sphinx.builders.ParallelTasks, 2).result()
+        assert type(other) is ParallelTasks
+    assert sphinx.builders.ParallelTasks is ParallelTasks
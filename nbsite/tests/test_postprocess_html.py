@@ -0,0 +1,77 @@
+import os
+
+import pytest
+
+from nbsite.scripts import (
+    HtmlTransform, clean_dist_html, fix_links, postprocess_html,
+)
+from nbsite.scripts._fix_links import LINK_TRANSFORMS
+
+PAGE = '<html><body>{}</body></html>'
+
+
+def _add_footer(soup, html_file):
+    soup.body.append(soup.new_tag('footer'))
+    return True
+
+
+def _uppercase_title(text, html_file):
+    return text.replace('<title>page</title>', '<title>PAGE</title>')
+
+
+@pytest.fixture
+def output(tmp_path):
+    output = tmp_path / 'builtdocs'
+    (output / '_sources').mkdir(parents=True)
+    (output / '_sources' / 'index.rst.txt').write_text('source')
+    (output / 'user_guide').mkdir()
+    (output / 'index.html').write_text(PAGE.format('<a href="user_guide/1_Intro.ipynb">intro</a>'))
+    (output / 'plain.html').write_text(PAGE.format('<p>nothing to fix</p>'))
+    (output / 'user_guide' / 'Intro.html').write_text(PAGE.format('<a href="https://holoviz.org">x</a>'))
+    (output / 'user_guide' / 'Intro.ipynb').write_text('{}')
+    return output
+
+
+def test_postprocess_html_fixes_links_and_cleans(output, capsys):
+    plain_mtime = os.stat(output / 'plain.html').st_mtime_ns
+    changed = postprocess_html(str(output), transforms=LINK_TRANSFORMS, clean=True, inspect_links=True)
+    assert changed == [str(output / 'index.html')]
+    assert 'href="user_guide/Intro.html"' in (output / 'index.html').read_text()
+    assert os.stat(output / 'plain.html').st_mtime_ns == plain_mtime
+    assert not (output / '_sources').exists()
+    assert not (output / 'user_guide' / 'Intro.ipynb').exists()
+    assert 'https://holoviz.org' in capsys.readouterr().out
+
+
+def test_postprocess_html_dry_run_keeps_files(output):
+    postprocess_html(str(output), transforms=[], clean=True, dry_run=True)
+    assert (output / '_sources').is_dir()
+    assert (output / 'user_guide' / 'Intro.ipynb').is_file()
+
+
+def test_postprocess_html_warns_about_missing_links(output):
+    (output / 'plain.html').write_text(PAGE.format('<a href="Missing.ipynb">missing</a>'))
+    with pytest.warns(UserWarning, match='Found missing link Missing.html'):
+        fix_links(str(output))
+
+
+def test_postprocess_html_runs_transforms_in_parallel(tmp_path):
+    for i in range(100):
+        (tmp_path / f'page{i}.html').write_text('<html><head><title>page</title></head><body></body></html>')
+    transforms = [
+        HtmlTransform('title', _uppercase_title, text=True),
+        HtmlTransform('footer', _add_footer),
+    ]
+    changed = postprocess_html(str(tmp_path), transforms=transforms, workers=2)
+    assert len(changed) == 100
+    for i in range(100):
+        html = (tmp_path / f'page{i}.html').read_text()
+        assert '<title>PAGE</title>' in html
+        assert '<footer></footer>' in html
+
+
+def test_clean_dist_html(output):
+    clean_dist_html(str(output), False)
+    assert not (output / '_sources').exists()
+    assert not (output / 'user_guide' / 'Intro.ipynb').exists()
+    assert (output / 'index.html').is_file()
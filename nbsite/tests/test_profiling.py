@@ -0,0 +1,71 @@
+import json
+import threading
+
+from nbsite import profiling
+
+
+def test_span_is_noop_when_disabled(tmp_path):
+    with profiling.span('phase'):
+        pass
+    assert profiling.events_dir() is None
+
+
+def test_profiled_writes_report_and_trace(tmp_path):
+    with profiling.profiled(str(tmp_path)):
+        with profiling.span('notebook.execute', notebook='a.ipynb'):
+            pass
+        with profiling.span('notebook.execute', notebook='b.ipynb'):
+            pass
+        with profiling.span('gallery.thumbnail_fetch', gallery='gallery', section='demos', backend=''):
+            pass
+    assert profiling.events_dir() is None
+
+    report = json.loads((tmp_path / profiling.REPORT_FILENAME).read_text())
+    phases = {phase['name']: phase for phase in report['phases']}
+    assert phases['notebook.execute']['count'] == 2
+    assert phases['notebook.execute']['category'] == 'notebook'
+    assert phases['build']['count'] == 1
+    assert {span['args'].get('notebook') for span in report['spans']} >= {'a.ipynb', 'b.ipynb'}
+    assert report['gallery_sections'][0]['section'] == 'demos'
+    assert report['gallery_sections'][0]['items'] == 1
+
+    trace = json.loads((tmp_path / profiling.TRACE_FILENAME).read_text())
+    assert len(trace['traceEvents']) == 4
+    assert all(event['ph'] == 'X' for event in trace['traceEvents'])
+
+
+def test_profiled_discards_previous_events(tmp_path):
+    with profiling.profiled(str(tmp_path)):
+        with profiling.span('phase'):
+            pass
+    with profiling.profiled(str(tmp_path)):
+        pass
+    report = json.loads((tmp_path / profiling.REPORT_FILENAME).read_text())
+    assert [phase['name'] for phase in report['phases']] == ['build']
+
+
+def test_concurrent_builds_have_their_own_profile(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+
+    barrier = threading.Barrier(2)
+
+    def work(name):
+        with profiling.span(f'{name}.worker'):
+            pass
+
+    def build(name):
+        with profiling.profiled(str(tmp_path / name)):
+            barrier.wait()
+            with profiling.span(f'{name}.phase'):
+                pass
+            # The threads the build hands work over to are bound to its profile.
+            with ThreadPoolExecutor(1) as executor:
+                executor.submit(profiling.bind(work), name).result()
+                executor.submit(work, 'unbound').result()
+            barrier.wait()
+
+    with ThreadPoolExecutor(2) as executor:
+        list(executor.map(build, ['a', 'b']))
+    for name in ['a', 'b']:
+        report = json.loads((tmp_path / name / profiling.REPORT_FILENAME).read_text())
+        assert {phase['name'] for phase in report['phases']} == {'build', f'{name}.phase', f'{name}.worker'}
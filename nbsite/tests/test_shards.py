@@ -0,0 +1,61 @@
+import json
+
+import pytest
+
+from nbsite.shards import (
+    install_artifacts, parse_shard, read_manifest, read_manifests, shard_of,
+    write_manifest,
+)
+
+
+def test_parse_shard():
+    assert parse_shard("2/4") == (2, 4)
+    assert parse_shard(" 1 / 1 ") == (1, 1)
+    for spec in ["0/4", "5/4", "2", "a/b"]:
+        with pytest.raises(ValueError):
+            parse_shard(spec)
+
+
+def test_shard_of_partitions_paths():
+    paths = [f"gallery/section/notebook_{i}.ipynb" for i in range(100)]
+    shards = [shard_of(path, 4) for path in paths]
+    assert set(shards) == {1, 2, 3, 4}
+    # The same on every machine and run.
+    assert shard_of("user_guide/Intro.ipynb", 4) == shard_of("user_guide/Intro.ipynb", 4)
+    assert all(shard_of(path, 1) == 1 for path in paths)
+
+
+def test_install_artifacts(tmp_path):
+    artifacts = tmp_path / "executed"
+    (artifacts / "gallery").mkdir(parents=True)
+    (artifacts / "gallery" / "a.ipynb").write_text("{}")
+    (artifacts / "gallery" / "a_data.json").write_text("[]")
+    # Left over by a previous execution.
+    (artifacts / "gallery" / "removed.ipynb").write_text("{}")
+    a = {"key": "abc", "files": ["gallery/a.ipynb", "gallery/a_data.json"]}
+    write_manifest(artifacts, 1, 2, {"gallery/a.ipynb": a})
+    assert read_manifest(artifacts, 1, 2) == {"gallery/a.ipynb": a}
+    assert read_manifest(artifacts, 2, 2) == {}
+    with pytest.raises(Exception, match="missing the shards 2 of 2"):
+        install_artifacts(artifacts, tmp_path / "doc")
+
+    write_manifest(artifacts, 2, 2, {"b.ipynb": {"key": "def", "files": ["b.ipynb"]}})
+    with pytest.raises(Exception, match="b.ipynb of shard 2 is missing"):
+        install_artifacts(artifacts, tmp_path / "doc")
+    (artifacts / "b.ipynb").write_text("{}")
+    assert [list(m["notebooks"]) for m in read_manifests(artifacts)] == [["gallery/a.ipynb"], ["b.ipynb"]]
+    installed = install_artifacts(artifacts, tmp_path / "doc")
+    assert sorted(installed) == sorted(
+        str(tmp_path / "doc" / path) for path in ["b.ipynb", "gallery/a.ipynb", "gallery/a_data.json"]
+    )
+    assert not list((tmp_path / "doc").glob("nbsite-shard-*"))
+
+
+def test_read_manifests_rejects_mixed_shard_counts(tmp_path):
+    write_manifest(tmp_path, 1, 2, {})
+    write_manifest(tmp_path, 1, 3, {})
+    with pytest.raises(Exception, match="different numbers of shards"):
+        read_manifests(tmp_path)
+    with pytest.raises(Exception, match="No executed notebooks"):
+        read_manifests(tmp_path / "empty")
+    assert json.loads((tmp_path / "nbsite-shard-1-of-2.json").read_text())["count"] == 2
@@ -0,0 +1,55 @@
+from nbsite.sharedassets import (
+    find_payloads, hoist_payloads, payload_hash, remove_unused,
+)
+
+SCRIPT = "console.log('loader');" * 10
+STYLE = ".bk-root { color: red; }" * 10
+MODULE = "import './widget.js';" * 10
+
+
+def _page(data='{"doc": 1}'):
+    return (
+        f'<div><script type="text/javascript">{SCRIPT}</script>'
+        f'<style>{STYLE}</style>'
+        f'<script type="application/json">{data * 50}</script>'
+        f'<script src="https://cdn.example.com/bokeh.js">{SCRIPT}</script>'
+        f'<script>small()</script>'
+        f'<script type="module">{MODULE}</script></div>'
+    )
+
+
+def test_find_payloads_skips_data_small_and_external_scripts():
+    assert find_payloads(_page(), min_size=100) == [payload_hash(SCRIPT), payload_hash(STYLE)]
+    assert find_payloads("<div>no script</div>", min_size=0) == []
+
+
+def test_hoist_payloads(tmp_path):
+    static_dir = tmp_path / "_static" / "nbsite"
+    hoisted = {payload_hash(SCRIPT), payload_hash(STYLE)}
+    html = hoist_payloads(_page(), hoisted, str(static_dir), "../_static/nbsite", min_size=100)
+
+    script_file = payload_hash(SCRIPT) + ".js"
+    style_file = payload_hash(STYLE) + ".css"
+    assert SCRIPT not in html.replace(f'<script src="https://cdn.example.com/bokeh.js">{SCRIPT}', '')
+    assert f'<script type="text/javascript" src="../_static/nbsite/{script_file}"></script>' in html
+    assert f'<link rel="stylesheet" href="../_static/nbsite/{style_file}">' in html
+    assert '<script type="application/json">' in html
+    assert "<script>small()</script>" in html
+    # Its relative imports would be resolved against the static file URL.
+    assert f'<script type="module">{MODULE}</script>' in html
+    assert (static_dir / script_file).read_text() == SCRIPT
+    assert (static_dir / style_file).read_text() == STYLE
+
+    # Only the payloads selected are hoisted.
+    html = hoist_payloads(_page(), {payload_hash(STYLE)}, str(static_dir), "_static/nbsite", min_size=100)
+    assert f'<script type="text/javascript">{SCRIPT}</script>' in html
+
+
+def test_remove_unused(tmp_path):
+    static_dir = tmp_path / "_static" / "nbsite"
+    hoist_payloads(_page(), {payload_hash(SCRIPT), payload_hash(STYLE)}, str(static_dir), "_static/nbsite", min_size=100)
+    (static_dir / "README.txt").write_text("kept")
+
+    remove_unused(str(static_dir), {payload_hash(STYLE)})
+    assert {p.name for p in static_dir.iterdir()} == {"README.txt", payload_hash(STYLE) + ".css"}
+    remove_unused(str(tmp_path / "missing"), set())
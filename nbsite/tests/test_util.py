@@ -1,6 +1,8 @@
+import os
+
 import pytest
 
-from nbsite.util import base_version
+from nbsite.util import base_version, copy_files
 
 
 @pytest.mark.parametrize(
@@ -21,3 +23,70 @@ from nbsite.util import base_version
 )
 def test_base_version(version, expected):
     assert base_version(version) == expected
+
+
+def _write(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content)
+    return path
+
+
+@pytest.fixture
+def src(tmp_path):
+    src = tmp_path / "src"
+    _write(src / "blob.json", "{}")
+    _write(src / "json_blob", "data")
+    _write(src / "topics" / "nested.json", "[]")
+    _write(src / "topics" / "json_nested", "data")
+    _write(src / ".hidden" / "hidden.json", "{}")
+    _write(src / "page.rst", "text")
+    return src
+
+
+def test_copy_files_matches_patterns_in_one_walk(src, tmp_path):
+    dest = tmp_path / "dest"
+    copied = copy_files(str(src), str(dest), ['**/*.json', 'json_*'])
+    assert sorted(os.path.relpath(path, dest) for path in copied) == sorted([
+        "blob.json", "json_blob", os.path.join("topics", "nested.json"),
+    ])
+    assert (dest / "topics" / "nested.json").read_text() == "[]"
+    assert copy_files(str(src), str(dest), ['**/*.json', 'json_*']) == []
+
+
+@pytest.mark.parametrize("check", ["size", "mtime", "hash"])
+def test_copy_files_replaces_stale_files(src, tmp_path, check):
+    dest = tmp_path / "dest"
+    copy_files(str(src), str(dest), "*.rst", check=check)
+    (src / "page.rst").write_text("new text")
+    assert copy_files(str(src), str(dest), "*.rst", check=check)
+    assert (dest / "page.rst").read_text() == "new text"
+
+
+def test_copy_files_hash_check_detects_same_size_changes(src, tmp_path):
+    dest = tmp_path / "dest"
+    copy_files(str(src), str(dest), "*.rst")
+    stat = os.stat(src / "page.rst")
+    (src / "page.rst").write_text("TEXT")
+    os.utime(src / "page.rst", ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert copy_files(str(src), str(dest), "*.rst", check="mtime") == []
+    assert copy_files(str(src), str(dest), "*.rst", check="hash")
+    assert (dest / "page.rst").read_text() == "TEXT"
+
+
+def test_copy_files_exists_check_keeps_files(src, tmp_path):
+    dest = tmp_path / "dest"
+    _write(dest / "page.rst", "edited")
+    assert copy_files(str(src), str(dest), "*.rst", check="exists") == []
+    assert (dest / "page.rst").read_text() == "edited"
+
+
+def test_copy_files_hardlink(src, tmp_path):
+    dest = tmp_path / "dest"
+    copy_files(str(src), str(dest), "*.rst", link="hardlink")
+    assert os.path.samefile(src / "page.rst", dest / "page.rst")
+    # Updating the copy replaces the link instead of writing through it.
+    (src / "page.rst").unlink()
+    _write(src / "page.rst", "new text")
+    copy_files(str(src), str(dest), "*.rst", link=None)
+    assert (dest / "page.rst").read_text() == "new text"
+    assert not os.path.samefile(src / "page.rst", dest / "page.rst")
@@ -1,23 +1,191 @@
-import glob
+import hashlib
 import os
 import re
 import shutil
+import uuid
 
+from concurrent.futures import ThreadPoolExecutor
 
-def copy_files(src, dest, pattern='**'):
+# How copy_files decides that an existing destination file is stale.
+COPY_CHECKS = ('exists', 'size', 'mtime', 'hash')
+
+# FICLONE ioctl of Linux, cloning a file on copy-on-write filesystems
+# (btrfs, XFS, ...).
+_FICLONE = 0x40049409
+
+# Devices on which reflinks or hardlinks were found not to be supported.
+_unsupported_links = set()
+
+
+def _component_regex(component):
+    regex = '' if component.startswith('.') else r'(?!\.)'
+    i = 0
+    while i < len(component):
+        c = component[i]
+        i += 1
+        if c == '*':
+            regex += '[^/]*'
+        elif c == '?':
+            regex += '[^/]'
+        elif c == '[':
+            end = component.find(']', i + 1)
+            if end == -1:
+                regex += re.escape(c)
+            else:
+                chars = component[i:end]
+                if chars.startswith('!'):
+                    chars = '^' + chars[1:]
+                regex += '[%s]' % chars.replace('\\', '\\\\')
+                i = end + 1
+        else:
+            regex += re.escape(c)
+    return regex
+
+
+def pattern_regex(pattern):
+    """Compile a recursive glob pattern to a regex matching relative paths.
+
+    Like glob.glob(pattern, recursive=True): ``**`` matches any number of
+    directories, ``*`` does not cross directories and hidden files and
+    directories are only matched explicitly.
+    """
+    components = pattern.replace(os.sep, '/').split('/')
+    regex = ''
+    for n, component in enumerate(components):
+        last = n == len(components) - 1
+        if component == '**':
+            regex += r'(?:(?!\.)[^/]+/)*' if not last else r'(?:(?!\.)[^/]+/)*(?!\.)[^/]+'
+        else:
+            regex += _component_regex(component) + ('' if last else '/')
+    return re.compile(regex + r'\Z')
+
+
+def _file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(block)
+    return h.digest()
+
+
+def _is_stale(src, dest, check):
+    try:
+        dest_stat = os.stat(dest)
+    except FileNotFoundError:
+        return True
+    if check == 'exists':
+        return False
+    src_stat = os.stat(src)
+    if (src_stat.st_dev, src_stat.st_ino) == (dest_stat.st_dev, dest_stat.st_ino):
+        return False
+    if src_stat.st_size != dest_stat.st_size:
+        return True
+    if check == 'mtime':
+        # Copies keep the source modification time, up to the precision of
+        # the destination filesystem.
+        return abs(src_stat.st_mtime - dest_stat.st_mtime) > 1
+    if check == 'hash':
+        return _file_hash(src) != _file_hash(dest)
+    return False
+
+
+def _reflink(src, dest):
+    import fcntl
+    with open(src, 'rb') as fsrc, open(dest, 'wb') as fdest:
+        fcntl.ioctl(fdest.fileno(), _FICLONE, fsrc.fileno())
+    shutil.copystat(src, dest)
+
+
+def _link_or_copy(src, dest, link):
+    """Atomically replace dest by a link to or a copy of src."""
+    device = (os.stat(src).st_dev, os.stat(os.path.dirname(dest)).st_dev)
+    tmp = os.path.join(os.path.dirname(dest), '.%s.%s.tmp' % (os.path.basename(dest), uuid.uuid4().hex[:8]))
+    try:
+        for method in (('hardlink', 'reflink') if link == 'hardlink' else ('reflink',) if link else ()):
+            if (method, device) in _unsupported_links:
+                continue
+            try:
+                if method == 'hardlink':
+                    os.link(src, tmp)
+                else:
+                    _reflink(src, tmp)
+                break
+            except (OSError, ImportError):
+                _unsupported_links.add((method, device))
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+        else:
+            shutil.copy2(src, tmp)
+        # Replacing rather than writing in place never modifies a file
+        # hardlinked by a previous run.
+        os.replace(tmp, dest)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def copy_files(src, dest, pattern='**', check='mtime', link='reflink', workers=None):
     """Copy every file matching pattern from src to dest
+
+    Parameters
+    ----------
+    src: str
+        The source directory.
+    dest: str
+        The destination directory.
+    pattern: str | list[str]
+        Recursive glob pattern(s), relative to src, of the files to copy.
+        Several patterns are matched in a single walk of src.
+    check: str
+        How an existing destination file is found stale and replaced:
+        'exists' never replaces it, 'size' compares the sizes, 'mtime' the
+        sizes and modification times and 'hash' the sizes and contents.
+    link: str | None
+        'hardlink' to hardlink the files when src and dest are on the same
+        filesystem, 'reflink' to clone them on copy-on-write filesystems,
+        the files being copied when not supported or with None.
+    workers: int | None
+        Number of threads copying the files.
+
+    Returns the list of destination files that were copied.
     """
-    for path in glob.glob(os.path.join(src, pattern), recursive=True):
-        if not os.path.isfile(path):
-            continue
-        d = os.path.join(dest, os.path.dirname(path.split(src)[1][1:]))
+    if check not in COPY_CHECKS:
+        raise ValueError(f'check must be one of {COPY_CHECKS}, not {check!r}')
+    patterns = [pattern] if isinstance(pattern, str) else list(pattern)
+    regexes = [pattern_regex(p) for p in patterns]
+    # Without **, the depth of the matched files is bounded.
+    max_depth = None
+    if not any('**' in p for p in patterns):
+        max_depth = max(p.replace(os.sep, '/').count('/') for p in patterns)
+
+    src = os.path.abspath(src)
+    jobs = []
+    for root, dirs, files in os.walk(src):
+        relroot = os.path.relpath(root, src).replace(os.sep, '/')
+        relroot = '' if relroot == '.' else relroot + '/'
+        if max_depth is not None and relroot.count('/') >= max_depth:
+            dirs[:] = []
+        for name in files:
+            relpath = relroot + name
+            if any(regex.match(relpath) for regex in regexes):
+                jobs.append((os.path.join(root, name), os.path.join(dest, *relpath.split('/'))))
+
+    stale = [(s, d) for s, d in jobs if _is_stale(s, d, check)]
+    for d in sorted({os.path.dirname(d) for _, d in stale}):
         if not os.path.exists(d):
             print('mkdir %s'%d)
-            os.makedirs(d)
-        f = os.path.join(dest, path.split(src)[1][1:])
-        if not os.path.exists(f):
-            print("cp %s %s"%(path, f))
-            shutil.copy(path, f)
+            os.makedirs(d, exist_ok=True)
+
+    def copy(job):
+        s, d = job
+        print("cp %s %s"%(s, d))
+        _link_or_copy(s, d, link)
+        return d
+
+    if len(stale) <= 1:
+        return [copy(job) for job in stale]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(copy, stale))
 
 
 def base_version(version):
@@ -0,0 +1,95 @@
+"""
+Benchmark of the handoff of an evaluated notebook from its execution to
+its rendering, on a notebook with large outputs.
+
+Compares the previous handoff through the disk (serialized, written,
+read back and parsed again before being passed as JSON text to the
+myst-nb parser) to the in-memory handoff of nbsite.nbbuild, the
+evaluated notebook being written in the background. Reports the time
+spent on the critical path and the peak memory allocated.
+
+    python scripts/bench_notebook_handoff.py --cells 20 --output-size 2
+"""
+
+import argparse
+import base64
+import io
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+import nbformat
+
+from nbconvert import NotebookExporter
+
+from nbsite.nbbuild import (
+    _shallow_copy, wait_for_notebook_writes, write_notebook_in_background,
+)
+
+
+def make_notebook(cells, output_size):
+    """A notebook with cells having output_size MB of outputs each."""
+    nb = nbformat.v4.new_notebook()
+    payload = base64.b64encode(os.urandom(output_size * 1024**2 * 3 // 4)).decode()
+    for i in range(cells):
+        nb.cells.append(nbformat.v4.new_markdown_cell(f'# Section {i}'))
+        cell = nbformat.v4.new_code_cell(f'plot({i})', execution_count=i + 1)
+        cell.outputs = [nbformat.v4.new_output(
+            'display_data', data={'image/png': payload, 'text/plain': '<Figure>'}
+        )]
+        nb.cells.append(cell)
+    return nb
+
+
+def disk_handoff(notebook, dest_path):
+    newnb, _ = NotebookExporter().from_notebook_node(notebook)
+    with open(dest_path, 'w', encoding='utf-8') as f:
+        f.write(newnb)
+    with open(dest_path, encoding='utf-8') as f:
+        text = f.read()
+    ntbk = nbformat.reads(text, as_version=4)
+    sio = io.StringIO(json.dumps(ntbk))
+    # What the myst-nb reader does with the text it is given.
+    return nbformat.reads(sio.read(), as_version=4)
+
+
+def memory_handoff(notebook, dest_path):
+    write_notebook_in_background(notebook, dest_path)
+    return _shallow_copy(notebook)
+
+
+def measure(handoff, notebook, dest_path):
+    tracemalloc.start()
+    start = time.perf_counter()
+    handoff(notebook, dest_path)
+    critical = time.perf_counter() - start
+    wait_for_notebook_writes()
+    total = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return critical, total, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--cells', type=int, default=20, help='number of code cells')
+    parser.add_argument('--output-size', type=int, default=2, help='size of the output of each cell in MB')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    notebook = make_notebook(args.cells, args.output_size)
+    print(f'Notebook with {args.cells} cells of {args.output_size}MB outputs')
+    with tempfile.TemporaryDirectory() as tmp:
+        dest_path = os.path.join(tmp, 'evaluated.ipynb')
+        for name, handoff in [('disk', disk_handoff), ('memory', memory_handoff)]:
+            critical, total, peak = min(
+                measure(handoff, notebook, dest_path) for _ in range(args.repeat)
+            )
+            print(f'{name:>8}: {critical:.3f}s critical path, {total:.3f}s total, '
+                  f'{peak / 1024**2:.0f}MiB peak allocated')
+
+
+if __name__ == '__main__':
+    main()